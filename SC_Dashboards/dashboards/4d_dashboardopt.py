@@ -14,14 +14,22 @@ Features:
 """
 
 import numpy as np
+import h5py
+import concurrent.futures
+import glob
+import json
 import os
+import threading
 import time
+import types
 from bokeh.io import curdoc
 from bokeh.layouts import column, row
 from bokeh.models import ColumnDataSource, Div
 from bokeh.plotting import figure
 from bokeh.models import (
+    BoxEditTool,
     ColorBar,
+    FreehandDrawTool,
     LinearColorMapper,
     LogColorMapper,
     LogScale,
@@ -204,6 +212,31 @@ except ImportError:
     def cleanup_mongodb():
         pass
 
+# Disk-budget LRU for derived caches (optional, see derived_cache_manager.py)
+try:
+    import derived_cache_manager
+except ImportError:
+    derived_cache_manager = None
+
+# Volume caches, shared stores and analysis engines (sibling modules shipped with the dashboard)
+from volume_cache import (
+    LIVE_MODE, NEXUS_CATALOG_VERSION, QUANTIZED_ENCODINGS, VOLUME_CACHE_SLAB_BYTES,
+    ByteBudgetLRUCache, LiveVolumeTail, ProgressiveVolumeCache, QuantizedVolume, SharedVolumeRegistry,
+    TiledVolume, artifact_fingerprint, bounded_read, build_nexus_catalog, build_summed_area_table,
+    build_volume_pyramid, dataset_index_is_current, describe_catalog_entry, detector_axes,
+    fingerprint_matches, index_key, interactive_level, load_dataset_index, open_contiguous_float32, open_nexus,
+    summed_area_sum, touch_artifact, write_fingerprint, write_quantized_volume,
+)
+from volume_analysis import (
+    AZIMUTHAL_CHI_BINS, AZIMUTHAL_Q_BINS, CLUSTER_COUNT, CLUSTER_REFINE_PASSES, DECOMPOSITION_COMPONENTS,
+    NMF_PASSES, PCA_PASSES, RATIO_PERCENTILES, ROI_STATISTICS,
+    AzimuthalIntegrator, DecompositionJob, InteractiveRefiner, MaskWeights, ROIReductionEngine,
+    build_integrated_volume, cluster_scan_points, format_detector_geometry, format_roi_set,
+    integrated_profile, nan_percentiles, normalize_roi_set, parse_detector_geometry, parse_mask_set,
+    parse_roi_set, ratio_map, read_detector_geometry, roi_set_sums, roi_statistics, roi_strip_deltas,
+    streaming_nmf, streaming_pca,
+)
+
 # Global variables
 uuid = None
 server = None
@@ -212,12 +245,65 @@ base_dir = None
 is_authorized = False
 user_email = None
 status_messages = []
+nexus_catalog = None
 
 DOMAIN_NAME = os.getenv('DOMAIN_NAME', '')
 DATA_IS_LOCAL = (DOMAIN_NAME == 'localhost' or DOMAIN_NAME == '' or DOMAIN_NAME is None)
 local_base_dir = f"/Users/amygooch/GIT/SCI/DATA/s14_nxs/"
 #local_base_dir = f"/Users/amygooch/GIT/SCI/DATA/waxs/pil11/"
 
+# Memmap uncompressed, contiguous float32 datasets in place instead of copying them
+ZERO_COPY_VOLUMES = os.getenv('SC_4D_ZERO_COPY', '1') == '1'
+# Compact encoding of the volume cache: float32 (none), float16, uint16 or log-uint16
+VOLUME_CACHE_ENCODING = os.getenv('SC_4D_CACHE_ENCODING', 'float32')
+# Also build the tiled (blocked) volume cache next to the flat memmap
+TILED_VOLUME_CACHE = os.getenv('SC_4D_TILED_CACHE', '0') == '1'
+# Binning factors of the multi-resolution pyramid built next to the memmap cache
+PYRAMID_FACTORS = (2, 4, 8)
+BUILD_VOLUME_PYRAMID = os.getenv('SC_4D_PYRAMID', '1') == '1'
+# Largest pyramid level (in bytes) considered cheap enough to read on every drag event
+PYRAMID_INTERACTIVE_BYTES = int(os.getenv('SC_4D_PYRAMID_INTERACTIVE_MB', '512')) * 1024 * 1024
+# Also build float64 summed-area tables over the detector axes for O(1) rectangular ROI sums
+BUILD_ROI_SAT = os.getenv('SC_4D_ROI_SAT', '0') == '1'
+# Detector binning of the summed-area tables (ROIs snap to these bins unless aligned to them)
+ROI_SAT_FACTOR = int(os.getenv('SC_4D_SAT_FACTOR', '1'))
+# Minimum time between two background prunes of the derived caches in one server process
+DERIVED_CACHE_PRUNE_SECONDS = 3600
+# Byte budget of the process-wide LRU cache behind load_dataset_by_path()
+DATASET_CACHE_BYTES = int(os.getenv('SC_4D_DATASET_CACHE_MB', '512')) * 1024 * 1024
+# Process4dNexus attributes holding the small datasets a plot configuration reads
+PICKED_DATASET_ATTRIBUTES = (
+    'plot1_single_dataset_picked', 'presample_picked', 'postsample_picked',
+    'x_coords_picked', 'y_coords_picked', 'probe_x_coords_picked', 'probe_y_coords_picked',
+    'plot1b_single_dataset_picked', 'presample_picked_b', 'postsample_picked_b',
+    'probe_x_coords_picked_b', 'probe_y_coords_picked_b',
+)
+# Live acquisition (SC_4D_LIVE, see volume_cache.LIVE_MODE): how often the SWMR tail is polled
+LIVE_POLL_MS = int(os.getenv('SC_4D_LIVE_POLL_MS', '1000'))
+# Minimum seconds between two Plot2/Plot3 refreshes triggered by new scan rows
+LIVE_REFRESH_SECONDS = float(os.getenv('SC_4D_LIVE_REFRESH_SECONDS', '2'))
+# Largest Plot2B volume whose pages are pre-faulted by the speculative preload
+PRELOAD_VOLUME_BYTES = int(os.getenv('SC_4D_PRELOAD_MB', '8192')) * 1024 * 1024
+# Threads shared by all sessions for ROI reductions (0 = one per core, at most 8)
+REDUCE_THREADS = int(os.getenv('SC_4D_REDUCE_THREADS', '0')) or min(8, os.cpu_count() or 1)
+# x-slab size of one ROI reduction task (smaller = faster cancellation and progress)
+REDUCE_SLAB_BYTES = int(os.getenv('SC_4D_REDUCE_SLAB_MB', '64')) * 1024 * 1024
+# Selector labels of the maps produced together by one pass over an ROI (see roi_statistics())
+ROI_STATISTIC_LABELS = {
+    'sum': "Sum", 'mean': "Mean", 'max': "Max", 'std': "Standard deviation",
+    'centroid_z': "Centroid (z)", 'centroid_u': "Centroid (u)",
+}
+# Derived integrated volumes are exposed as '<source>@I(q)-<key>' datasets (with '/q' and '/chi' axes)
+INTEGRATED_DATASET_MARKER = '@I(q'
+# Streaming decompositions of probe spectra offered by the decomposition panel
+DECOMPOSITION_METHODS = ('pca', 'nmf')
+# Per-component stacks of decomposition / clustering results, listed as '<root>/<name>_<i>' datasets
+DERIVED_STACK_PARTS = {'loading': 'loadings', 'component': 'components', 'mean': 'means'}
+# Per-directory catalog of .nxs files behind the file picker (see volume_cache.build_nexus_catalog())
+NEXUS_CATALOG_NAME = '.nexus_catalog.json'
+# Sessions reuse a catalog this recent without walking the directory again
+NEXUS_CATALOG_TTL_SECONDS = float(os.getenv('SC_4D_CATALOG_TTL_SECONDS', '300'))
+
 def add_status_message(message):
     """Add a status message to the collection"""
     global status_messages
@@ -225,6 +311,19 @@ def add_status_message(message):
     print(f"📝 {message}")
 
 
+def create_roi_statistic_select(callback, value='sum', width=200):
+    """Selector of the Plot3 ROI statistic; callback receives the ROI_STATISTICS name."""
+    labels = {label: statistic for statistic, label in ROI_STATISTIC_LABELS.items()}
+    select = create_select(
+        title="ROI Statistic:",
+        value=ROI_STATISTIC_LABELS[value],
+        options=list(labels),
+        width=width
+    )
+    select.on_change("value", lambda attr, old, new: callback(labels[new]))
+    return select
+
+
 def create_status_display_widget():
     """Create a status display widget"""
     global status_messages
@@ -273,8 +372,8 @@ def find_nxs_files(directory):
 
 
 def find_nexus_and_mmap_files():
-    """Find nexus and memmap files"""
-    global base_dir, save_dir
+    """Find nexus and memmap files (the first scan of the base_dir, else save_dir, catalog)"""
+    global base_dir, save_dir, nexus_catalog
     
     print("=" * 80)
     print("🔍 DEBUG: find_nexus_and_mmap_files() called")
@@ -285,47 +384,1600 @@ def find_nexus_and_mmap_files():
         print("❌ DEBUG: base_dir is None, returning None, None")
         return None, None
     
-    print(f"🔍 DEBUG: Checking if base_dir exists: {os.path.exists(base_dir)}")
-    if not os.path.exists(base_dir):
-        print(f"❌ DEBUG: base_dir does not exist: {base_dir}")
-    else:
-        print(f"🔍 DEBUG: base_dir is a directory: {os.path.isdir(base_dir)}")
-    
-    nxs_files = find_nxs_files(base_dir)
-    print(f"🔍 DEBUG: Found {len(nxs_files)} .nxs files in base_dir")
-    if nxs_files:
-        print(f"🔍 DEBUG: First few .nxs files: {nxs_files[:3]}")
-    
-    if len(nxs_files) > 0:
-        nexus_filename = nxs_files[0]
+    for label, directory in (('base_dir', base_dir), ('save_dir', save_dir)):
+        if not directory or not os.path.isdir(directory):
+            print(f"🔍 DEBUG: {label} is not a directory: {directory}")
+            continue
+        catalog = load_nexus_catalog(directory)
+        readable = [entry for entry in catalog['files'] if 'error' not in entry]
+        print(f"🔍 DEBUG: Found {len(catalog['files'])} .nxs files in {label} ({len(readable)} readable)")
+        if not catalog['files']:
+            continue
+        nexus_catalog = catalog
+        nexus_filename = (readable or catalog['files'])[0]['path']
         mmap_filename = nexus_filename.replace('.nxs', '.float32.dat')
-        print(f"✅ DEBUG: Using nexus file from base_dir: {nexus_filename}")
+        print(f"✅ DEBUG: Using nexus file from {label}: {nexus_filename}")
         print(f"🔍 DEBUG: Corresponding mmap file: {mmap_filename}")
-        print(f"🔍 DEBUG: Checking if nexus file exists: {os.path.exists(nexus_filename)}")
-        print(f"🔍 DEBUG: Checking if mmap file exists: {os.path.exists(mmap_filename)}")
         return nexus_filename, mmap_filename
-    else:
-        print(f"🔍 DEBUG: No .nxs files in base_dir, checking save_dir: {save_dir}")
-        if save_dir:
-            print(f"🔍 DEBUG: Checking if save_dir exists: {os.path.exists(save_dir)}")
-            nxs_files = find_nxs_files(save_dir)
-            print(f"🔍 DEBUG: Found {len(nxs_files)} .nxs files in save_dir")
-            if nxs_files:
-                print(f"🔍 DEBUG: First few .nxs files: {nxs_files[:3]}")
-            if len(nxs_files) > 0:
-                nexus_filename = nxs_files[0]
-                mmap_filename = nexus_filename.replace('.nxs', '.float32.dat')
-                print(f"✅ DEBUG: Using nexus file from save_dir: {nexus_filename}")
-                print(f"🔍 DEBUG: Corresponding mmap file: {mmap_filename}")
-                print(f"🔍 DEBUG: Checking if nexus file exists: {os.path.exists(nexus_filename)}")
-                print(f"🔍 DEBUG: Checking if mmap file exists: {os.path.exists(mmap_filename)}")
-                return nexus_filename, mmap_filename
     
     print("❌ DEBUG: No .nxs files found in base_dir or save_dir")
     print("=" * 80)
     return None, None
 
 
+def load_nexus_catalog(directory, refresh=False):
+    """
+    Return the catalog of .nxs files under directory, see build_nexus_catalog().
+
+    A catalog younger than NEXUS_CATALOG_TTL_SECONDS is shared by all sessions
+    of this server process; otherwise the directory is walked again, reusing
+    the entries of the on-disk catalog (<directory>/.nexus_catalog.json) for
+    unchanged files.
+    """
+    holder = _shared_state()
+    if getattr(holder, 'nexus_catalogs', None) is None:
+        holder.nexus_catalogs = {}
+    directory = os.path.realpath(directory)
+    catalog = holder.nexus_catalogs.get(directory)
+    if catalog is not None and not refresh and time.time() - catalog['built_at'] < NEXUS_CATALOG_TTL_SECONDS:
+        return catalog
+
+    catalog_filename = os.path.join(directory, NEXUS_CATALOG_NAME)
+    if catalog is None:
+        try:
+            with open(catalog_filename, 'r') as fp:
+                catalog = json.load(fp)
+            if catalog.get('version') != NEXUS_CATALOG_VERSION:
+                catalog = None
+        except (OSError, ValueError):
+            catalog = None
+    t0 = time.time()
+    catalog = build_nexus_catalog(directory, previous=catalog)
+    print(f"✅ Cataloged {len(catalog['files'])} .nxs files in {directory} ({time.time() - t0:.1f}s)")
+    partial_filename = f"{catalog_filename}.partial-{os.getpid()}"
+    try:
+        with open(partial_filename, 'w') as fp:
+            json.dump(catalog, fp)
+        os.replace(partial_filename, catalog_filename)
+    except OSError as e:
+        print(f"⚠️ Could not write NeXus catalog {catalog_filename}: {e}")
+    holder.nexus_catalogs[directory] = catalog
+    return catalog
+
+
+class RateLimitedCallback:
+    """Calls callback(lo, hi) at most every min_interval seconds, merging the row ranges in between."""
+
+    def __init__(self, callback, min_interval=0.0, name=None):
+        self.callback = callback
+        self.min_interval = min_interval
+        self.name = name
+        self._last = 0.0
+        self._pending = None
+
+    def __call__(self, lo, hi):
+        self._pending = (lo, hi) if self._pending is None else (min(self._pending[0], lo), max(self._pending[1], hi))
+        self.flush()
+
+    def flush(self):
+        if self._pending is None or time.time() - self._last < self.min_interval:
+            return
+        lo, hi = self._pending
+        self._pending = None
+        self._last = time.time()
+        self.callback(lo, hi)
+
+
+def schedule_derived_cache_prune(status_callback=None):
+    """
+    Evict least recently used derived caches over SC_DERIVED_CACHE_BUDGET_GB in a background thread.
+
+    Runs at most once per DERIVED_CACHE_PRUNE_SECONDS per server process; a
+    no-op without a budget or without derived_cache_manager.
+    """
+    if derived_cache_manager is None or derived_cache_manager.DEFAULT_BUDGET_BYTES <= 0:
+        return None
+    holder = _shared_state()
+    with holder.prune_lock:
+        if time.time() - holder.last_derived_cache_prune < DERIVED_CACHE_PRUNE_SECONDS:
+            return None
+        holder.last_derived_cache_prune = time.time()
+    status_callback = status_callback or print
+
+    def _prune():
+        try:
+            # Artifacts open in some session may be idle on disk (their sidecar is touched hourly at most)
+            evicted = derived_cache_manager.prune(derived_cache_manager.scan(),
+                                                  derived_cache_manager.DEFAULT_BUDGET_BYTES,
+                                                  keep=get_shared_volume_registry().filenames())
+            if evicted:
+                status_callback(f"🔍 Evicted {len(evicted)} unused derived caches "
+                                f"({sum(a.size for a in evicted) / 1e9:.1f} GB) to stay under the disk budget")
+        except Exception as e:
+            print(f"⚠️ Derived cache prune failed: {e}")
+
+    thread = threading.Thread(target=_prune, name="derived-cache-prune", daemon=True)
+    thread.start()
+    return thread
+
+
+def _shared_state():
+    """
+    Return the module object holding this server process's shared caches.
+
+    Bokeh re-executes this script for every session, so module globals are
+    per-session; shared state is parked in sys.modules to outlive them.
+    """
+    holder = sys.modules.get('_sc_4d_shared_volumes')
+    if holder is None:
+        holder = types.ModuleType('_sc_4d_shared_volumes')
+        holder.registry = SharedVolumeRegistry()
+        holder.prune_lock = threading.Lock()
+        holder.last_derived_cache_prune = 0.0
+        sys.modules['_sc_4d_shared_volumes'] = holder
+    return holder
+
+
+def get_shared_volume_registry():
+    """Return the SharedVolumeRegistry of this server process."""
+    return _shared_state().registry
+
+
+def get_shared_reduction_pool():
+    """Return the thread pool running ROI reductions of this server process."""
+    holder = _shared_state()
+    if getattr(holder, 'reduction_pool', None) is None:
+        holder.reduction_pool = concurrent.futures.ThreadPoolExecutor(REDUCE_THREADS, thread_name_prefix="roi-reduce")
+    return holder.reduction_pool
+
+
+def get_shared_dataset_cache():
+    """Return the ByteBudgetLRUCache behind load_dataset_by_path() of this server process."""
+    holder = _shared_state()
+    if getattr(holder, 'dataset_cache', None) is None:
+        holder.dataset_cache = ByteBudgetLRUCache(DATASET_CACHE_BYTES)
+    return holder.dataset_cache
+
+
+class Process4dNexusOpt(Process4dNexus):
+    """
+    Process4dNexus with dashboard-side volume caching.
+
+    When the float32 memmap cache of a 3D/4D volume does not exist yet, the
+    base class would cast the whole volume before anything renders. Here the
+    cache is built by a ProgressiveVolumeCache in the background instead, and
+    load_dataset_by_path() hands out a ProgressiveVolume until it is done.
+
+    Volumes, caches and background builds live in the process-wide
+    SharedVolumeRegistry, so sessions opening the same file share one copy;
+    call release() (or the registry's release_session) when the session ends.
+    """
+
+    def __init__(self, nexus_filename, mmap_filename, cached_cast_float=True, status_callback=None,
+                 session_id=None, live=False, **kwargs):
+        self._opt_nexus_filename = nexus_filename
+        self._opt_mmap_filename = mmap_filename
+        self._opt_cached_cast_float = cached_cast_float
+        self._opt_status_callback = status_callback or print
+        self._session_id = session_id if session_id is not None else f"local-{id(self)}"
+        self._shared_volumes = get_shared_volume_registry()
+        self._dataset_cache = get_shared_dataset_cache()
+        self._non_volume_paths = set()
+        self._volume_b_preload = None
+        self._live = live
+        self._live_rows_seen = 0
+        self._live_listeners = []
+        self._seen_fingerprint = None
+        self._roi_engines = {}
+        self._integrated = None
+        self._decomposition_job = None
+        self._clustering_job = None
+        self.decompositions = {}
+        self.roi_set = []
+        self.detector_masks = {}
+        self._last_roi = {}
+        super().__init__(
+            nexus_filename,
+            mmap_filename,
+            # Only let the base class use the cache when it already exists (no blocking cast)
+            cached_cast_float=cached_cast_float and os.path.exists(mmap_filename),
+            status_callback=status_callback,
+            **kwargs
+        )
+
+    def get_volume_cache_filename(self, dataset_path):
+        """Return the float32 memmap cache filename for a dataset."""
+        try:
+            return self.get_memmap_filename_for(dataset_path)
+        except Exception:
+            base = os.path.splitext(self._opt_nexus_filename)[0]
+            return f"{base}.{dataset_path.strip('/').replace('/', '_')}.float32.dat"
+
+    def _shared(self, dataset_path, dtype, factory, valid=None):
+        key = SharedVolumeRegistry.make_key(self._opt_nexus_filename, dataset_path, dtype)
+        # Live volumes and tails are shared across new rows; only their derived maps follow the row count
+        fingerprint = 'live' if self._live else self._source_fingerprint()
+        return self._shared_volumes.acquire(key, self._session_id, factory, valid=valid, fingerprint=fingerprint)
+
+    def get_dataset_entry(self, dataset_path):
+        """Return the dataset index entry (path, shape, dtype, ...) of a dataset, or None."""
+        index = self.get_dataset_index()
+        by_path = index.get('by_path')
+        if by_path is None:
+            by_path = index['by_path'] = {entry['path']: entry for entry in index['datasets']}
+        return by_path.get(dataset_path.strip('/'))
+
+    def get_fingerprint(self, dataset_path, transform):
+        """Fingerprint of the artifact derived from dataset_path by transform (see artifact_fingerprint)."""
+        entry = self.get_dataset_entry(dataset_path)
+        if entry is not None:
+            shape, dtype = entry['shape'], entry['dtype']
+        else:
+            with open_nexus(self._opt_nexus_filename, live=self._live) as f:
+                shape, dtype = f[dataset_path].shape, f[dataset_path].dtype
+        return artifact_fingerprint(self._opt_nexus_filename, dataset_path, shape, dtype, transform)
+
+    def is_artifact_current(self, filename, dataset_path, transform):
+        """O(1) staleness check of a derived artifact against the current source file (counts as a use)."""
+        if not os.path.exists(filename) or not fingerprint_matches(filename, self.get_fingerprint(dataset_path, transform)):
+            return False
+        touch_artifact(filename)
+        return True
+
+    def release(self):
+        """Drop this session's references to shared volumes; returns the registry keys no session uses anymore."""
+        for engine in self._roi_engines.values():
+            engine.cancel()
+        for job in (self._decomposition_job, self._clustering_job):
+            if job is not None:
+                job.cancel()
+        return self._shared_volumes.release_session(self._session_id)
+
+    def get_dataset_index_filename(self):
+        return os.path.splitext(self._opt_nexus_filename)[0] + '.choices.json'
+
+    def get_dataset_index(self):
+        """Return the (shared) dataset index of the NeXus file, see load_dataset_index()."""
+        return self._shared('/', 'index', lambda: load_dataset_index(
+            self._opt_nexus_filename, self.get_dataset_index_filename(), status_callback=self._opt_status_callback,
+            live=self._live,
+        ), valid=lambda index: dataset_index_is_current(index, self._opt_nexus_filename))
+
+    def get_choices(self):
+        """
+        Categorize the datasets of the file by dimension and by name.
+
+        Served from the sidecar dataset index in a single pass instead of
+        walking the HDF5 hierarchy on every page load.
+        """
+        try:
+            index = self.get_dataset_index()
+        except Exception as e:
+            if self._live:
+                # The base class walks the file with a plain (non-SWMR) open, which the writer's lock refuses
+                print(f"⚠️ Dataset index unavailable ({e}), no datasets to choose from yet")
+                index = {'datasets': []}
+            else:
+                print(f"⚠️ Dataset index unavailable ({e}), walking the file instead")
+                return super().get_choices()
+        dimensions_categories = {'scalar': [], '1d': [], '2d': [], '3d': [], '4d': [], 'unknown': []}
+        names_categories = {}
+        for entry in index['datasets']:
+            ndim = len(entry['shape'])
+            category = 'scalar' if ndim == 0 else (f'{ndim}d' if ndim <= 4 else 'unknown')
+            dimensions_categories[category].append(entry)
+            names_categories.setdefault(entry['path'].split('/')[-1], []).append(entry)
+        self.dimensions_categories = dimensions_categories
+        self.names_categories = names_categories
+        self.choices_done = True
+        # Integrated volumes (and their q / chi axes) are browsed like the datasets they were derived from
+        for path, integrated in self.get_integrated_datasets(refresh=True).items():
+            shape = integrated['shape']
+            dimensions_categories[f'{len(shape)}d'].append({'path': path, 'shape': shape, 'dtype': '<f4'})
+            for axis in ('q', 'chi'):
+                if integrated[axis] is not None:
+                    dimensions_categories['1d'].append(
+                        {'path': f"{path}/{axis}", 'shape': [len(integrated[axis])], 'dtype': '<f4'})
+        for root, result in self.decompositions.items():
+            self._add_decomposition_choices(root, result)
+        return True
+
+    def get_datasets_by_dimension(self, dimension):
+        if not getattr(self, 'choices_done', False):
+            self.get_choices()
+        return list(self.dimensions_categories.get(f'{dimension}d', []))
+
+    def find_1d_dataset_by_size(self, target_size, exclude_paths=None, parent_dir=None):
+        """Return the "path shape" choice of the first 1D dataset of target_size (optionally under parent_dir)."""
+        exclude_paths = {p.rsplit(' (', 1)[0] for p in (exclude_paths or []) if p}
+        for dataset in self.get_datasets_by_dimension(1):
+            if dataset['path'] in exclude_paths:
+                continue
+            if parent_dir is not None and not dataset['path'].startswith(parent_dir + '/'):
+                continue
+            if dataset['shape'][0] == target_size:
+                return f"{dataset['path']} {dataset['shape']}"
+        return None
+
+    def auto_populate_map_coords(self, plot1_shape):
+        """Pick Map X/Y coordinate choices matching a 2D dataset shape."""
+        if plot1_shape is None or len(plot1_shape) != 2:
+            return None, None
+        map_x_choice = self.find_1d_dataset_by_size(plot1_shape[0])
+        map_y_choice = self.find_1d_dataset_by_size(plot1_shape[1], exclude_paths=[map_x_choice])
+        return map_x_choice, map_y_choice
+
+    def auto_populate_probe_coords(self, probe_dataset_path, probe_shape):
+        """Pick Probe X (and Y for 4D) choices from 1D datasets next to the probe dataset."""
+        if not probe_dataset_path or probe_shape is None or len(probe_shape) not in (3, 4):
+            return None, None
+        parent_dir = '/'.join(probe_dataset_path.split('/')[:-1])
+        if not parent_dir:
+            return None, None
+        probe_x_choice = self.find_1d_dataset_by_size(probe_shape[2], parent_dir=parent_dir)
+        if len(probe_shape) == 3:
+            return probe_x_choice, None
+        return probe_x_choice, self.find_1d_dataset_by_size(probe_shape[3], parent_dir=parent_dir)
+
+    def get_volume(self, dataset_path):
+        """
+        Return a float32 array-like for a 3D/4D dataset, or None for other datasets.
+
+        Uses the finished memmap cache (or its compact encoding, see
+        SC_4D_CACHE_ENCODING) when it exists; otherwise starts (or reuses) a
+        background cache build and returns a ProgressiveVolume.
+        """
+        if not dataset_path or not self._opt_cached_cast_float or dataset_path in self._non_volume_paths:
+            return None
+        if self._live and dataset_path == getattr(self, 'volume_picked', None):
+            tail = self.get_live_tail()
+            if tail is not None:
+                return tail.volume
+        if INTEGRATED_DATASET_MARKER in dataset_path:
+            integrated = self.get_integrated_datasets().get(dataset_path.strip('/'))
+            if integrated is None:
+                return None
+            return self._shared(dataset_path, 'float32', lambda: np.memmap(
+                integrated['filename'], dtype=np.float32, mode='r', shape=tuple(integrated['shape'])))
+
+        def _open():
+            with open_nexus(self._opt_nexus_filename, live=self._live) as f:
+                dset = f.get(dataset_path)
+                if not isinstance(dset, h5py.Dataset) or dset.ndim < 3:
+                    return None
+                shape = tuple(dset.shape)
+            volume = (open_contiguous_float32(self._opt_nexus_filename, dataset_path, live=self._live)
+                      if ZERO_COPY_VOLUMES else None)
+            if volume is not None:
+                self._opt_status_callback(f"✅ {dataset_path} is contiguous float32, reading it in place (no cache file)")
+                if BUILD_VOLUME_PYRAMID and not self.has_pyramid(dataset_path):
+                    self.build_pyramid(dataset_path, source=volume)
+                return volume
+            if TILED_VOLUME_CACHE and self.get_tiled_volume(dataset_path) is None:
+                self.build_tiled_cache(dataset_path)
+            quantized = self.get_quantized_volume(dataset_path)
+            if quantized is not None and quantized.shape == shape:
+                if BUILD_VOLUME_PYRAMID and not self.has_pyramid(dataset_path):
+                    self.build_pyramid(dataset_path, source=quantized)
+                return quantized
+            cache_filename = self.get_volume_cache_filename(dataset_path)
+            if (self.is_artifact_current(cache_filename, dataset_path, 'float32')
+                    and os.path.getsize(cache_filename) == int(np.prod(shape)) * 4):
+                volume = np.memmap(cache_filename, dtype=np.float32, mode='r', shape=shape)
+                self._on_volume_cache_ready(dataset_path, volume)
+                return volume
+            cache = ProgressiveVolumeCache(
+                self._opt_nexus_filename,
+                dataset_path,
+                cache_filename,
+                status_callback=self._opt_status_callback,
+                on_complete=lambda volume: self._on_volume_cache_ready(dataset_path, volume),
+                fingerprint=self.get_fingerprint(dataset_path, 'float32'),
+                live=self._live,
+            )
+            cache.start()
+            return cache
+
+        def _current(value):
+            if getattr(value, 'error', None) is not None:
+                return False
+            # Switch sessions over to the compact cache once it has been written
+            return (VOLUME_CACHE_ENCODING == 'float32' or hasattr(value, 'encoding')
+                    or not os.path.exists(self.get_quantized_cache_filename(dataset_path) + '.meta.json'))
+
+        # The finished memmap, compact cache or (possibly still building) cache; a failed build is retried
+        shared = self._shared(dataset_path, 'float32', _open, valid=_current)
+        if shared is None:
+            self._non_volume_paths.add(dataset_path)
+            return None
+        if isinstance(shared, np.ndarray) or not hasattr(shared, 'volume'):
+            return shared
+        return shared.volume()
+
+    def _on_volume_cache_ready(self, dataset_path, volume):
+        """Derive the pyramid and compact cache from the finished float32 memmap rather than re-reading HDF5."""
+        if BUILD_VOLUME_PYRAMID and not self.has_pyramid(dataset_path):
+            self.build_pyramid(dataset_path, source=volume)
+        if BUILD_ROI_SAT and not self.is_artifact_current(self.get_roi_sat_filename(dataset_path), dataset_path, 'sat'):
+            self.build_roi_sat(dataset_path, source=volume)
+        if VOLUME_CACHE_ENCODING != 'float32':
+            self.build_quantized_cache(dataset_path, source=volume)
+
+    def get_quantized_cache_filename(self, dataset_path, encoding=None):
+        flat = self.get_volume_cache_filename(dataset_path)
+        base = flat[:-len('.float32.dat')] if flat.endswith('.float32.dat') else flat
+        return f"{base}.{encoding or VOLUME_CACHE_ENCODING}.dat"
+
+    def get_quantized_volume(self, dataset_path, encoding=None):
+        """Return the QuantizedVolume of a dataset, or None if it has not been built."""
+        if (encoding or VOLUME_CACHE_ENCODING) == 'float32':
+            return None
+        filename = self.get_quantized_cache_filename(dataset_path, encoding)
+        if not os.path.exists(f"{filename}.json") or not self.is_artifact_current(
+                filename, dataset_path, encoding or VOLUME_CACHE_ENCODING):
+            return None
+        try:
+            return QuantizedVolume(filename)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️ Ignoring unreadable quantized cache {filename}: {e}")
+            return None
+
+    def build_quantized_cache(self, dataset_path, source, encoding=None, background=True, remove_float32=True):
+        """
+        Encode source (the float32 volume) into the compact cache, reporting the max quantization error.
+
+        With remove_float32 the float32 cache file is deleted once the compact
+        cache has been written and every value checked to decode (see
+        write_quantized_volume()); sessions still mapping it keep reading it
+        until they switch to the compact cache. A volume the encoding refuses
+        keeps its float32 cache and is not encoded again by this process.
+        """
+        encoding = encoding or VOLUME_CACHE_ENCODING
+        if encoding not in QUANTIZED_ENCODINGS:
+            raise ValueError(f"Unknown volume cache encoding {encoding!r}, expected one of {sorted(QUANTIZED_ENCODINGS)}")
+        filename = self.get_quantized_cache_filename(dataset_path, encoding)
+        fingerprint = self.get_fingerprint(dataset_path, encoding)
+        refused = threading.Event()
+
+        def _build():
+            t0 = time.time()
+            try:
+                quantized = write_quantized_volume(source, filename, encoding, status_callback=self._opt_status_callback)
+                write_fingerprint(filename, fingerprint)
+                self._opt_status_callback(
+                    f"✅ {encoding} volume cache ready for {dataset_path} ({time.time() - t0:.1f}s): "
+                    f"{quantized.stored_nbytes / 1e6:.0f} MB instead of {quantized.nbytes / 1e6:.0f} MB, "
+                    f"max quantization error {quantized.max_error:.4g}"
+                )
+                float32_filename = self.get_volume_cache_filename(dataset_path)
+                if remove_float32 and os.path.exists(float32_filename):
+                    os.remove(float32_filename)
+            except ValueError as e:
+                refused.set()
+                self._opt_status_callback(f"⚠️ Keeping the float32 volume cache of {dataset_path}: {e}")
+            except Exception as e:
+                self._opt_status_callback(f"❌ {encoding} volume cache build for {dataset_path} failed: {e}")
+
+        if not background:
+            _build()
+            return None
+
+        def _start():
+            thread = threading.Thread(target=_build, name=f"quantized-cache:{dataset_path}", daemon=True)
+            thread.refused = refused
+            thread.start()
+            return thread
+
+        # A refused volume would be refused again: its entry stays until the sessions using it are gone
+        return self._shared(dataset_path, f'build/{encoding}', _start,
+                            valid=lambda t: t.is_alive() or t.refused.is_set())
+
+    def preload_volume_b(self, dataset_path):
+        """
+        Speculatively load the Plot2B volume in a background thread.
+
+        Starts its cache build (or opens the finished cache), then pre-faults
+        its pages (up to SC_4D_PRELOAD_MB) and hands it over through
+        _cached_volume_b / _cached_volume_b_path. A new selection cancels the
+        previous preload.
+        """
+        current = self._volume_b_preload
+        if current is not None and current['path'] == dataset_path:
+            return current['thread']
+        self.cancel_volume_b_preload()
+        if not dataset_path:
+            return None
+        cancel = threading.Event()
+
+        def _preload():
+            t0 = time.time()
+            try:
+                key = SharedVolumeRegistry.make_key(self._opt_nexus_filename, dataset_path, 'float32')
+                started_build = self._shared_volumes.get(key) is None
+                volume = self.get_volume(dataset_path)
+                if volume is None:
+                    return
+                cache = getattr(volume, '_cache', None)
+                while cache is not None and not cache.complete and cache.error is None:
+                    if cancel.wait(0.5):
+                        # Stop a build nobody else asked for; the next selection would otherwise compete with it
+                        if started_build and self._shared_volumes.sessions_using(key) <= {self._session_id}:
+                            cache.cancel()
+                        return
+                volume = self.get_volume(dataset_path)
+                if volume.nbytes <= PRELOAD_VOLUME_BYTES:
+                    self._prefault_volume(volume, cancel)
+                if cancel.is_set():
+                    return
+                self._cached_volume_b = volume
+                self._cached_volume_b_path = dataset_path
+                print(f"✅ Plot2B volume {dataset_path} preloaded in {time.time() - t0:.1f}s")
+            except Exception as e:
+                print(f"⚠️ Plot2B preload of {dataset_path} failed: {e}")
+
+        thread = threading.Thread(target=_preload, name=f"plot2b-preload:{dataset_path}", daemon=True)
+        self._volume_b_preload = {'path': dataset_path, 'cancel': cancel, 'thread': thread}
+        thread.start()
+        return thread
+
+    def cancel_volume_b_preload(self):
+        current, self._volume_b_preload = self._volume_b_preload, None
+        if current is not None:
+            current['cancel'].set()
+        if getattr(self, '_cached_volume_b_path', None) is not None:
+            self._cached_volume_b = None
+            self._cached_volume_b_path = None
+
+    @staticmethod
+    def _prefault_volume(volume, cancel, slab_bytes=VOLUME_CACHE_SLAB_BYTES):
+        """Touch one element per page of a memmap-backed volume, slab by slab, until cancelled."""
+        data = getattr(volume, '_codes', volume)
+        if not isinstance(data, np.memmap):
+            return
+        flat = data.reshape(-1)
+        step = max(1, 4096 // flat.itemsize)
+        slab = max(step, slab_bytes // flat.itemsize // step * step)
+        for lo in range(0, flat.size, slab):
+            if cancel.is_set():
+                return
+            flat[lo:lo + slab:step].sum()
+
+    def get_live_tail(self):
+        """Return the (shared) LiveVolumeTail of the picked volume, or None if the file cannot be tailed."""
+        dataset_path = getattr(self, 'volume_picked', None)
+        if not dataset_path:
+            return None
+        flat = self.get_volume_cache_filename(dataset_path)
+        aux_paths = [p for p in (getattr(self, name, None) for name in PICKED_DATASET_ATTRIBUTES) if p]
+
+        def _open():
+            try:
+                tail = LiveVolumeTail(self._opt_nexus_filename, dataset_path, f"{flat}.live", aux_paths=aux_paths)
+            except Exception as e:
+                self._opt_status_callback(f"❌ Cannot tail {self._opt_nexus_filename} in SWMR mode: {e}")
+                return None
+            self._opt_status_callback(f"🔴 Live mode: following {dataset_path} as it is written")
+            return tail
+
+        return self._shared(dataset_path, 'float32/live', _open)
+
+    def add_live_listener(self, callback, min_interval=0.0, name=None):
+        """
+        Call callback(lo, hi) when scan rows [lo, hi) arrive in live mode.
+
+        Calls are rate-limited to one per min_interval seconds (ranges are
+        merged meanwhile), e.g. LIVE_REFRESH_SECONDS for Plot2/Plot3 refreshes.
+        A named listener replaces the previous one of that name, so panels
+        rebuilt by create_dashboard() subscribe once; switch_nexus_file()
+        only carries the unnamed ones over to the next file.
+        """
+        listener = RateLimitedCallback(callback, min_interval, name=name)
+        if name is not None:
+            self._live_listeners = [l for l in self._live_listeners if l.name != name]
+        self._live_listeners.append(listener)
+        return listener
+
+    def poll_live(self):
+        """
+        Pick up new scan rows: extend the cached maps/coordinates and ratio maps, then notify listeners.
+
+        Meant for a Bokeh periodic callback; returns the number of rows received so far.
+        """
+        tail = self.get_live_tail() if self._live else None
+        if tail is None:
+            return 0
+        tail.poll()
+        lo, hi = self._live_rows_seen, tail.rows
+        if hi > lo:
+            previous = self._source_fingerprint()
+            self._live_rows_seen = hi
+            fingerprint = self._source_fingerprint()
+            for path, data in tail.aux.items():
+                self._dataset_cache.put(self._dataset_cache_key(path), data, fingerprint)
+            self._extend_ratio_maps(previous)
+            for listener in self._live_listeners:
+                listener(lo, hi)
+        else:
+            for listener in self._live_listeners:
+                listener.flush()
+        return hi
+
+    def _extend_ratio_maps(self, previous):
+        """Append the ratio of new rows to the picked ratio maps cached under previous instead of recomputing them."""
+        fingerprint = self._source_fingerprint()
+        for suffix in ('', '_b'):
+            numerator = getattr(self, f'presample_picked{suffix}', None)
+            denominator = getattr(self, f'postsample_picked{suffix}', None)
+            if not numerator or not denominator:
+                continue
+            num = self.load_dataset_by_path(numerator)
+            den = self.load_dataset_by_path(denominator)
+            rows = min(len(num), len(den))
+            pair = (numerator, denominator)
+            old = self._dataset_cache.peek(self._dataset_cache_key(('ratio',) + pair), previous)
+            if old is not None and len(old) <= rows:
+                ratio = np.concatenate([old, ratio_map(num[len(old):rows], den[len(old):rows])])
+            else:
+                ratio = ratio_map(num[:rows], den[:rows])
+            ratio = self._dataset_cache.put(self._dataset_cache_key(('ratio',) + pair), ratio, fingerprint)
+            self._dataset_cache.put(self._dataset_cache_key(('ratio-percentiles',) + pair), nan_percentiles(ratio),
+                                    fingerprint)
+
+    def get_tiled_cache_filename(self, dataset_path):
+        """Return the tiled (blocked) cache filename for a dataset."""
+        flat = self.get_volume_cache_filename(dataset_path)
+        return (flat[:-len('.dat')] if flat.endswith('.dat') else flat) + '.tiles'
+
+    def get_tiled_volume(self, dataset_path):
+        """Return the TiledVolume for a dataset, or None if it has not been built (or is stale)."""
+        filename = self.get_tiled_cache_filename(dataset_path)
+
+        def _open():
+            if not self.is_artifact_current(filename, dataset_path, 'tiles'):
+                return None
+            try:
+                return TiledVolume(filename)
+            except (ValueError, OSError) as e:
+                print(f"⚠️ Ignoring unreadable tiled cache {filename}: {e}")
+                return None
+
+        return self._shared(dataset_path, 'float32/tiles', _open)
+
+    def build_tiled_cache(self, dataset_path, block_shape=None, background=True):
+        """Write the tiled cache for a 3D/4D dataset (in a background thread by default)."""
+        filename = self.get_tiled_cache_filename(dataset_path)
+        fingerprint = self.get_fingerprint(dataset_path, 'tiles')
+
+        def _build():
+            t0 = time.time()
+            try:
+                with open_nexus(self._opt_nexus_filename, live=self._live) as f:
+                    TiledVolume.write(filename, f[dataset_path], block_shape=block_shape,
+                                      status_callback=self._opt_status_callback)
+                write_fingerprint(filename, fingerprint)
+                self._opt_status_callback(f"✅ Tiled volume cache ready for {dataset_path} ({time.time() - t0:.1f}s)")
+            except Exception as e:
+                self._opt_status_callback(f"❌ Tiled volume cache build for {dataset_path} failed: {e}")
+
+        if not background:
+            _build()
+            return None
+
+        def _start():
+            thread = threading.Thread(target=_build, name=f"tiled-cache:{dataset_path}", daemon=True)
+            thread.start()
+            return thread
+
+        # One build per file across all sessions
+        return self._shared(dataset_path, 'build/tiles', _start, valid=lambda t: t.is_alive())
+
+    def get_pyramid_filename(self, dataset_path, factor):
+        """Return the memmap filename of one pyramid level."""
+        flat = self.get_volume_cache_filename(dataset_path)
+        base = flat[:-len('.float32.dat')] if flat.endswith('.float32.dat') else flat
+        return f"{base}.pyr{factor}.float32.dat"
+
+    def has_pyramid(self, dataset_path):
+        return all(self.is_artifact_current(self.get_pyramid_filename(dataset_path, f), dataset_path, 'pyramid')
+                   for f in PYRAMID_FACTORS)
+
+    def build_pyramid(self, dataset_path, source=None, background=True):
+        """Build the 2x/4x/8x binned levels of a volume (from source, default the volume itself)."""
+        filenames = {f: self.get_pyramid_filename(dataset_path, f) for f in PYRAMID_FACTORS}
+        fingerprint = self.get_fingerprint(dataset_path, 'pyramid')
+
+        def _build():
+            t0 = time.time()
+            try:
+                build_volume_pyramid(source if source is not None else self.get_volume(dataset_path),
+                                     filenames, status_callback=self._opt_status_callback)
+                for filename in filenames.values():
+                    write_fingerprint(filename, fingerprint)
+                self._opt_status_callback(f"✅ Volume pyramid ready for {dataset_path} ({time.time() - t0:.1f}s)")
+            except Exception as e:
+                self._opt_status_callback(f"❌ Volume pyramid build for {dataset_path} failed: {e}")
+
+        if not background:
+            _build()
+            return None
+
+        def _start():
+            thread = threading.Thread(target=_build, name=f"volume-pyramid:{dataset_path}", daemon=True)
+            thread.start()
+            return thread
+
+        return self._shared(dataset_path, 'build/pyramid', _start, valid=lambda t: t.is_alive())
+
+    def get_volume_level(self, dataset_path, factor=1):
+        """Return the volume binned by factor (1 = full resolution), or None if not built yet."""
+        if factor == 1:
+            return self.get_volume(dataset_path)
+        filename = self.get_pyramid_filename(dataset_path, factor)
+
+        def _open():
+            full = self.get_volume(dataset_path)
+            if full is None or not self.is_artifact_current(filename, dataset_path, 'pyramid'):
+                return None
+            shape = tuple(-(-n // factor) for n in full.shape)
+            if os.path.getsize(filename) != int(np.prod(shape)) * 4:
+                return None
+            return np.memmap(filename, dtype=np.float32, mode='r', shape=shape)
+
+        return self._shared(dataset_path, f'float32/pyr{factor}', _open)
+
+    def get_interactive_level(self, dataset_path):
+        """Finest built pyramid factor cheap enough to read on every drag event (1 if none)."""
+        full = self.get_volume(dataset_path)
+        if full is None or full.nbytes <= PYRAMID_INTERACTIVE_BYTES:
+            return 1
+        levels = {f: self.get_volume_level(dataset_path, f) for f in PYRAMID_FACTORS}
+        return interactive_level(full.nbytes, {f: level.nbytes for f, level in levels.items() if level is not None},
+                                 PYRAMID_INTERACTIVE_BYTES)
+
+    def get_roi_sat_filename(self, dataset_path):
+        """Return the filename of the summed-area table of a volume."""
+        flat = self.get_volume_cache_filename(dataset_path)
+        base = flat[:-len('.float32.dat')] if flat.endswith('.float32.dat') else flat
+        return f"{base}.sat{ROI_SAT_FACTOR}.float64.dat"
+
+    def build_roi_sat(self, dataset_path, source=None, background=True):
+        """Build the summed-area table of a volume (from source, default the volume itself)."""
+        filename = self.get_roi_sat_filename(dataset_path)
+        fingerprint = self.get_fingerprint(dataset_path, 'sat')
+
+        def _build():
+            t0 = time.time()
+            try:
+                build_summed_area_table(source if source is not None else self.get_volume(dataset_path),
+                                        filename, factor=ROI_SAT_FACTOR, status_callback=self._opt_status_callback)
+                write_fingerprint(filename, fingerprint)
+                self._opt_status_callback(f"✅ ROI summed-area table ready for {dataset_path} ({time.time() - t0:.1f}s)")
+            except Exception as e:
+                self._opt_status_callback(f"❌ ROI summed-area table build for {dataset_path} failed: {e}")
+
+        if not background:
+            _build()
+            return None
+
+        def _start():
+            thread = threading.Thread(target=_build, name=f"roi-sat:{dataset_path}", daemon=True)
+            thread.start()
+            return thread
+
+        return self._shared(dataset_path, 'build/sat', _start, valid=lambda t: t.is_alive())
+
+    def get_roi_sat(self, dataset_path):
+        """Return the summed-area table of a volume, or None if not built yet."""
+        filename = self.get_roi_sat_filename(dataset_path)
+
+        def _open():
+            full = self.get_volume(dataset_path)
+            if full is None or not self.is_artifact_current(filename, dataset_path, 'sat'):
+                return None
+            n_scan = len(full.shape) - detector_axes(len(full.shape))
+            shape = tuple(full.shape[:n_scan]) + tuple(-(-n // ROI_SAT_FACTOR) + 1 for n in full.shape[n_scan:])
+            if os.path.getsize(filename) != int(np.prod(shape)) * 8:
+                return None
+            return np.memmap(filename, dtype=np.float64, mode='r', shape=shape)
+
+        return self._shared(dataset_path, f'float64/sat{ROI_SAT_FACTOR}', _open)
+
+    def read_volume_region(self, dataset_path, *index):
+        """
+        Read volume[index] (e.g. x, y, z, u slices), touching only the blocks needed.
+
+        Falls back to the flat memmap / progressive volume when no tiled cache exists.
+        """
+        tiled = self.get_tiled_volume(dataset_path)
+        if tiled is not None:
+            return tiled[index]
+        return np.asarray(self.get_volume(dataset_path)[index])
+
+    def get_probe(self, dataset_path, x_idx, y_idx=None, level=1):
+        """
+        Return the detector data at one scan point (volume[x, y, ...]).
+
+        Indices are full-resolution; with level > 1 the binned probe of the
+        pyramid level containing that scan point is returned.
+        """
+        index = (x_idx,) if y_idx is None else (x_idx, y_idx)
+        if level > 1:
+            coarse = self.get_volume_level(dataset_path, level)
+            if coarse is not None:
+                return np.asarray(coarse[tuple(int(i) // level for i in index)])
+        return self.read_volume_region(dataset_path, *index)
+
+    def roi_sum_map(self, dataset_path, ranges, level=1, rows=None):
+        """
+        Sum the volume over an ROI in its trailing (detector) axes.
+
+        ranges holds one (lo, hi) pair per detector axis, e.g. ((z_lo, z_hi), (u_lo, u_hi))
+        for a 4D volume, in full-resolution indices; the result is a float64 map
+        over the remaining scan axes. With level > 1 the map is computed from
+        that pyramid level (scan axes binned too) and scaled to full-resolution sums.
+
+        When a summed-area table exists (SC_4D_ROI_SAT) the map takes a few
+        lookups per scan point instead; ROIs not aligned to its detector bins
+        only use it for level > 1. rows=(lo, hi) restricts a full-resolution
+        map to those x rows (see roi_sum_map_async()). Otherwise a full map is
+        kept per dataset, and the next one is derived from it by adding and
+        subtracting the strips that entered or left the box, when that reads
+        less than the new box (see roi_strip_deltas()).
+        """
+        x = slice(None) if rows is None else slice(*rows)
+        table = self.get_roi_sat(dataset_path)
+        if table is not None and len(ranges) == detector_axes(table.ndim):
+            aligned = all(int(lo) % ROI_SAT_FACTOR == 0 and int(hi) % ROI_SAT_FACTOR == 0 for lo, hi in ranges)
+            if (level > 1 and rows is None) or aligned:
+                return summed_area_sum(table[x], ranges, ROI_SAT_FACTOR)
+        if level > 1 and rows is None:
+            coarse = self.get_volume_level(dataset_path, level)
+            if coarse is not None:
+                n_scan = coarse.ndim - len(ranges)
+                bounds = (slice(None),) * n_scan + tuple(
+                    slice(int(lo) // level, max(-(-int(hi) // level), int(lo) // level + 1)) for lo, hi in ranges
+                )
+                axes = tuple(range(n_scan, coarse.ndim))
+                return np.sum(coarse[bounds], axis=axes, dtype=np.float64) * level ** len(ranges)
+        if rows is not None:
+            return self._reduce_roi(dataset_path, ranges, rows)
+        result = self._reduce_roi(dataset_path, ranges, plan=self._roi_update_plan(dataset_path, ranges))
+        self._last_roi[dataset_path] = (tuple(ranges), result)
+        return result
+
+    def _roi_update_plan(self, dataset_path, ranges):
+        """(last map, signed strips) updating the last full ROI map to ranges, or None when recomputing is cheaper."""
+        last = self._last_roi.get(dataset_path)
+        if last is None or self.get_roi_sat(dataset_path) is not None:
+            return None
+        old_ranges, base = last
+        volume = self.get_volume(dataset_path)
+        if len(old_ranges) != len(ranges) or volume is None or base.shape[0] != volume.shape[0]:
+            return None
+        strips = roi_strip_deltas(old_ranges, ranges)
+        strip_size = sum(int(np.prod([hi - lo for lo, hi in strip])) for _sign, strip in strips)
+        if strip_size >= int(np.prod([max(int(hi) - int(lo), 0) for lo, hi in ranges])):
+            return None
+        return base, strips
+
+    def _reduce_roi(self, dataset_path, ranges, rows=None, plan=None):
+        """Full-resolution ROI map over x rows (all if None), derived from plan=(base, strips) when given."""
+        x = slice(None) if rows is None else slice(*rows)
+        if plan is not None:
+            base, strips = plan
+            out = np.array(base[x], dtype=np.float64)
+            for sign, strip in strips:
+                if sign > 0:
+                    out += self._reduce_roi(dataset_path, strip, rows)
+                else:
+                    out -= self._reduce_roi(dataset_path, strip, rows)
+            return out
+        tiled = self.get_tiled_volume(dataset_path)
+        volume = tiled if tiled is not None else self.get_volume(dataset_path)
+        n_scan = len(volume.shape) - len(ranges)
+        bounds = (x,) + (slice(None),) * (n_scan - 1) + tuple(slice(int(lo), int(hi)) for lo, hi in ranges)
+        axes = tuple(range(n_scan, len(volume.shape)))
+        if tiled is not None:
+            return tiled.reduce_sum(bounds, axes)
+        return np.sum(volume[bounds], axis=axes, dtype=np.float64)
+
+    def roi_sum_map_async(self, dataset_path, ranges, on_done, on_progress=None, doc=None, on_error=None):
+        """
+        Compute roi_sum_map() in x-slabs on the shared thread pool, see ROIReductionEngine.
+
+        A new call (e.g. the Plot2 box moved again) cancels the previous one.
+        Pass the session's doc so on_done/on_progress/on_error run as
+        next-tick callbacks that may update Bokeh models. Returns the ReductionJob.
+        """
+        engine = self._get_roi_engine(doc)
+        volume = self.get_volume(dataset_path)
+        plan = self._roi_update_plan(dataset_path, ranges)
+
+        def _reduce_rows(lo, hi):
+            if plan is not None:
+                return self._reduce_roi(dataset_path, ranges, (lo, hi), plan)
+            return self.roi_sum_map(dataset_path, ranges, rows=(lo, hi))
+
+        def _done(result):
+            self._last_roi[dataset_path] = (tuple(ranges), result)
+            on_done(result)
+
+        return engine.submit(volume.shape[0], self._reduce_slab_rows(volume), _reduce_rows, _done, on_progress,
+                             on_error)
+
+    def _get_roi_engine(self, doc, purpose='plot3'):
+        """One engine per purpose, so e.g. an ROI set computation is not cancelled by Plot3 updates."""
+        engine = self._roi_engines.get(purpose)
+        if engine is None or engine.doc is not doc:
+            if engine is not None:
+                engine.cancel()
+            engine = self._roi_engines[purpose] = ROIReductionEngine(get_shared_reduction_pool(), doc)
+        return engine
+
+    @staticmethod
+    def _reduce_slab_rows(volume):
+        row_bytes = int(np.prod(volume.shape[1:], dtype=np.int64)) * 4
+        return max(1, REDUCE_SLAB_BYTES // max(row_bytes, 1))
+
+    def _roi_statistics_key(self, dataset_path, ranges):
+        return self._dataset_cache_key(('roi-stats', dataset_path, tuple((int(lo), int(hi)) for lo, hi in ranges)))
+
+    def _roi_statistics_rows(self, dataset_path, ranges, lo, hi):
+        n_scan = len(self.get_volume(dataset_path).shape) - len(ranges)
+        bounds = (slice(lo, hi),) + (slice(None),) * (n_scan - 1) + tuple(slice(int(a), int(b)) for a, b in ranges)
+        return roi_statistics(self.read_volume_region(dataset_path, *bounds), ranges)
+
+    def get_roi_statistics(self, dataset_path, ranges):
+        """
+        Every ROI_STATISTICS map of an ROI, stacked along the last axis.
+
+        They come from one pass over the volume's x-slabs and are cached per
+        ROI, so switching the Plot3 statistic is a view of the cached array.
+        """
+        def _compute():
+            volume = self.get_volume(dataset_path)
+            slab_rows = self._reduce_slab_rows(volume)
+            blocks = [
+                self._roi_statistics_rows(dataset_path, ranges, lo, min(lo + slab_rows, volume.shape[0]))
+                for lo in range(0, volume.shape[0], slab_rows)
+            ]
+            return np.concatenate(blocks or [self._roi_statistics_rows(dataset_path, ranges, 0, 0)])
+
+        return self._dataset_cache.get_or_load(self._roi_statistics_key(dataset_path, ranges), _compute,
+                                               self._source_fingerprint())
+
+    def get_roi_statistic(self, dataset_path, ranges, statistic='sum'):
+        """One ROI_STATISTICS map of an ROI (see get_roi_statistics())."""
+        return self.get_roi_statistics(dataset_path, ranges)[..., ROI_STATISTICS.index(statistic)]
+
+    def roi_statistics_async(self, dataset_path, ranges, on_done, on_progress=None, doc=None, on_error=None):
+        """
+        get_roi_statistics() on the ROI reduction engine (see roi_sum_map_async()).
+
+        An ROI already cached is handed to on_done right away; returns the
+        ReductionJob, or None in that case.
+        """
+        engine = self._get_roi_engine(doc)
+        key = self._roi_statistics_key(dataset_path, ranges)
+        fingerprint = self._source_fingerprint()
+        cached = self._dataset_cache.peek(key, fingerprint)
+        if cached is not None:
+            engine.cancel()
+            engine._dispatch(lambda: on_done(cached))
+            return None
+
+        def _done(result):
+            on_done(self._dataset_cache.put(key, result, fingerprint))
+
+        volume = self.get_volume(dataset_path)
+        return engine.submit(
+            volume.shape[0], self._reduce_slab_rows(volume),
+            lambda lo, hi: self._roi_statistics_rows(dataset_path, ranges, lo, hi),
+            _done, on_progress, on_error,
+        )
+
+    def set_roi_set(self, rois):
+        """Replace the ROI set (see normalize_roi_set()) computed by get_roi_set_maps()."""
+        self.roi_set = normalize_roi_set(rois)
+        return self.roi_set
+
+    def roi_set_metadata(self):
+        """Session metadata entries of the ROI set, restored by on_load_session()."""
+        return {'roi_set': [dict(roi) for roi in self.roi_set]}
+
+    def _roi_set_rows(self, dataset_path, roi_set, lo, hi):
+        """Sum maps of every ROI over x rows lo:hi, reading the ROIs' bounding box once."""
+        volume = self.get_volume(dataset_path)
+        n_det = detector_axes(len(volume.shape))
+        if any(len(roi['ranges']) != n_det for roi in roi_set):
+            raise ValueError(f"{dataset_path} needs {n_det} (lo, hi) pair(s) per ROI")
+        origin = [min(roi['ranges'][axis][0] for roi in roi_set) for axis in range(n_det)]
+        end = [max(roi['ranges'][axis][1] for roi in roi_set) for axis in range(n_det)]
+        bounds = ((slice(lo, hi),) + (slice(None),) * (len(volume.shape) - n_det - 1)
+                  + tuple(slice(a, b) for a, b in zip(origin, end)))
+        return roi_set_sums(self.read_volume_region(dataset_path, *bounds), origin, roi_set)
+
+    def _roi_set_key(self, dataset_path, roi_set):
+        return self._dataset_cache_key(
+            ('roi-set', dataset_path, tuple(tuple(map(tuple, roi['ranges'])) for roi in roi_set))
+        )
+
+    def get_roi_set_maps(self, dataset_path, roi_set=None):
+        """
+        Plot3-style sum maps of every ROI of the set (default self.roi_set), as an (N, *scan) stack.
+
+        All maps come from one pass over the volume's x-slabs and are cached per ROI set.
+        """
+        roi_set = normalize_roi_set(roi_set) if roi_set is not None else self.roi_set
+
+        def _compute():
+            volume = self.get_volume(dataset_path)
+            slab_rows = self._reduce_slab_rows(volume)
+            blocks = [
+                self._roi_set_rows(dataset_path, roi_set, lo, min(lo + slab_rows, volume.shape[0]))
+                for lo in range(0, volume.shape[0], slab_rows)
+            ]
+            return np.concatenate(blocks or [self._roi_set_rows(dataset_path, roi_set, 0, 0)])
+
+        stack = self._dataset_cache.get_or_load(self._roi_set_key(dataset_path, roi_set), _compute,
+                                                self._source_fingerprint())
+        return np.moveaxis(stack, -1, 0)
+
+    def roi_set_maps_async(self, dataset_path, on_done, on_progress=None, roi_set=None, doc=None, on_error=None):
+        """
+        get_roi_set_maps() on its own ROI reduction engine; callbacks receive the (N, *scan) stack.
+
+        A set already cached is handed to on_done right away; returns the
+        ReductionJob, or None in that case.
+        """
+        roi_set = normalize_roi_set(roi_set) if roi_set is not None else self.roi_set
+        engine = self._get_roi_engine(doc, 'roi-set')
+        key = self._roi_set_key(dataset_path, roi_set)
+        fingerprint = self._source_fingerprint()
+        cached = self._dataset_cache.peek(key, fingerprint)
+        if cached is not None:
+            engine.cancel()
+            engine._dispatch(lambda: on_done(np.moveaxis(cached, -1, 0)))
+            return None
+
+        def _done(result):
+            on_done(np.moveaxis(self._dataset_cache.put(key, result, fingerprint), -1, 0))
+
+        def _progress(maps, fraction):
+            on_progress(np.moveaxis(maps, -1, 0), fraction)
+
+        volume = self.get_volume(dataset_path)
+        return engine.submit(
+            volume.shape[0], self._reduce_slab_rows(volume),
+            lambda lo, hi: self._roi_set_rows(dataset_path, roi_set, lo, hi),
+            _done, None if on_progress is None else _progress, on_error,
+        )
+
+    def get_detector_shape(self, dataset_path):
+        """Detector (trailing) shape of a volume: (z, u) for 4D, (z,) for 3D."""
+        shape = tuple(self.get_volume(dataset_path).shape)
+        return shape[len(shape) - detector_axes(len(shape)):]
+
+    def get_mask_weights(self, dataset_path, masks=None):
+        """MaskWeights of masks ({name: mask}, default self.detector_masks) on the volume's detector."""
+        masks = self.detector_masks if masks is None else masks
+        if not masks:
+            raise ValueError("No virtual detector masks defined")
+        return MaskWeights(masks, self.get_detector_shape(dataset_path))
+
+    def _mask_rows(self, dataset_path, weights, lo, hi):
+        """Maps of every mask over x rows lo:hi, reading the masks' detector window once."""
+        n_scan = len(self.get_volume(dataset_path).shape) - len(weights.window)
+        bounds = (slice(lo, hi),) + (slice(None),) * (n_scan - 1) + weights.window
+        return weights.apply(self.read_volume_region(dataset_path, *bounds))
+
+    def get_mask_maps(self, dataset_path, masks=None):
+        """
+        Virtual detector maps of every mask (default self.detector_masks), as an (N, *scan) stack.
+
+        One pass over the volume's x-slabs; each slab is a single product with
+        the mask weight matrix (see MaskWeights). Cached per mask set.
+        """
+        weights = masks if isinstance(masks, MaskWeights) else self.get_mask_weights(dataset_path, masks)
+
+        def _compute():
+            volume = self.get_volume(dataset_path)
+            slab_rows = self._reduce_slab_rows(volume)
+            blocks = [
+                self._mask_rows(dataset_path, weights, lo, min(lo + slab_rows, volume.shape[0]))
+                for lo in range(0, volume.shape[0], slab_rows)
+            ]
+            return np.concatenate(blocks or [self._mask_rows(dataset_path, weights, 0, 0)])
+
+        stack = self._dataset_cache.get_or_load(self._dataset_cache_key(('masks', dataset_path, weights.key)),
+                                                _compute, self._source_fingerprint())
+        return np.moveaxis(stack, -1, 0)
+
+    def mask_maps_async(self, dataset_path, on_done, on_progress=None, masks=None, doc=None, on_error=None):
+        """get_mask_maps() on its own ROI reduction engine (see roi_set_maps_async())."""
+        weights = masks if isinstance(masks, MaskWeights) else self.get_mask_weights(dataset_path, masks)
+        engine = self._get_roi_engine(doc, 'masks')
+        key = self._dataset_cache_key(('masks', dataset_path, weights.key))
+        fingerprint = self._source_fingerprint()
+        cached = self._dataset_cache.peek(key, fingerprint)
+        if cached is not None:
+            engine.cancel()
+            engine._dispatch(lambda: on_done(np.moveaxis(cached, -1, 0)))
+            return None
+
+        def _done(result):
+            on_done(np.moveaxis(self._dataset_cache.put(key, result, fingerprint), -1, 0))
+
+        def _progress(maps, fraction):
+            on_progress(np.moveaxis(maps, -1, 0), fraction)
+
+        volume = self.get_volume(dataset_path)
+        return engine.submit(
+            volume.shape[0], self._reduce_slab_rows(volume),
+            lambda lo, hi: self._mask_rows(dataset_path, weights, lo, hi),
+            _done, None if on_progress is None else _progress, on_error,
+        )
+
+    def get_detector_geometry(self):
+        """Detector geometry read from the NeXus instrument fields (possibly incomplete, see read_detector_geometry())."""
+        def _read():
+            try:
+                return read_detector_geometry(self._opt_nexus_filename, live=self._live)
+            except (OSError, KeyError, ValueError) as e:
+                print(f"⚠️ Could not read the detector geometry: {e}")
+                return {}
+
+        return self._shared('/', 'geometry', _read)
+
+    def get_azimuthal_integrator(self, dataset_path, geometry=None, n_q=AZIMUTHAL_Q_BINS, n_chi=AZIMUTHAL_CHI_BINS,
+                                 mask=None, q_range=None):
+        """AzimuthalIntegrator for the detector of a 4D volume (geometry defaults to the file's)."""
+        geometry = dict(self.get_detector_geometry(), **(geometry or {}))
+        missing = [k for k in ('center', 'distance', 'pixel_size', 'wavelength') if k not in geometry]
+        if missing:
+            raise ValueError(f"Detector geometry is missing {', '.join(missing)}")
+        return AzimuthalIntegrator(self.get_detector_shape(dataset_path), geometry, n_q=n_q, n_chi=n_chi,
+                                   mask=mask, q_range=q_range)
+
+    def get_integrated_filename(self, dataset_path, integrator):
+        """Return the memmap filename of a volume integrated by integrator."""
+        flat = self.get_volume_cache_filename(dataset_path)
+        base = flat[:-len('.float32.dat')] if flat.endswith('.float32.dat') else flat
+        return f"{base}.azint-{integrator.key[:12]}.float32.dat"
+
+    def get_integration_fingerprint(self, dataset_path, integrator_key):
+        """Fingerprint of an integrated volume: the source fingerprint plus the integrator it was built with."""
+        fingerprint = self.get_fingerprint(dataset_path, 'azimuthal')
+        fingerprint['integrator'] = integrator_key
+        return fingerprint
+
+    @staticmethod
+    def integrated_dataset_path(dataset_path, integrator_key, n_chi=1):
+        """Name under which an integrated volume is listed, e.g. 'entry/data/data@I(q)-1a2b3c4d'."""
+        return f"{dataset_path.strip('/')}{INTEGRATED_DATASET_MARKER}{',chi' if n_chi > 1 else ''})-{integrator_key[:8]}"
+
+    def get_integrated_datasets(self, refresh=False):
+        """
+        Integrated volumes built from this file's 4D datasets, {path: description}.
+
+        Found on disk from their metadata sidecars, so integrations computed by
+        any session are listed; stale ones (source rewritten) are skipped.
+        """
+        if self._integrated is not None and not refresh:
+            return self._integrated
+        integrated = {}
+        for entry in self.get_datasets_by_dimension(4) if getattr(self, 'choices_done', False) else []:
+            source = entry['path']
+            if INTEGRATED_DATASET_MARKER in source:
+                continue
+            flat = self.get_volume_cache_filename(source)
+            base = flat[:-len('.float32.dat')] if flat.endswith('.float32.dat') else flat
+            for filename in sorted(glob.glob(glob.escape(base) + '.azint-' + '[0-9a-f]' * 12 + '.float32.dat')):
+                try:
+                    with open(f"{filename}.meta.json", 'r') as fp:
+                        key = json.load(fp).get('integrator', '')
+                    with open(f"{filename}.json", 'r') as fp:
+                        metadata = json.load(fp)
+                except (OSError, ValueError):
+                    continue
+                if not fingerprint_matches(filename, self.get_integration_fingerprint(source, key)):
+                    continue
+                touch_artifact(filename)
+                n_chi = len(metadata['chi']) if metadata.get('chi') else 1
+                bin_shape = [len(metadata['q'])] if n_chi == 1 else [n_chi, len(metadata['q'])]
+                integrated[self.integrated_dataset_path(source, key, n_chi)] = {
+                    'source': source, 'filename': filename, 'key': key,
+                    'shape': list(entry['shape'][:-2]) + bin_shape,
+                    'q': metadata['q'], 'chi': metadata.get('chi'), 'geometry': metadata.get('geometry'),
+                }
+        self._integrated = integrated
+        return integrated
+
+    def get_integrated_axis(self, dataset_path):
+        """Bin centres of an integrated volume's '<path>/q' or '<path>/chi' axis, or None."""
+        parent, _, axis = dataset_path.strip('/').rpartition('/')
+        if INTEGRATED_DATASET_MARKER not in parent or axis not in ('q', 'chi'):
+            return None
+        integrated = self.get_integrated_datasets().get(parent)
+        if integrated is None or integrated[axis] is None:
+            return None
+        return np.asarray(integrated[axis], dtype=np.float32)
+
+    def integrate_volume(self, dataset_path, integrator, background=True, on_complete=None):
+        """
+        Integrate every frame of a 4D volume into a derived I(q) / I(chi, q) volume.
+
+        The result is a float32 memmap next to the volume caches, listed by
+        get_choices() as integrated_dataset_path() and served by get_volume().
+        on_complete(path) is called with that path once it is written.
+        """
+        filename = self.get_integrated_filename(dataset_path, integrator)
+        fingerprint = self.get_integration_fingerprint(dataset_path, integrator.key)
+        derived_path = self.integrated_dataset_path(dataset_path, integrator.key, integrator.n_chi)
+
+        def _build():
+            t0 = time.time()
+            try:
+                if not fingerprint_matches(filename, fingerprint):
+                    build_integrated_volume(self.get_volume(dataset_path), integrator, filename,
+                                            status_callback=self._opt_status_callback)
+                    write_fingerprint(filename, fingerprint)
+                self._integrated = None
+                self._opt_status_callback(f"✅ Integrated volume {derived_path} ready ({time.time() - t0:.1f}s)")
+                if on_complete is not None:
+                    on_complete(derived_path)
+            except Exception as e:
+                self._opt_status_callback(f"❌ Azimuthal integration of {dataset_path} failed: {e}")
+
+        if not background:
+            _build()
+            return None
+
+        def _start():
+            thread = threading.Thread(target=_build, name=f"azimuthal:{dataset_path}", daemon=True)
+            thread.start()
+            return thread
+
+        return self._shared(dataset_path, f'build/azint-{integrator.key}', _start, valid=lambda t: t.is_alive())
+
+    @staticmethod
+    def decomposition_dataset_path(dataset_path, method, n_components):
+        """Group under which a decomposition's datasets are listed, e.g. 'entry/data/data@pca8'."""
+        return f"{dataset_path.strip('/')}@{method}{n_components}"
+
+    def _run_analysis(self, job_attr, root, key, parts, compute, on_done, on_update, doc, **fields):
+        """
+        Run compute(cancelled, on_update) in a background thread as the session's job_attr job.
+
+        The previous job in that slot is cancelled. The result's parts are
+        kept in the dataset cache under key; a cached result (parts plus
+        fields) is reused without recomputing. The result is listed under
+        root (see get_decomposition_dataset()). Callbacks go through
+        doc.add_next_tick_callback when a doc is given.
+        """
+        if getattr(self, job_attr) is not None:
+            getattr(self, job_attr).cancel()
+        job = DecompositionJob()
+        setattr(self, job_attr, job)
+
+        def _dispatch(callback):
+            if doc is None:
+                callback()
+            else:
+                doc.add_next_tick_callback(lambda: None if job.cancelled.is_set() else callback())
+
+        def _finish(result):
+            self.decompositions[root] = result
+            self._add_decomposition_choices(root, result)
+            job.result = result
+            job.finished.set()
+            _dispatch(lambda: on_done(result))
+
+        fingerprint = self._source_fingerprint()
+        cached = {part: self._dataset_cache.peek(key + (part,), fingerprint) for part in parts}
+        if all(value is not None for value in cached.values()):
+            _finish(dict(cached, **fields))
+            return job
+
+        def _update(result):
+            job.result = result
+            if on_update is not None:
+                _dispatch(lambda: on_update(result))
+
+        def _run():
+            t0 = time.time()
+            try:
+                result = compute(job.cancelled, _update)
+            except Exception as e:
+                job.error = e
+                job.finished.set()
+                self._opt_status_callback(f"❌ {root} failed: {e}")
+                return
+            if result is None:
+                job.finished.set()
+                return
+            for part in parts:
+                result[part] = self._dataset_cache.put(key + (part,), result[part], fingerprint)
+            self._opt_status_callback(f"✅ {root} ready ({time.time() - t0:.1f}s)")
+            _finish(result)
+
+        threading.Thread(target=_run, name=f"analysis:{root}", daemon=True).start()
+        return job
+
+    def decompose(self, dataset_path, on_done, method='pca', n_components=DECOMPOSITION_COMPONENTS, passes=None,
+                  level=1, on_update=None, doc=None):
+        """
+        Decompose the probe spectra of a 3D/4D volume (streaming_pca() or streaming_nmf()) in the background.
+
+        level > 1 decomposes a pyramid level instead of the full volume. The
+        estimate after every pass goes to on_update(result) and the final one
+        to on_done(result), through doc.add_next_tick_callback when a doc is
+        given. A new decomposition cancels the one in flight. Finished results
+        are kept in the dataset cache and listed as decomposition_dataset_path()
+        '/loading_<i>' and '/component_<i>' datasets. Returns the DecompositionJob.
+        """
+        if method not in DECOMPOSITION_METHODS:
+            raise ValueError(f"Unknown decomposition {method}, expected one of {', '.join(DECOMPOSITION_METHODS)}")
+        passes = passes or (PCA_PASSES if method == 'pca' else NMF_PASSES)
+        volume = self.get_volume_level(dataset_path, level)
+        if volume is None:
+            raise ValueError(f"{dataset_path} has no {'volume' if level == 1 else f'{level}x pyramid level'} yet")
+        decompose = streaming_pca if method == 'pca' else streaming_nmf
+        parts = ('components', 'loadings', 'weights') + (('explained',) if method == 'pca' else ())
+        return self._run_analysis(
+            '_decomposition_job', self.decomposition_dataset_path(dataset_path, method, n_components),
+            self._dataset_cache_key(('decomposition', dataset_path, method, n_components, level, passes)), parts,
+            lambda cancelled, update: decompose(volume, n_components=n_components, passes=passes,
+                                                slab_rows=self._reduce_slab_rows(volume), cancelled=cancelled,
+                                                on_update=update),
+            on_done, on_update, doc, method=method, passes=passes,
+        )
+
+    def cluster(self, dataset_path, on_done, n_clusters=CLUSTER_COUNT, level=None, refine_passes=CLUSTER_REFINE_PASSES,
+                normalize=True, on_update=None, doc=None):
+        """
+        Cluster the scan points of a 3D/4D volume by their probes (cluster_scan_points()) in the background.
+
+        The coarse fit uses pyramid level (default: the interactive level,
+        see get_interactive_level()); on_update(result) gets its cluster map
+        within seconds, on_done(result) the refined full-resolution one. A new
+        clustering cancels the one in flight. Results are listed as
+        '<volume>@kmeans<k>/labels' and '/mean_<i>' (cluster-mean probes).
+        Returns the DecompositionJob.
+        """
+        volume = self.get_volume(dataset_path)
+        if volume is None:
+            raise ValueError(f"{dataset_path} is not a 3D/4D volume")
+        level = self.get_interactive_level(dataset_path) if level is None else level
+        coarse = self.get_volume_level(dataset_path, level) if level > 1 else None
+        if level > 1 and coarse is None:
+            raise ValueError(f"{dataset_path} has no {level}x pyramid level yet")
+        return self._run_analysis(
+            '_clustering_job', self.decomposition_dataset_path(dataset_path, 'kmeans', n_clusters),
+            self._dataset_cache_key(('clusters', dataset_path, n_clusters, level, normalize, refine_passes + 1)),
+            ('labels', 'means', 'counts'),
+            lambda cancelled, update: cluster_scan_points(
+                volume, n_clusters=n_clusters, coarse=coarse, factor=level, refine_passes=refine_passes,
+                normalize=normalize, slab_rows=self._reduce_slab_rows(volume), cancelled=cancelled, on_update=update),
+            on_done, on_update, doc, method='kmeans', passes=refine_passes + 1,
+        )
+
+    def _add_decomposition_choices(self, root, result):
+        """List a decomposition's (or clustering's) maps and per-component arrays with the file's datasets."""
+        if not getattr(self, 'choices_done', False):
+            return
+        for category, entries in self.dimensions_categories.items():
+            entries[:] = [e for e in entries if not e['path'].startswith(root + '/')]
+        if 'labels' in result:
+            shape = list(result['labels'].shape)
+            self.dimensions_categories[f'{len(shape)}d'].append({'path': f"{root}/labels", 'shape': shape, 'dtype': '<i4'})
+        for name, part in DERIVED_STACK_PARTS.items():
+            for i in range(len(result[part]) if part in result else 0):
+                shape = list(result[part].shape[1:])
+                self.dimensions_categories[f'{len(shape)}d'].append(
+                    {'path': f"{root}/{name}_{i + 1}", 'shape': shape, 'dtype': '<f4'})
+
+    def get_decomposition_dataset(self, dataset_path):
+        """
+        A dataset of a finished decomposition or clustering, or None.
+
+        '<root>/labels' is the cluster map; '<root>/<name>_<i>' the i-th
+        (1-based) entry of a DERIVED_STACK_PARTS stack, e.g. 'loading_1'.
+        """
+        root, _, name = dataset_path.strip('/').rpartition('/')
+        result = self.decompositions.get(root)
+        if result is None:
+            return None
+        if name == 'labels':
+            return result.get('labels')
+        kind, _, number = name.rpartition('_')
+        parts = result.get(DERIVED_STACK_PARTS.get(kind))
+        if parts is None or not number.isdigit() or not 0 < int(number) <= len(parts):
+            return None
+        return parts[int(number) - 1]
+
+    def load_dataset_by_path(self, dataset_path, *args, index=None, **kwargs):
+        """
+        Load a dataset, or dataset[index], through the process-wide LRU cache.
+
+        3D/4D volumes themselves come from get_volume(); their slices and every
+        other dataset (coordinates, presample maps, ...) are cached read-only,
+        keyed by dataset path and index, within SC_4D_DATASET_CACHE_MB.
+        """
+        if args or kwargs or not dataset_path:
+            return super().load_dataset_by_path(dataset_path, *args, **kwargs)
+        derived = self.get_integrated_axis(dataset_path)
+        if derived is None:
+            derived = self.get_decomposition_dataset(dataset_path)
+        if derived is not None:
+            return derived if index is None else derived[index]
+        volume = self.get_volume(dataset_path)
+        if volume is not None and index is None:
+            return volume
+
+        def _load():
+            if volume is not None:
+                return np.array(volume[index])
+            if index is None and not self._live:
+                return super(Process4dNexusOpt, self).load_dataset_by_path(dataset_path)
+            with open_nexus(self._opt_nexus_filename, live=self._live) as f:
+                return f[dataset_path][()] if index is None else bounded_read(f[dataset_path], index)
+
+        return self._dataset_cache.get_or_load(self._dataset_cache_key(dataset_path, index), _load,
+                                               fingerprint=self._source_fingerprint())
+
+    def _dataset_cache_key(self, dataset_path, index=None):
+        return (os.path.realpath(self._opt_nexus_filename), dataset_path, index_key(index))
+
+    def _source_fingerprint(self):
+        # A live file changes on every write; its cached maps are keyed by the rows received (see poll_live())
+        if self._live:
+            return ('live', self._live_rows_seen)
+        stat = os.stat(self._opt_nexus_filename)
+        fingerprint = (stat.st_size, stat.st_mtime_ns)
+        if self._seen_fingerprint is not None and fingerprint != self._seen_fingerprint:
+            # The file was rewritten: entries of the old version are never served again, free their budget now
+            self.invalidate_dataset_cache()
+        self._seen_fingerprint = fingerprint
+        return fingerprint
+
+    def prefetch_datasets(self, dataset_paths):
+        """
+        Read small (non-volume) datasets into the dataset cache in one background file open.
+
+        load_dataset_by_path() calls for these paths wait for the prefetch
+        instead of opening the file themselves. Returns the thread, or None
+        when there was nothing to read.
+        """
+        paths = []
+        for path in dict.fromkeys(p for p in dataset_paths if p):
+            entry = self.get_dataset_entry(path)
+            # Volumes go through get_volume(); non-numeric datasets keep the base-class loader
+            if entry is not None and len(entry['shape']) < 3 and np.dtype(entry['dtype']).kind in 'biuf':
+                paths.append(path)
+        keys = {self._dataset_cache_key(path): path for path in paths}
+        reserved = self._dataset_cache.reserve(list(keys))
+        if not reserved:
+            return None
+        fingerprint = self._source_fingerprint()
+
+        def _prefetch():
+            t0 = time.time()
+            try:
+                with open_nexus(self._opt_nexus_filename, live=self._live) as f:
+                    for key in reserved:
+                        try:
+                            self._dataset_cache.put(key, f[keys[key]][()], fingerprint)
+                        finally:
+                            self._dataset_cache.release(key)
+                print(f"✅ Prefetched {len(reserved)} datasets in {time.time() - t0:.2f}s")
+            except Exception as e:
+                print(f"⚠️ Dataset prefetch failed: {e}")
+            finally:
+                for key in reserved:
+                    self._dataset_cache.release(key)
+
+        thread = threading.Thread(target=_prefetch, name="dataset-prefetch", daemon=True)
+        thread.start()
+        return thread
+
+    def get_ratio_map(self, numerator_path, denominator_path):
+        """
+        Return (numerator / denominator, {percentile: value}) for the Plot1/Plot1B ratio modes.
+
+        Both are computed once per pair (see ratio_map() and RATIO_PERCENTILES)
+        and kept in the dataset cache, so mode toggles and session reloads reuse them.
+        """
+        fingerprint = self._source_fingerprint()
+        pair = (numerator_path, denominator_path)
+
+        def _ratio():
+            return ratio_map(self.load_dataset_by_path(numerator_path), self.load_dataset_by_path(denominator_path))
+
+        ratio = self._dataset_cache.get_or_load(self._dataset_cache_key(('ratio',) + pair), _ratio, fingerprint)
+        percentiles = self._dataset_cache.get_or_load(
+            self._dataset_cache_key(('ratio-percentiles',) + pair), lambda: nan_percentiles(ratio), fingerprint
+        )
+        return ratio, dict(zip(RATIO_PERCENTILES, percentiles.tolist()))
+
+    def get_picked_ratio_maps(self):
+        """Ratio maps of the picked Plot1 / Plot1B numerator-denominator pairs, keyed 'plot1' / 'plot1b'."""
+        maps = {}
+        for name, suffix in (('plot1', ''), ('plot1b', '_b')):
+            numerator = getattr(self, f'presample_picked{suffix}', None)
+            denominator = getattr(self, f'postsample_picked{suffix}', None)
+            if numerator and denominator:
+                maps[name] = self.get_ratio_map(numerator, denominator)
+        return maps
+
+    def precompute_picked_ratio_maps(self):
+        """Compute the picked ratio maps in a background thread (after a running prefetch of their inputs)."""
+
+        def _precompute():
+            try:
+                maps = self.get_picked_ratio_maps()
+                if maps:
+                    print(f"✅ Precomputed ratio maps: {', '.join(maps)}")
+            except Exception as e:
+                print(f"⚠️ Ratio map precompute failed: {e}")
+
+        thread = threading.Thread(target=_precompute, name="ratio-maps", daemon=True)
+        thread.start()
+        return thread
+
+    def prefetch_picked_datasets(self):
+        """Prefetch the coordinate and auxiliary datasets picked for the current plots."""
+        return self.prefetch_datasets(getattr(self, name, None) for name in PICKED_DATASET_ATTRIBUTES)
+
+    def is_open_elsewhere(self, released):
+        """False when release() (which returned released) dropped the last session browsing this file."""
+        return SharedVolumeRegistry.make_key(self._opt_nexus_filename, '/', 'index') not in released
+
+    def invalidate_dataset_cache(self, dataset_path=None):
+        """Drop cached datasets of this file (all, or one dataset_path), e.g. from a "clear cache" button."""
+        nexus = os.path.realpath(self._opt_nexus_filename)
+        # Derived entries (ratio maps, ...) are keyed by a tuple naming their source datasets
+        return self._dataset_cache.invalidate(
+            lambda key: key[0] == nexus and (dataset_path is None or key[1] == dataset_path
+                                             or (isinstance(key[1], tuple) and dataset_path in key[1]))
+        )
+
+    def get_dataset_cache_stats(self):
+        return self._dataset_cache.stats()
+
+    def load_nexus_data(self, *args, **kwargs):
+        result = super().load_nexus_data(*args, **kwargs)
+        volume = self.get_volume(getattr(self, 'volume_picked', None))
+        if volume is None:
+            return result
+        return (volume,) + tuple(result[1:])
+
+
+def switch_nexus_file(new_nexus_filename):
+    """Open another scan of the catalog in this session and show its dataset selection."""
+    global process_4dnexus, nexus_filename, mmap_filename
+    old = process_4dnexus
+    add_status_message(f"⏳ Opening {os.path.basename(new_nexus_filename)}...")
+    # Release by session id before the new file acquires its entries under the same id
+    released = old.release()
+    if not old.is_open_elsewhere(released):
+        old.invalidate_dataset_cache()
+    new = Process4dNexusOpt(
+        new_nexus_filename,
+        new_nexus_filename.replace('.nxs', '.float32.dat'),
+        cached_cast_float=True,
+        status_callback=add_status_message,
+        session_id=old._session_id,
+        live=LIVE_MODE
+    )
+    new.get_choices()
+    # Panel listeners (named) refresh the old file's widgets; the new dashboard subscribes its own
+    new._live_listeners = [listener for listener in old._live_listeners if listener.name is None]
+    process_4dnexus, nexus_filename, mmap_filename = new, new._opt_nexus_filename, new._opt_mmap_filename
+    curdoc().clear()
+    curdoc().add_root(create_tmp_dashboard(new))
+
+
 def create_tmp_dashboard(process_4dnexus):
     """Create initial dashboard with dataset selectors using SCLib UI components."""
     global status_messages
@@ -1193,6 +2845,32 @@ def create_tmp_dashboard(process_4dnexus):
     
     refresh_sessions_button.on_click(lambda: on_refresh_sessions())
     
+    # Scan picker over the catalog of the dataset directory (see load_nexus_catalog())
+    catalog_files = [entry for entry in (nexus_catalog or {}).get('files', []) if 'error' not in entry]
+    catalog_labels = {
+        describe_catalog_entry(entry, nexus_catalog.get('directory')): entry['path'] for entry in catalog_files
+    }
+    current_label = next((label for label, path in catalog_labels.items()
+                          if os.path.realpath(path) == os.path.realpath(process_4dnexus._opt_nexus_filename)), None)
+    nexus_file_select = create_select(
+        title="Scan File:",
+        value=current_label or "No other scan files",
+        options=list(catalog_labels) or ["No other scan files"],
+        width=350
+    )
+    nexus_file_select.visible = len(catalog_labels) > 1
+    
+    def on_nexus_file_change(attr, old, new):
+        path = catalog_labels.get(new)
+        if path and new != current_label:
+            try:
+                switch_nexus_file(path)
+            except Exception as e:
+                print(f"❌ Could not open {path}: {e}")
+                status_display.text = f"<span style='color: red;'>Could not open {path}: {e}</span>"
+    
+    nexus_file_select.on_change("value", on_nexus_file_change)
+    
     # Placeholder plots
     plot1_placeholder = create_div(
         text="<h3>Plot1: Select a 2D dataset above and click 'Initialize Plots'</h3>",
@@ -1392,6 +3070,12 @@ def create_tmp_dashboard(process_4dnexus):
             print(f"  probe_y_coords_picked_b: {process_4dnexus.probe_y_coords_picked_b}")
             print("=" * 80)
             
+            # Read the small picked datasets in the background while the volume is set up
+            process_4dnexus.prefetch_picked_datasets()
+            process_4dnexus.precompute_picked_ratio_maps()
+            # Start the volume cache build now; plots read finished slabs while it runs
+            process_4dnexus.get_volume(process_4dnexus.volume_picked)
+            
             # Build and swap to full dashboard
             from bokeh.io import curdoc as _curdoc
             loading = column(create_div(text="<h3>Loading full dashboard...</h3>"))
@@ -1547,6 +3231,13 @@ def create_tmp_dashboard(process_4dnexus):
                     process_4dnexus.probe_y_coords_picked_b = metadata["probe_y_coords_picked_b"]
                     print(f"✅ Restored probe_y_coords_picked_b: {metadata.get('probe_y_coords_picked_b')}")
                 
+                if metadata.get("roi_set"):
+                    try:
+                        process_4dnexus.set_roi_set(metadata["roi_set"])
+                        print(f"✅ Restored roi_set: {format_roi_set(process_4dnexus.roi_set)}")
+                    except (KeyError, TypeError, ValueError) as e:
+                        print(f"⚠️ Ignoring unreadable roi_set in session: {e}")
+                
                 # Restore plot1_mode and set plot1_is_1d BEFORE load_data() is called
                 # This is critical to prevent load_data() from setting a default y_coords when Plot1 is 1D
                 if "plot1_mode" in metadata:
@@ -1590,6 +3281,9 @@ def create_tmp_dashboard(process_4dnexus):
             # We'll pass this to the dashboard so it can load the session after creating the dashboard
             process_4dnexus._session_filepath_to_load = filepath
             
+            # Start the volume cache build now; plots read finished slabs while it runs
+            process_4dnexus.get_volume(getattr(process_4dnexus, 'volume_picked', None))
+            
             # Transition to real dashboard (similar to initialize_plots_callback)
             from bokeh.io import curdoc as _curdoc
             loading = column(create_div(text="<h3>Loading dashboard with session...</h3>"))
@@ -1720,6 +3414,10 @@ def create_tmp_dashboard(process_4dnexus):
         plot2b_selector.visible = new
         probe_x_selector_b.visible = new
         probe_y_selector_b.visible = new
+        if new and plot2b_selector.value and plot2b_selector.value != "No 3D/4D datasets":
+            process_4dnexus.preload_volume_b(extract_dataset_path(plot2b_selector.value))
+        elif not new:
+            process_4dnexus.cancel_volume_b_preload()
     
     enable_plot2b_toggle.on_change("active", on_enable_plot2b)
     
@@ -1838,6 +3536,8 @@ def create_tmp_dashboard(process_4dnexus):
         plot2b_path = extract_dataset_path(new)
         if plot2b_path == "No 3D/4D datasets":
             return
+        # Start loading the volume now instead of when the full dashboard is built
+        process_4dnexus.preload_volume_b(plot2b_path)
         plot2b_shape = extract_shape(new)
         if plot2b_shape:
             # Check if Plot1 is in 1D mode (Single Dataset 1D or Ratio 1D)
@@ -1993,6 +3693,7 @@ def create_tmp_dashboard(process_4dnexus):
     # Create column for Load Session and Initialize button
     actions_column = row(
         column(
+            nexus_file_select,
             create_label_div("Load Session:", width=300),
             load_session_select,
             row(refresh_sessions_button, load_session_button),
@@ -2043,6 +3744,577 @@ def create_tmp_dashboard(process_4dnexus):
     return column(css_style, main_layout)
 
 
+def create_map_stack_view(title):
+    """
+    Select + plot browsing a stack of scan maps (2D images or 1D lines).
+
+    Returns (select, plot, set_names, set_maps); set_maps takes the (N, *scan)
+    stack, or None while it is being computed.
+    """
+    select = create_select(title=f"{title}:", value="No maps", options=["No maps"], width=250)
+    color_mapper = LinearColorMapper(palette="Viridis256")
+    image_source = ColumnDataSource(data={'image': []})
+    line_source = ColumnDataSource(data={'x': [], 'y': []})
+    plot = figure(title=title, width=450, height=400)
+    image_renderer = plot.image(image='image', x=0, y=0, dw=1, dh=1, source=image_source, color_mapper=color_mapper)
+    line_renderer = plot.line(x='x', y='y', source=line_source)
+    plot.add_layout(ColorBar(color_mapper=color_mapper), 'right')
+    state = {'maps': None, 'names': []}
+    
+    def _show(name):
+        if state['maps'] is None or name not in state['names']:
+            return
+        data = np.asarray(state['maps'][state['names'].index(name)], dtype=np.float32)
+        finite = data[np.isfinite(data)]
+        if finite.size:
+            color_mapper.low, color_mapper.high = float(finite.min()), float(finite.max())
+        image_renderer.visible = data.ndim == 2
+        line_renderer.visible = data.ndim == 1
+        if data.ndim == 2:
+            # Bokeh image() takes (rows, cols) = (y, x)
+            image_renderer.glyph.dw, image_renderer.glyph.dh = data.shape
+            image_source.data = {'image': [data.T]}
+        else:
+            line_source.data = {'x': np.arange(len(data)), 'y': data}
+        plot.title.text = f"{title}: {name}"
+    
+    def set_names(names):
+        state['maps'], state['names'] = None, list(names)
+        select.options = state['names']
+        if select.value not in state['names']:
+            select.value = state['names'][0]
+    
+    def set_maps(maps):
+        state['maps'] = maps
+        _show(select.value)
+    
+    select.on_change("value", lambda attr, old, new: _show(new))
+    return select, plot, set_names, set_maps
+
+
+def create_live_map_panel(process_4dnexus):
+    """
+    Panel showing the picked Plot1 / Plot1B scan maps over the rows received so far in live mode.
+
+    Redrawn from poll_live() at most every LIVE_REFRESH_SECONDS; ratio maps
+    come from the cache poll_live() extends by the new rows.
+    """
+    message = create_div(text="⏳ Waiting for scan rows...", width=600)
+    map_select, map_plot, set_names, set_maps = create_map_stack_view("Live Scan Map")
+    
+    def _on_live_rows(lo, hi):
+        try:
+            ratios = process_4dnexus.get_picked_ratio_maps()
+            names, maps = [], []
+            for name, attribute in (('plot1', 'plot1_single_dataset_picked'), ('plot1b', 'plot1b_single_dataset_picked')):
+                if name in ratios:
+                    names.append(f"{name} ratio")
+                    maps.append(ratios[name][0])
+                elif getattr(process_4dnexus, attribute, None):
+                    names.append(name)
+                    maps.append(process_4dnexus.load_dataset_by_path(getattr(process_4dnexus, attribute)))
+        except Exception as e:
+            message.text = f"<span style='color: red;'>Live map refresh failed: {e}</span>"
+            return
+        if not names:
+            message.text = "<span style='color: orange;'>Pick a Plot1 map to follow it live</span>"
+            return
+        if names != list(map_select.options):
+            set_names(names)
+        set_maps(maps)
+        message.text = f"🔴 {hi} scan rows (+{hi - lo})"
+    
+    process_4dnexus.add_live_listener(_on_live_rows, min_interval=LIVE_REFRESH_SECONDS, name='live-map')
+    panel = column(
+        create_div(text="<h3 style='margin-top: 0; color: #5716e5;'>Live Scan Maps</h3>", width=600),
+        map_select,
+        message,
+        map_plot,
+    )
+    panel.css_classes = ["config-section"]
+    return panel
+
+
+def create_roi_panel(process_4dnexus):
+    """
+    Panel browsing the probes of the Plot2 volume and mapping a detector box (ROI) over the scan.
+
+    Dragging the scan sliders or the box renders from the interactive
+    pyramid level first (see get_interactive_level()) and at full
+    resolution once the user pauses (see InteractiveRefiner). The Plot2
+    volume must be 4D (see create_dashboard()).
+    """
+    dataset_path = process_4dnexus.volume_picked
+    shape = tuple(process_4dnexus.get_volume(dataset_path).shape)
+    message = create_div(text="Drag the scan sliders to browse probes; draw a box on the probe to map it", width=600)
+    x_slider = create_slider(title="Scan x", start=0, end=max(shape[0] - 1, 1), value=shape[0] // 2, step=1, width=250)
+    y_slider = create_slider(title="Scan y", start=0, end=max(shape[1] - 1, 1), value=shape[1] // 2, step=1, width=250)
+    
+    probe_mapper = LogColorMapper(palette="Viridis256")
+    probe_source = ColumnDataSource(data={'image': []})
+    box_source = ColumnDataSource(data={'x': [], 'y': [], 'width': [], 'height': []})
+    probe_plot = figure(title="Probe (z, u)", width=450, height=400)
+    probe_image = probe_plot.image(image='image', x=0, y=0, dw=1, dh=1, source=probe_source, color_mapper=probe_mapper)
+    boxes = probe_plot.rect(x='x', y='y', width='width', height='height', source=box_source,
+                            fill_alpha=0.1, line_color='red', line_width=2)
+    probe_plot.add_tools(BoxEditTool(renderers=[boxes], num_objects=1))
+    
+    map_mapper = LinearColorMapper(palette="Viridis256")
+    map_source = ColumnDataSource(data={'image': []})
+    map_plot = figure(title="ROI Map: sum", width=450, height=400)
+    map_image = map_plot.image(image='image', x=0, y=0, dw=1, dh=1, source=map_source, color_mapper=map_mapper)
+    map_plot.add_layout(ColorBar(color_mapper=map_mapper), 'right')
+    
+    # One refiner per view, so browsing probes does not cancel the refinement of the map
+    probe_refiner = InteractiveRefiner(curdoc())
+    map_refiner = InteractiveRefiner(curdoc())
+    
+    def _show(source, image, mapper, data, extent):
+        data = np.asarray(data, dtype=np.float32)
+        # Coarse pyramid levels are stretched over the full-resolution extent, so boxes keep their meaning
+        values = data[data > 0] if isinstance(mapper, LogColorMapper) else data[np.isfinite(data)]
+        if values.size:
+            mapper.low, mapper.high = float(values.min()), float(values.max())
+        image.glyph.dw, image.glyph.dh = extent
+        source.data = {'image': [data.T]}
+    
+    def _box_ranges():
+        if not box_source.data['x']:
+            return None
+        ranges = []
+        for center, size, n in ((box_source.data['x'][0], box_source.data['width'][0], shape[2]),
+                                (box_source.data['y'][0], box_source.data['height'][0], shape[3])):
+            lo = min(max(int(round(center - abs(size) / 2)), 0), n - 1)
+            ranges.append((lo, min(max(int(round(center + abs(size) / 2)), lo + 1), n)))
+        return tuple(ranges)
+    
+    def _on_slice(attr, old, new):
+        x_idx, y_idx = int(x_slider.value), int(y_slider.value)
+        probe_refiner.request(
+            lambda level: process_4dnexus.get_probe(dataset_path, x_idx, y_idx, level=level),
+            lambda probe: _show(probe_source, probe_image, probe_mapper, probe, shape[2:]),
+            coarse_level=process_4dnexus.get_interactive_level(dataset_path),
+        )
+    
+    def _on_box(attr, old, new):
+        ranges = _box_ranges()
+        if ranges is None:
+            return
+        message.text = f"ROI z {ranges[0][0]}:{ranges[0][1]}, u {ranges[1][0]}:{ranges[1][1]}"
+        statistic = state['statistic']
+        map_plot.title.text = f"ROI Map: {ROI_STATISTIC_LABELS[statistic]}"
+        
+        def _on_map(roi_map):
+            if state['statistic'] == statistic and _box_ranges() == ranges:
+                if statistic != 'sum':
+                    roi_map = roi_map[..., ROI_STATISTICS.index(statistic)]
+                _show(map_source, map_image, map_mapper, roi_map, shape[:2])
+        
+        def _on_error(error):
+            message.text = f"<span style='color: red;'>ROI map failed: {error}</span>"
+        
+        # Only the sum has pyramid levels; the full-resolution map is reduced on the engine once the box rests
+        level = process_4dnexus.get_interactive_level(dataset_path) if statistic == 'sum' else 1
+        if level > 1:
+            _on_map(process_4dnexus.roi_sum_map(dataset_path, ranges, level=level))
+        reduce = process_4dnexus.roi_sum_map_async if statistic == 'sum' else process_4dnexus.roi_statistics_async
+        map_refiner.defer(lambda: reduce(
+            dataset_path, ranges, _on_map, on_progress=lambda roi_map, fraction: _on_map(roi_map),
+            doc=curdoc(), on_error=_on_error,
+        ))
+    
+    def _on_statistic(statistic):
+        state['statistic'] = statistic
+        _on_box(None, None, None)
+    
+    state = {'statistic': 'sum'}
+    statistic_select = create_roi_statistic_select(_on_statistic, value=state['statistic'])
+    
+    x_slider.on_change("value", _on_slice)
+    y_slider.on_change("value", _on_slice)
+    box_source.on_change("data", _on_box)
+    _on_slice(None, None, None)
+    
+    panel = column(
+        create_div(text="<h3 style='margin-top: 0; color: #5716e5;'>Probe and ROI Map</h3>", width=600),
+        row(x_slider, y_slider, statistic_select),
+        message,
+        row(probe_plot, map_plot),
+    )
+    panel.css_classes = ["config-section"]
+    return panel
+
+
+def create_roi_set_panel(process_4dnexus):
+    """
+    Panel defining several (z, u) boxes and showing their maps, computed in one pass over the Plot2 volume.
+
+    The boxes are kept in process_4dnexus.roi_set (saved with the session,
+    see roi_set_metadata()); the resulting maps are browsed as a stack.
+    """
+    roi_input = create_text_input(
+        title="ROI Set (name: z_lo z_hi u_lo u_hi; ...):",
+        value=format_roi_set(process_4dnexus.roi_set),
+        width=600
+    )
+    compute_button = create_button(label="Compute ROI Maps", button_type="success", width=200)
+    message = create_div(text="", width=600)
+    roi_select, stack_plot, set_names, set_maps = create_map_stack_view("ROI Map")
+    
+    def _on_progress(maps, fraction):
+        message.text = f"⏳ Computing ROI maps: {fraction:.0%}"
+        set_maps(maps)
+    
+    def _on_done(maps):
+        message.text = f"✅ {len(maps)} ROI maps ready"
+        set_maps(maps)
+    
+    def _on_error(error):
+        message.text = f"<span style='color: red;'>ROI maps failed: {error}</span>"
+    
+    def _on_compute():
+        try:
+            roi_set = process_4dnexus.set_roi_set(parse_roi_set(roi_input.value))
+        except ValueError as e:
+            message.text = f"<span style='color: red;'>{e}</span>"
+            return
+        dataset_path = getattr(process_4dnexus, 'volume_picked', None)
+        if not dataset_path or not roi_set:
+            message.text = "<span style='color: orange;'>Pick a Plot2 volume and enter at least one ROI</span>"
+            return
+        set_names(roi['name'] for roi in roi_set)
+        message.text = "⏳ Computing ROI maps..."
+        try:
+            process_4dnexus.roi_set_maps_async(dataset_path, _on_done, on_progress=_on_progress, doc=curdoc(),
+                                               on_error=_on_error)
+        except ValueError as e:
+            message.text = f"<span style='color: red;'>{e}</span>"
+            return
+        computed[0] = True
+    
+    def _on_live_rows(lo, hi):
+        # Maps are cached per received row count, so this reduces the volume as it stands now
+        if computed[0]:
+            _on_compute()
+    
+    computed = [False]
+    compute_button.on_click(_on_compute)
+    process_4dnexus.add_live_listener(_on_live_rows, min_interval=LIVE_REFRESH_SECONDS, name='roi-set')
+    
+    panel = column(
+        create_div(text="<h3 style='margin-top: 0; color: #5716e5;'>ROI Set Maps</h3>", width=600),
+        row(roi_input, compute_button),
+        roi_select,
+        message,
+        stack_plot,
+    )
+    panel.css_classes = ["config-section"]
+    return panel
+
+
+def create_mask_panel(process_4dnexus):
+    """
+    Panel defining virtual detector masks (annulus, polygon, brush, file) and showing their maps.
+
+    Brush masks use the strokes drawn with the freehand tool on the detector
+    image (the probe at the center of the scan, shown by "Show Detector").
+    """
+    mask_input = create_text_input(
+        title=("Masks (name: annulus cz cu r_in r_out | polygon z1 u1 z2 u2 ... | brush radius"
+               " | file path[::dataset] (next to the scan); ...):"),
+        value="",
+        width=600
+    )
+    show_button = create_button(label="Show Detector", button_type="default", width=150)
+    compute_button = create_button(label="Compute Mask Maps", button_type="success", width=200)
+    message = create_div(text="", width=600)
+    mask_select, stack_plot, set_names, set_maps = create_map_stack_view("Mask Map")
+    
+    detector_mapper = LogColorMapper(palette="Greys256")
+    detector_source = ColumnDataSource(data={'image': []})
+    stroke_source = ColumnDataSource(data={'xs': [], 'ys': []})
+    detector_plot = figure(title="Detector (z, u)", width=450, height=400)
+    detector_image = detector_plot.image(image='image', x=0, y=0, dw=1, dh=1, source=detector_source,
+                                         color_mapper=detector_mapper)
+    strokes = detector_plot.multi_line(xs='xs', ys='ys', source=stroke_source, line_color='red', line_width=2)
+    detector_plot.add_tools(FreehandDrawTool(renderers=[strokes]))
+    
+    def _on_show():
+        dataset_path = getattr(process_4dnexus, 'volume_picked', None)
+        if not dataset_path:
+            message.text = "<span style='color: orange;'>Pick a Plot2 volume first</span>"
+            return
+        volume = process_4dnexus.get_volume(dataset_path)
+        if len(volume.shape) != 4:
+            message.text = "<span style='color: orange;'>Drawn masks need a 4D volume; use file masks</span>"
+            return
+        probe = np.asarray(process_4dnexus.get_probe(dataset_path, volume.shape[0] // 2, volume.shape[1] // 2),
+                           dtype=np.float32)
+        positive = probe[probe > 0]
+        if positive.size:
+            detector_mapper.low, detector_mapper.high = float(positive.min()), float(positive.max())
+        detector_image.glyph.dw, detector_image.glyph.dh = probe.shape
+        detector_source.data = {'image': [probe.T]}
+    
+    def _on_progress(maps, fraction):
+        message.text = f"⏳ Computing mask maps: {fraction:.0%}"
+        set_maps(maps)
+    
+    def _on_done(maps):
+        message.text = f"✅ {len(maps)} mask maps ready"
+        set_maps(maps)
+    
+    def _on_error(error):
+        message.text = f"<span style='color: red;'>Mask maps failed: {error}</span>"
+    
+    def _on_compute():
+        dataset_path = getattr(process_4dnexus, 'volume_picked', None)
+        if not dataset_path:
+            message.text = "<span style='color: orange;'>Pick a Plot2 volume first</span>"
+            return
+        drawn = [list(zip(xs, ys)) for xs, ys in zip(stroke_source.data['xs'], stroke_source.data['ys'])]
+        try:
+            # Mask files are only read from the scan's directory or the user's upload directory
+            mask_dirs = [os.path.dirname(os.path.abspath(process_4dnexus._opt_nexus_filename)), base_dir]
+            masks = parse_mask_set(mask_input.value, process_4dnexus.get_detector_shape(dataset_path), drawn,
+                                   mask_dirs=mask_dirs)
+            weights = process_4dnexus.get_mask_weights(dataset_path, masks)
+        except ValueError as e:
+            message.text = f"<span style='color: red;'>{e}</span>"
+            return
+        process_4dnexus.detector_masks = masks
+        set_names(weights.names)
+        message.text = "⏳ Computing mask maps..."
+        process_4dnexus.mask_maps_async(dataset_path, _on_done, on_progress=_on_progress, masks=weights, doc=curdoc(),
+                                        on_error=_on_error)
+        computed[0] = True
+    
+    def _on_live_rows(lo, hi):
+        if computed[0]:
+            _on_compute()
+    
+    computed = [False]
+    show_button.on_click(_on_show)
+    compute_button.on_click(_on_compute)
+    process_4dnexus.add_live_listener(_on_live_rows, min_interval=LIVE_REFRESH_SECONDS, name='masks')
+    
+    panel = column(
+        create_div(text="<h3 style='margin-top: 0; color: #5716e5;'>Virtual Detector Masks</h3>", width=600),
+        mask_input,
+        row(show_button, compute_button),
+        message,
+        row(detector_plot, column(mask_select, stack_plot)),
+    )
+    panel.css_classes = ["config-section"]
+    return panel
+
+
+def create_integration_panel(process_4dnexus):
+    """
+    Panel integrating the Plot2 volume azimuthally into a derived I(q) or I(chi, q) volume.
+
+    The geometry is prefilled from the NeXus instrument fields when present.
+    The result is listed with the file's volumes (Plot2/Plot3 selectors) the
+    next time they are populated; its scan-averaged profile is shown here.
+    """
+    doc = curdoc()
+    geometry_input = create_text_input(
+        title="Geometry (center_z center_u [px] distance [mm] pixel [µm] energy [keV]):",
+        value=format_detector_geometry(process_4dnexus.get_detector_geometry()),
+        width=450
+    )
+    q_bins_input = create_text_input(title="q bins:", value=str(AZIMUTHAL_Q_BINS), width=100)
+    chi_bins_input = create_text_input(title="chi bins (1 = I(q)):", value=str(AZIMUTHAL_CHI_BINS), width=120)
+    integrate_button = create_button(label="Integrate Volume", button_type="success", width=200)
+    message = create_div(text="", width=600)
+    profile_source = ColumnDataSource(data={'q': [], 'intensity': []})
+    profile_plot = figure(title="Mean I(q) over the scan", width=600, height=300,
+                          x_axis_label="q (1/Å)", y_axis_label="I")
+    profile_plot.line('q', 'intensity', source=profile_source, line_width=2)
+    
+    def _show_profile(derived_path):
+        volume = process_4dnexus.get_volume(derived_path)
+        if volume is None:
+            message.text = f"<span style='color: red;'>{derived_path} could not be opened</span>"
+            return
+        integrated = process_4dnexus.get_integrated_datasets()[derived_path]
+        profile = integrated_profile(volume, 1 if integrated['chi'] is None else 2)
+        profile_source.data = {'q': integrated['q'], 'intensity': profile.tolist()}
+        message.text = f"✅ {derived_path} {list(volume.shape)} ready; pick it as a Plot2/Plot3 volume"
+    
+    def _on_integrate():
+        dataset_path = getattr(process_4dnexus, 'volume_picked', None)
+        if not dataset_path:
+            message.text = "<span style='color: orange;'>Pick a Plot2 volume first</span>"
+            return
+        try:
+            integrator = process_4dnexus.get_azimuthal_integrator(
+                dataset_path,
+                geometry=parse_detector_geometry(geometry_input.value),
+                n_q=int(q_bins_input.value),
+                n_chi=int(chi_bins_input.value),
+            )
+        except ValueError as e:
+            message.text = f"<span style='color: red;'>{e}</span>"
+            return
+        message.text = f"⏳ Integrating {dataset_path} into {integrator.n_q} q bins..."
+        process_4dnexus.integrate_volume(
+            dataset_path, integrator,
+            on_complete=lambda derived_path: doc.add_next_tick_callback(lambda: _show_profile(derived_path)),
+        )
+    
+    integrate_button.on_click(_on_integrate)
+    
+    panel = column(
+        create_div(text="<h3 style='margin-top: 0; color: #5716e5;'>Azimuthal Integration</h3>", width=600),
+        row(geometry_input, q_bins_input, chi_bins_input),
+        integrate_button,
+        message,
+        profile_plot,
+    )
+    panel.css_classes = ["config-section"]
+    return panel
+
+
+def create_decomposition_panel(process_4dnexus):
+    """
+    Panel running a streaming PCA / NMF of the Plot2 volume's probe spectra.
+
+    Loading maps and components are refined after every pass and browsed as
+    stacks; finished ones are also listed as '<volume>@<method><k>/...'
+    datasets (see Process4dNexusOpt.decompose()).
+    """
+    method_select = create_select(title="Decomposition:", value="pca", options=list(DECOMPOSITION_METHODS), width=120)
+    components_input = create_text_input(title="Components:", value=str(DECOMPOSITION_COMPONENTS), width=100)
+    passes_input = create_text_input(title="Passes (empty = default):", value="", width=150)
+    level_select = create_select(title="Pyramid level:", value="1",
+                                 options=[str(f) for f in (1,) + PYRAMID_FACTORS], width=120)
+    run_button = create_button(label="Decompose", button_type="success", width=150)
+    cancel_button = create_button(label="Cancel", button_type="warning", width=100)
+    message = create_div(text="", width=600)
+    loading_select, loading_plot, set_loading_names, set_loadings = create_map_stack_view("Loading Map")
+    component_select, component_plot, set_component_names, set_components = create_map_stack_view("Component")
+    state = {'job': None}
+    
+    def _show(result, final):
+        if 'explained' in result:
+            summary = "explained variance " + ", ".join(f"{e:.1%}" for e in result['explained'])
+        else:
+            summary = "weights " + ", ".join(f"{w:.3g}" for w in result['weights'])
+        message.text = f"{'✅' if final else '⏳'} {result['method'].upper()} after {result['passes']} passes ({summary})"
+        set_loadings(result['loadings'])
+        set_components(result['components'])
+    
+    def _on_run():
+        dataset_path = getattr(process_4dnexus, 'volume_picked', None)
+        if not dataset_path:
+            message.text = "<span style='color: orange;'>Pick a Plot2 volume first</span>"
+            return
+        try:
+            n_components = int(components_input.value)
+            passes = int(passes_input.value) if passes_input.value.strip() else None
+            if n_components < 1 or (passes is not None and passes < 1):
+                raise ValueError("Components and passes must be positive")
+            names = [f"{method_select.value.upper()} {i + 1}" for i in range(n_components)]
+            set_loading_names(names)
+            set_component_names(names)
+            message.text = f"⏳ Running {method_select.value.upper()} on {dataset_path}..."
+            state['job'] = process_4dnexus.decompose(
+                dataset_path, lambda result: _show(result, True), method=method_select.value,
+                n_components=n_components, passes=passes, level=int(level_select.value),
+                on_update=lambda result: _show(result, False), doc=curdoc(),
+            )
+        except ValueError as e:
+            message.text = f"<span style='color: red;'>{e}</span>"
+    
+    def _on_cancel():
+        if state['job'] is not None and not state['job'].finished.is_set():
+            state['job'].cancel()
+            message.text = "Decomposition cancelled"
+    
+    run_button.on_click(_on_run)
+    cancel_button.on_click(_on_cancel)
+    
+    panel = column(
+        create_div(text="<h3 style='margin-top: 0; color: #5716e5;'>PCA / NMF Decomposition</h3>", width=600),
+        row(method_select, components_input, passes_input, level_select),
+        row(run_button, cancel_button),
+        message,
+        row(column(loading_select, loading_plot), column(component_select, component_plot)),
+    )
+    panel.css_classes = ["config-section"]
+    return panel
+
+
+def create_cluster_panel(process_4dnexus):
+    """
+    Panel clustering the scan points of the Plot2 volume by their probes (mini-batch k-means).
+
+    The cluster map from the coarse pyramid level shows within seconds and is
+    replaced by the refined one; cluster-mean probes are browsed as a stack.
+    Results are also listed as '<volume>@kmeans<k>/...' datasets (see
+    Process4dNexusOpt.cluster()).
+    """
+    clusters_input = create_text_input(title="Clusters:", value=str(CLUSTER_COUNT), width=100)
+    level_select = create_select(title="Coarse level:", value="auto",
+                                 options=["auto"] + [str(f) for f in (1,) + PYRAMID_FACTORS], width=120)
+    refine_input = create_text_input(title="Refine passes:", value=str(CLUSTER_REFINE_PASSES), width=120)
+    feature_select = create_select(title="Compare probes by:", value="shape", options=["shape", "intensity"], width=150)
+    run_button = create_button(label="Cluster Scan Points", button_type="success", width=200)
+    cancel_button = create_button(label="Cancel", button_type="warning", width=100)
+    message = create_div(text="", width=600)
+    map_select, map_plot, set_map_names, set_map = create_map_stack_view("Cluster Map")
+    mean_select, mean_plot, set_mean_names, set_means = create_map_stack_view("Cluster Mean Probe")
+    state = {'job': None}
+    
+    def _show(result, final):
+        counts = ", ".join(str(int(c)) for c in result['counts'])
+        message.text = (f"✅ Refined clusters ({counts} points)" if final
+                        else f"⏳ Coarse clusters ({counts} points), refining...")
+        set_map(result['labels'][None])
+        set_means(result['means'])
+    
+    def _on_run():
+        dataset_path = getattr(process_4dnexus, 'volume_picked', None)
+        if not dataset_path:
+            message.text = "<span style='color: orange;'>Pick a Plot2 volume first</span>"
+            return
+        try:
+            n_clusters = int(clusters_input.value)
+            refine_passes = int(refine_input.value)
+            if n_clusters < 2 or refine_passes < 0:
+                raise ValueError("Clusters must be at least 2 and refine passes not negative")
+            set_map_names(["Clusters"])
+            set_mean_names([f"Cluster {i}" for i in range(n_clusters)])
+            message.text = f"⏳ Clustering {dataset_path}..."
+            state['job'] = process_4dnexus.cluster(
+                dataset_path, lambda result: _show(result, True), n_clusters=n_clusters,
+                level=None if level_select.value == "auto" else int(level_select.value),
+                refine_passes=refine_passes, normalize=feature_select.value == "shape",
+                on_update=lambda result: _show(result, False), doc=curdoc(),
+            )
+        except ValueError as e:
+            message.text = f"<span style='color: red;'>{e}</span>"
+    
+    def _on_cancel():
+        if state['job'] is not None and not state['job'].finished.is_set():
+            state['job'].cancel()
+            message.text = "Clustering cancelled"
+    
+    run_button.on_click(_on_run)
+    cancel_button.on_click(_on_cancel)
+    
+    panel = column(
+        create_div(text="<h3 style='margin-top: 0; color: #5716e5;'>Scan Point Clustering</h3>", width=600),
+        row(clusters_input, level_select, refine_input, feature_select),
+        row(run_button, cancel_button),
+        message,
+        row(column(map_select, map_plot), column(mean_select, mean_plot)),
+    )
+    panel.css_classes = ["config-section"]
+    return panel
+
+
 def create_dashboard(process_4dnexus):
     """
     Create the full dashboard using SCLib components with session management and undo/redo.
@@ -2099,7 +4371,17 @@ def create_dashboard(process_4dnexus):
     
     # Use the new DashboardBuilder
     builder = DashboardBuilder(process_4dnexus)
-    return builder.build()
+    panels = [builder.build()]
+    if LIVE_MODE:
+        panels.append(create_live_map_panel(process_4dnexus))
+    # The probe/ROI panel draws (z, u) boxes on probe images, so it needs a 4D Plot2 volume
+    volume_picked = getattr(process_4dnexus, 'volume_picked', None)
+    volume = process_4dnexus.get_volume(volume_picked) if volume_picked else None
+    if volume is not None and len(volume.shape) == 4:
+        panels.append(create_roi_panel(process_4dnexus))
+    return column(*panels, create_roi_set_panel(process_4dnexus),
+                  create_mask_panel(process_4dnexus), create_integration_panel(process_4dnexus),
+                  create_decomposition_panel(process_4dnexus), create_cluster_panel(process_4dnexus))
 def scientistCloudInitDashboard():
     """Initialize the dashboard."""
     global status_messages, curdoc, request, has_args
@@ -2225,15 +4507,46 @@ if True:
         curdoc().add_root(error_div)
     else:
         print("🔍 DEBUG: Creating Process4dNexus object...")
-        # Create the processor object
-        process_4dnexus = Process4dNexus(
+        # Create the processor object (volume caches are built in the background)
+        session_context = curdoc().session_context
+        process_4dnexus = Process4dNexusOpt(
             nexus_filename,
             mmap_filename,
             cached_cast_float=True,
-            status_callback=add_status_message
+            status_callback=add_status_message,
+            session_id=session_context.id if session_context is not None else None,
+            live=LIVE_MODE
         )
         print("✅ DEBUG: Process4dNexus object created successfully")
         
+        def _release_shared_volumes(session_context):
+            # Volumes no other session uses are dropped from the shared registry
+            dropped = process_4dnexus.release()
+            if not process_4dnexus.is_open_elsewhere(dropped):
+                process_4dnexus.invalidate_dataset_cache()
+            print(f"🔍 DEBUG: Session {session_context.id} destroyed, released {len(dropped)} shared volume(s), "
+                  f"dataset cache: {process_4dnexus.get_dataset_cache_stats()}")
+        
+        curdoc().on_session_destroyed(_release_shared_volumes)
+        schedule_derived_cache_prune(status_callback=add_status_message)
+        
+        if LIVE_MODE:
+            # poll_live() extends the cached maps and ratio maps; the panels of create_dashboard() redraw from them
+            process_4dnexus.add_live_listener(
+                lambda lo, hi: add_status_message(f"🔴 Live: {hi} scan rows (+{hi - lo})"),
+                min_interval=LIVE_REFRESH_SECONDS
+            )
+            
+            def _poll_live():
+                if not getattr(process_4dnexus, 'volume_picked', None):
+                    return
+                try:
+                    process_4dnexus.poll_live()
+                except Exception as e:
+                    print(f"⚠️ Live poll failed: {e}")
+            
+            curdoc().add_periodic_callback(_poll_live, LIVE_POLL_MS)
+        
         print("🔍 DEBUG: Calling get_choices() to discover datasets...")
         try:
             choices_success = process_4dnexus.get_choices()
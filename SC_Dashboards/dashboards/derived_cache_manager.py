@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Disk-budget LRU manager for derived dataset caches
+
+Dashboards write derived artifacts (float32 memmaps, tiled caches, pyramid
+levels, compact encodings, dataset indexes) next to the uploads. Each
+artifact is tagged with an <artifact>.meta.json fingerprint whose mtime the
+dashboard refreshes whenever it uses the artifact, so the sidecars double as
+the access ledger. This module scans the dataset roots for derived files,
+reports their size and last access, and evicts the least recently used ones
+to stay under a disk budget.
+
+Usage:
+    python3 derived_cache_manager.py report [--root DIR ...]
+    python3 derived_cache_manager.py prune --budget-gb 500 [--min-idle-hours 24] [--dry-run]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+DEFAULT_ROOTS = os.getenv(
+    'SC_DERIVED_CACHE_ROOTS', '/mnt/visus_datasets/upload:/mnt/visus_datasets/converted'
+).split(os.pathsep)
+# 0 = no budget (report only, the dashboards never prune)
+DEFAULT_BUDGET_BYTES = int(float(os.getenv('SC_DERIVED_CACHE_BUDGET_GB', '0')) * 1024 ** 3)
+# Artifacts used more recently than this are never evicted
+DEFAULT_MIN_IDLE_SECONDS = float(os.getenv('SC_DERIVED_CACHE_MIN_IDLE_HOURS', '24')) * 3600
+
+META_SUFFIX = '.meta.json'
+# Derived files that carry no fingerprint (legacy caches, dataset indexes); their mtime is the last access
+UNTRACKED_SUFFIXES = ('.float32.dat', '.choices.json')
+# Leftovers of builds that crashed before renaming their output into place
+PARTIAL_MARKER = '.partial-'
+
+
+class DerivedArtifact:
+    """One derived artifact and the files that make it up (data, sidecars)."""
+
+    def __init__(self, path, files, last_access):
+        self.path = path
+        self.files = files
+        self.last_access = last_access
+        self.size = 0
+        for filename in files:
+            try:
+                self.size += os.path.getsize(filename)
+            except OSError:
+                pass
+
+    def remove(self):
+        """Delete the artifact, fingerprint first so readers treat it as stale rather than half-deleted."""
+        removed = 0
+        for filename in sorted(self.files, key=lambda f: not f.endswith(META_SUFFIX)):
+            try:
+                os.remove(filename)
+                removed += 1
+            except OSError as e:
+                print(f"⚠️ Could not remove {filename}: {e}")
+        return removed
+
+
+def touch(artifact_filename):
+    """Record an access to an artifact."""
+    try:
+        os.utime(artifact_filename + META_SUFFIX)
+    except OSError:
+        pass
+
+
+def scan(roots=None):
+    """Return every derived artifact found under roots."""
+    artifacts = []
+    for root in roots or DEFAULT_ROOTS:
+        for dirpath, _dirnames, filenames in os.walk(root):
+            names = set(filenames)
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    if name.endswith(META_SUFFIX):
+                        artifact = name[:-len(META_SUFFIX)]
+                        if PARTIAL_MARKER in name:
+                            artifacts.append(DerivedArtifact(path, [path], os.path.getmtime(path)))
+                            continue
+                        files = [path] + [os.path.join(dirpath, n) for n in (artifact, artifact + '.json') if n in names]
+                        artifacts.append(DerivedArtifact(os.path.join(dirpath, artifact), files, os.path.getmtime(path)))
+                    elif PARTIAL_MARKER in name:
+                        artifacts.append(DerivedArtifact(path, [path], os.path.getmtime(path)))
+                    elif name.endswith(UNTRACKED_SUFFIXES) and name + META_SUFFIX not in names:
+                        stat = os.stat(path)
+                        artifacts.append(DerivedArtifact(path, [path], max(stat.st_atime, stat.st_mtime)))
+                except OSError:
+                    # Removed while scanning (e.g. by a concurrent build or prune)
+                    continue
+    return artifacts
+
+
+def prune(artifacts, budget_bytes, min_idle_seconds=DEFAULT_MIN_IDLE_SECONDS, dry_run=False, keep=()):
+    """
+    Evict least recently used artifacts until their total size fits budget_bytes.
+
+    Artifacts used within min_idle_seconds, and those whose file is in keep
+    (e.g. held open by a running dashboard), are kept even if the budget is
+    exceeded. Returns the evicted artifacts.
+    """
+    keep = {os.path.realpath(path) for path in keep}
+    total = sum(a.size for a in artifacts)
+    now = time.time()
+    evicted = []
+    for artifact in sorted(artifacts, key=lambda a: a.last_access):
+        if total <= budget_bytes or now - artifact.last_access < min_idle_seconds:
+            break
+        if os.path.realpath(artifact.path) in keep:
+            continue
+        if not dry_run:
+            artifact.remove()
+        total -= artifact.size
+        evicted.append(artifact)
+    return evicted
+
+
+def _format_size(nbytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if nbytes < 1024:
+            return f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f} TB"
+
+
+def _format_age(seconds):
+    days = seconds / 86400
+    return f"{days:.1f} d" if days >= 1 else f"{seconds / 3600:.1f} h"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report and prune derived dataset caches")
+    parser.add_argument('command', choices=['report', 'prune'])
+    parser.add_argument('--root', action='append',
+                        help=f"dataset root to scan (repeatable, default: {os.pathsep.join(DEFAULT_ROOTS)})")
+    parser.add_argument('--budget-gb', type=float, default=DEFAULT_BUDGET_BYTES / 1024 ** 3,
+                        help="disk budget for derived caches (prune)")
+    parser.add_argument('--min-idle-hours', type=float, default=DEFAULT_MIN_IDLE_SECONDS / 3600,
+                        help="never evict artifacts used more recently (prune)")
+    parser.add_argument('--dry-run', action='store_true', help="only list what prune would remove")
+    args = parser.parse_args(argv)
+
+    artifacts = scan(args.root or DEFAULT_ROOTS)
+    now = time.time()
+    total = sum(a.size for a in artifacts)
+    if args.command == 'report':
+        for artifact in sorted(artifacts, key=lambda a: a.last_access):
+            print(f"{_format_size(artifact.size):>10}  {_format_age(now - artifact.last_access):>8}  {artifact.path}")
+        print(f"{len(artifacts)} derived artifacts, {_format_size(total)}")
+        return 0
+
+    budget_bytes = int(args.budget_gb * 1024 ** 3)
+    if budget_bytes <= 0:
+        print("❌ prune needs a budget (--budget-gb or SC_DERIVED_CACHE_BUDGET_GB)")
+        return 1
+    evicted = prune(artifacts, budget_bytes, min_idle_seconds=args.min_idle_hours * 3600, dry_run=args.dry_run)
+    for artifact in evicted:
+        print(f"{'would remove' if args.dry_run else 'removed'} {_format_size(artifact.size):>10}  "
+              f"{_format_age(now - artifact.last_access):>8}  {artifact.path}")
+    freed = sum(a.size for a in evicted)
+    print(f"{'Would free' if args.dry_run else 'Freed'} {_format_size(freed)}; "
+          f"{_format_size(total - freed)} of derived caches left (budget {_format_size(budget_bytes)})")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1035 @@
+#!/usr/bin/env python3
+"""
+Virtual detectors and probe analysis of the 4D dashboard
+
+The NumPy side of the 4D dashboard's analysis tools: ROI statistics and
+ROI sets, detector masks (MaskWeights), azimuthal integration, streaming
+PCA/NMF of probe spectra, mini-batch k-means of scan points, and the
+scheduling behind interactive views (InteractiveRefiner, and the
+thread-pool ROIReductionEngine behind the Plot3 maps). Volumes are read
+through NumPy indexing, so every function works on h5py datasets,
+memmaps and the cached volumes of volume_cache alike.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import h5py
+import numpy as np
+
+from volume_cache import LIVE_MODE, VOLUME_CACHE_SLAB_BYTES, bin_mean, detector_axes, json_attr, open_nexus
+
+# Sparse virtual detector masks (optional, see MaskWeights)
+try:
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
+# Minimum time between two partial maps pushed to the UI
+REDUCE_PROGRESS_SECONDS = 0.25
+# Maps produced together by one pass over an ROI (see roi_statistics())
+ROI_STATISTICS = ('sum', 'mean', 'max', 'std', 'centroid_z', 'centroid_u')
+# Percentiles precomputed with every ratio map (color ranges of Plot1/Plot1B)
+RATIO_PERCENTILES = (0, 1, 2, 5, 50, 95, 98, 99, 100)
+# Default binning of azimuthal integrations: q bins, and chi bins of I(q, chi) (1 = I(q) only)
+AZIMUTHAL_Q_BINS = int(os.getenv('SC_4D_AZIMUTHAL_Q_BINS', '500'))
+AZIMUTHAL_CHI_BINS = int(os.getenv('SC_4D_AZIMUTHAL_CHI_BINS', '1'))
+# Streaming decompositions of probe spectra: components, randomized SVD oversampling, passes over the volume
+DECOMPOSITION_COMPONENTS = int(os.getenv('SC_4D_DECOMPOSITION_COMPONENTS', '8'))
+DECOMPOSITION_OVERSAMPLE = 10
+PCA_PASSES = int(os.getenv('SC_4D_PCA_PASSES', '4'))
+NMF_PASSES = int(os.getenv('SC_4D_NMF_PASSES', '30'))
+# Mini-batch k-means of scan points: clusters, points per batch, batches on the coarse level, passes over the volume
+CLUSTER_COUNT = int(os.getenv('SC_4D_CLUSTERS', '8'))
+CLUSTER_BATCH_POINTS = 4096
+CLUSTER_COARSE_ITERATIONS = 100
+CLUSTER_REFINE_PASSES = int(os.getenv('SC_4D_CLUSTER_REFINE_PASSES', '1'))
+
+
+def roi_statistics(block, ranges):
+    """
+    Every ROI_STATISTICS map of block at once, stacked along a new last axis.
+
+    block holds the ROI voxels (trailing axes = one per (lo, hi) in ranges) of
+    some scan points. Centroids are intensity-weighted positions in
+    full-resolution detector indices, NaN where the ROI sums to 0; 3D volumes
+    have no centroid_u.
+    """
+    data = np.asarray(block, dtype=np.float64)
+    n_det = len(ranges)
+    axes = tuple(range(data.ndim - n_det, data.ndim))
+    total = data.sum(axis=axes)
+    out = np.full(total.shape + (len(ROI_STATISTICS),), np.nan)
+    out[..., 0] = total
+    if all(data.shape[a] for a in axes):
+        out[..., 1] = total / int(np.prod([data.shape[a] for a in axes]))
+        out[..., 2] = data.max(axis=axes)
+        out[..., 3] = data.std(axis=axes)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i, (lo, _hi) in enumerate(ranges):
+            other = tuple(a for a in axes if a != axes[i])
+            marginal = data.sum(axis=other) if other else data
+            centroid = (marginal @ (int(lo) + np.arange(marginal.shape[-1], dtype=np.float64))) / total
+            out[..., 4 + i] = np.where(total != 0, centroid, np.nan)
+    return out
+
+
+def normalize_roi_set(rois):
+    """
+    Return an ROI set as a list of {'name': str, 'ranges': [[lo, hi], ...]}.
+
+    rois holds such dicts (e.g. from session metadata) or (name, ranges) pairs.
+    """
+    roi_set = []
+    for i, roi in enumerate(rois or []):
+        name, ranges = (roi.get('name'), roi['ranges']) if isinstance(roi, dict) else roi
+        ranges = [[int(lo), int(hi)] for lo, hi in ranges]
+        if not ranges or any(hi <= lo for lo, hi in ranges):
+            raise ValueError(f"ROI {name or i + 1} has an empty range: {ranges}")
+        roi_set.append({'name': str(name or f"ROI {i + 1}"), 'ranges': ranges})
+    return roi_set
+
+
+def parse_roi_set(text):
+    """Parse "name: z_lo z_hi u_lo u_hi" entries (names optional) separated by ';' or newlines."""
+    rois = []
+    for i, entry in enumerate(e.strip() for e in text.replace('\n', ';').split(';')):
+        if not entry:
+            continue
+        name, _, numbers = entry.rpartition(':')
+        try:
+            values = [int(float(v)) for v in numbers.replace(',', ' ').split()]
+        except ValueError:
+            raise ValueError(f"Cannot read ROI '{entry}', expected name: z_lo z_hi u_lo u_hi")
+        if not values or len(values) % 2:
+            raise ValueError(f"ROI '{entry}' needs a (lo, hi) pair per detector axis")
+        rois.append((name.strip() or f"ROI {i + 1}", list(zip(values[::2], values[1::2]))))
+    return normalize_roi_set(rois)
+
+
+def format_roi_set(roi_set):
+    """Inverse of parse_roi_set()."""
+    return "; ".join(
+        f"{roi['name']}: " + " ".join(f"{lo} {hi}" for lo, hi in roi['ranges']) for roi in roi_set or []
+    )
+
+
+def roi_set_sums(block, origin, roi_set):
+    """
+    Sum maps of every ROI of roi_set from one block, stacked along a new last axis.
+
+    block holds the scan points' detector data inside the bounding box of the
+    ROIs, whose lower corner is origin (one index per detector axis).
+    """
+    n_det = len(origin)
+    axes = tuple(range(block.ndim - n_det, block.ndim))
+    maps = []
+    for roi in roi_set:
+        window = tuple(slice(lo - o, hi - o) for (lo, hi), o in zip(roi['ranges'], origin))
+        maps.append(np.sum(block[(Ellipsis,) + window], axis=axes, dtype=np.float64))
+    return np.stack(maps, axis=-1)
+
+
+def annulus_mask(detector_shape, center, r_inner, r_outer):
+    """Pixels of a (z, u) detector whose distance to center (z, u) lies in [r_inner, r_outer)."""
+    z, u = np.ogrid[:detector_shape[0], :detector_shape[1]]
+    r = np.hypot(z - center[0], u - center[1])
+    return (r >= r_inner) & (r < r_outer)
+
+
+def polygon_mask(detector_shape, vertices):
+    """Pixels of a (z, u) detector inside a polygon given as (z, u) vertices (even-odd rule)."""
+    z, u = np.ogrid[:detector_shape[0], :detector_shape[1]]
+    inside = np.zeros(tuple(detector_shape), dtype=bool)
+    vertices = [tuple(map(float, v)) for v in vertices]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for (z0, u0), (z1, u1) in zip(vertices, vertices[1:] + vertices[:1]):
+            crosses = (u0 > u) != (u1 > u)
+            inside ^= crosses & (z < z0 + (u - u0) * (z1 - z0) / (u1 - u0))
+    return inside
+
+
+def brush_mask(detector_shape, strokes, radius):
+    """Pixels of a (z, u) detector within radius of freehand strokes, each a sequence of (z, u) points."""
+    mask = np.zeros(tuple(detector_shape), dtype=bool)
+    z, u = np.ogrid[:detector_shape[0], :detector_shape[1]]
+    step = max(radius / 2.0, 0.5)
+    for stroke in strokes:
+        points = np.asarray(stroke, dtype=np.float64).reshape(-1, 2)
+        for (z0, u0), (z1, u1) in zip(points, np.concatenate([points[1:], points[-1:]])):
+            for t in np.linspace(0, 1, max(2, int(np.hypot(z1 - z0, u1 - u0) / step) + 1)):
+                cz, cu = z0 + t * (z1 - z0), u0 + t * (u1 - u0)
+                mask |= (z - cz) ** 2 + (u - cu) ** 2 <= radius ** 2
+    return mask
+
+
+def resolve_mask_filename(filename, mask_dirs):
+    """
+    Real path of a mask file, which must lie under one of mask_dirs.
+
+    The filename comes from the browser: relative names are taken relative
+    to the first directory, and symlinks and '..' are resolved before the
+    check, so nothing outside mask_dirs can be read. Raises ValueError.
+    """
+    roots = [os.path.realpath(d) for d in mask_dirs if d]
+    if not roots:
+        raise ValueError("Mask files are disabled (no dataset directory to read them from)")
+    path = os.path.realpath(os.path.join(roots[0], filename.strip()))
+    if not any(os.path.commonpath([path, root]) == root for root in roots):
+        raise ValueError(f"Mask file {filename} is outside the dataset directory")
+    return path
+
+
+def load_mask_file(spec, detector_shape, mask_dirs=()):
+    """
+    Load a mask (boolean or weights) of detector_shape from .npy, .npz or HDF5.
+
+    spec is a filename under one of mask_dirs (see resolve_mask_filename()),
+    optionally followed by '::' and the array/dataset name; otherwise 'mask'
+    or the first array in the file is used.
+    """
+    filename, _, name = spec.partition('::')
+    filename = resolve_mask_filename(filename, mask_dirs)
+    if filename.endswith('.npy'):
+        mask = np.load(filename)
+    elif filename.endswith('.npz'):
+        with np.load(filename) as npz:
+            mask = npz[name or ('mask' if 'mask' in npz.files else npz.files[0])]
+    else:
+        with h5py.File(filename, 'r') as f:
+            if not name:
+                names = []
+                f.visititems(lambda n, obj: names.append(n) if isinstance(obj, h5py.Dataset) else None)
+                name = 'mask' if 'mask' in f else names[0]
+            mask = f[name][()]
+    if tuple(mask.shape) != tuple(detector_shape):
+        raise ValueError(f"Mask {spec} has shape {mask.shape}, the detector is {tuple(detector_shape)}")
+    return mask
+
+
+def parse_mask_set(text, detector_shape, strokes=(), mask_dirs=()):
+    """
+    Parse virtual detector specs separated by ';' or newlines into {name: mask}.
+
+    name: annulus cz cu r_inner r_outer
+    name: polygon z1 u1 z2 u2 z3 u3 ...
+    name: brush radius             (the freehand strokes drawn on the detector)
+    name: file path[::dataset]     (a file under one of mask_dirs)
+    """
+    masks = {}
+    for i, entry in enumerate(e.strip() for e in text.replace('\n', ';').split(';')):
+        if not entry:
+            continue
+        name, _, spec = entry.partition(':')
+        kind, _, args = spec.strip().partition(' ')
+        name = name.strip() or f"Mask {i + 1}"
+        if kind != 'file' and len(detector_shape) != 2:
+            raise ValueError(f"Mask '{entry}': {kind} masks need a 2D (z, u) detector")
+        try:
+            if kind == 'file':
+                masks[name] = load_mask_file(args.strip(), detector_shape, mask_dirs)
+                continue
+            values = [float(v) for v in args.replace(',', ' ').split()]
+            if kind == 'annulus' and len(values) == 4:
+                masks[name] = annulus_mask(detector_shape, values[:2], values[2], values[3])
+            elif kind == 'polygon' and len(values) >= 6 and len(values) % 2 == 0:
+                masks[name] = polygon_mask(detector_shape, list(zip(values[::2], values[1::2])))
+            elif kind == 'brush' and len(values) == 1 and strokes:
+                masks[name] = brush_mask(detector_shape, strokes, values[0])
+            else:
+                raise ValueError("unknown mask type or wrong number of values")
+        except (OSError, KeyError, IndexError, ValueError) as e:
+            raise ValueError(f"Cannot read mask '{entry}': {e}")
+    return masks
+
+
+class MaskWeights:
+    """
+    Virtual detector masks as one (pixels, masks) weight matrix for blocked products.
+
+    Only the bounding window of all masks is kept, so the volume is read in
+    that window; maps are then volume_window.reshape(points, pixels) @ W.
+    W is a scipy.sparse matrix when SciPy is installed; otherwise the pixels
+    inside any mask are gathered and multiplied by a dense matrix.
+    """
+
+    def __init__(self, masks, detector_shape):
+        self.names = list(masks)
+        weights = [np.asarray(masks[name], dtype=np.float64) for name in self.names]
+        for name, w in zip(self.names, weights):
+            if w.shape != tuple(detector_shape):
+                raise ValueError(f"Mask {name} has shape {w.shape}, the detector is {tuple(detector_shape)}")
+        covered = np.zeros(tuple(detector_shape), dtype=bool)
+        for w in weights:
+            covered |= w != 0
+        if not covered.any():
+            raise ValueError("The masks select no detector pixels")
+        nonzero = np.nonzero(covered)
+        self.window = tuple(slice(int(i.min()), int(i.max()) + 1) for i in nonzero)
+        window_shape = tuple(s.stop - s.start for s in self.window)
+        n_pixels = int(np.prod(window_shape))
+        rows, cols, values = [], [], []
+        digest = hashlib.sha1(repr((tuple(detector_shape), self.names)).encode())
+        for col, w in enumerate(weights):
+            flat = w[self.window].ravel()
+            nz = np.flatnonzero(flat)
+            rows.append(nz)
+            cols.append(np.full(nz.size, col))
+            values.append(flat[nz])
+            digest.update(nz.tobytes())
+            digest.update(flat[nz].tobytes())
+        self.key = digest.hexdigest()
+        rows, cols, values = np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+        if scipy is not None:
+            self._matrix = scipy.sparse.csr_matrix((values, (rows, cols)), shape=(n_pixels, len(self.names)))
+            self._pixels = None
+        else:
+            self._pixels = np.unique(rows)
+            self._matrix = np.zeros((self._pixels.size, len(self.names)))
+            self._matrix[np.searchsorted(self._pixels, rows), cols] = values
+
+    def apply(self, block):
+        """Map values of block (scan points x window pixels, any leading shape) for every mask, stacked last."""
+        n_det = len(self.window)
+        flat = np.asarray(block, dtype=np.float32).reshape(-1, int(np.prod(block.shape[block.ndim - n_det:])))
+        if self._pixels is not None:
+            out = flat[:, self._pixels] @ self._matrix
+        else:
+            out = np.asarray(flat @ self._matrix)
+        return out.reshape(block.shape[:block.ndim - n_det] + (len(self.names),))
+
+
+# Length units of NeXus geometry fields, in metres (unitless values are taken as mm)
+_GEOMETRY_LENGTH_UNITS = {'m': 1.0, 'cm': 1e-2, 'mm': 1e-3, 'um': 1e-6, 'µm': 1e-6, 'micron': 1e-6, 'nm': 1e-9}
+
+
+def read_detector_geometry(nexus_filename, live=LIVE_MODE):
+    """
+    Best-effort detector geometry from the NeXus instrument fields (see pixel_q_chi()).
+
+    Looks for beam_center_x/y, distance, x/y_pixel_size and wavelength or
+    energy anywhere in the file; returns only the keys it found.
+    """
+    fields = {}
+
+    def _visit(name, obj):
+        if isinstance(obj, h5py.Dataset) and obj.size == 1 and obj.dtype.kind in 'iuf':
+            fields.setdefault(name.split('/')[-1], (float(np.ravel(obj[()])[0]), json_attr(obj.attrs.get('units', ''))))
+
+    with open_nexus(nexus_filename, live=live) as f:
+        f.visititems(_visit)
+
+    def _length(name):
+        value, units = fields[name]
+        return value * _GEOMETRY_LENGTH_UNITS.get(str(units).strip(), 1e-3)
+
+    geometry = {}
+    if 'distance' in fields:
+        geometry['distance'] = _length('distance')
+    if 'x_pixel_size' in fields:
+        geometry['pixel_size'] = (_length('y_pixel_size' if 'y_pixel_size' in fields else 'x_pixel_size'),
+                                  _length('x_pixel_size'))
+    if 'beam_center_x' in fields and 'beam_center_y' in fields:
+        center = []
+        for name, axis in (('beam_center_y', 0), ('beam_center_x', 1)):
+            value, units = fields[name]
+            # Beam centers are pixels unless given in a length unit
+            if str(units).strip() in _GEOMETRY_LENGTH_UNITS and 'pixel_size' in geometry:
+                value = _length(name) / geometry['pixel_size'][axis]
+            center.append(value)
+        geometry['center'] = tuple(center)
+    for name in ('wavelength', 'incident_wavelength'):
+        if name in fields:
+            value, units = fields[name]
+            geometry['wavelength'] = value * {'nm': 10.0, 'm': 1e10}.get(str(units).strip(), 1.0)
+            break
+    else:
+        for name in ('energy', 'incident_energy'):
+            if name in fields:
+                value, units = fields[name]
+                kev = value * (1e-3 if str(units).strip() == 'eV' else 1.0)
+                if kev > 0:
+                    geometry['wavelength'] = 12.398419843320026 / kev
+                break
+    return geometry
+
+
+def parse_detector_geometry(text):
+    """Parse 'cz cu distance_mm pixel_um energy_keV' (centre in pixels) into a geometry dict."""
+    values = [float(v) for v in text.replace(',', ' ').split()]
+    if len(values) != 5 or min(values[2:]) <= 0:
+        raise ValueError("Geometry needs: center_z center_u distance_mm pixel_um energy_keV")
+    cz, cu, distance_mm, pixel_um, energy_kev = values
+    return {
+        'center': (cz, cu),
+        'distance': distance_mm * 1e-3,
+        'pixel_size': (pixel_um * 1e-6, pixel_um * 1e-6),
+        'wavelength': 12.398419843320026 / energy_kev,
+    }
+
+
+def format_detector_geometry(geometry):
+    """Inverse of parse_detector_geometry() for the keys present ('' if incomplete)."""
+    if not all(k in geometry for k in ('center', 'distance', 'pixel_size', 'wavelength')):
+        return ''
+    return (f"{geometry['center'][0]:g} {geometry['center'][1]:g} {geometry['distance'] * 1e3:g} "
+            f"{geometry['pixel_size'][1] * 1e6:g} {12.398419843320026 / geometry['wavelength']:g}")
+
+
+def pixel_q_chi(detector_shape, geometry):
+    """
+    Momentum transfer q (1/Å) and azimuth chi (degrees) of every pixel of a flat (z, u) detector.
+
+    geometry: 'center' (z, u) beam position in pixels, 'distance' and
+    'pixel_size' ((z, u) or scalar) in metres, 'wavelength' in Å; the detector
+    is normal to the beam. chi is 0 along +u and 90 towards -z (up).
+    """
+    pz, pu = np.broadcast_to(np.asarray(geometry['pixel_size'], dtype=np.float64), (2,))
+    z, u = np.ogrid[:detector_shape[0], :detector_shape[1]]
+    dz = (z - geometry['center'][0]) * pz
+    du = (u - geometry['center'][1]) * pu
+    two_theta = np.arctan2(np.hypot(dz, du), geometry['distance'])
+    q = 4 * np.pi / geometry['wavelength'] * np.sin(two_theta / 2)
+    chi = np.degrees(np.arctan2(-dz, du))
+    return q, np.broadcast_to(chi, q.shape)
+
+
+class AzimuthalIntegrator:
+    """
+    Azimuthal (I(q)) or cake (I(chi, q)) integration of detector frames as one sparse product.
+
+    The pixel-to-bin assignment is computed once: a CSR matrix of shape
+    (bins, window pixels) holding 1/pixels-per-bin, so every block of frames
+    is binned by matrix @ frames.T. Without SciPy the pixels are sorted by bin
+    and summed with np.add.reduceat. Bins are the mean of their pixels (NaN
+    when empty); only the bounding window of the used pixels is read.
+    """
+
+    def __init__(self, detector_shape, geometry, n_q=AZIMUTHAL_Q_BINS, n_chi=AZIMUTHAL_CHI_BINS,
+                 mask=None, q_range=None):
+        if len(detector_shape) != 2:
+            raise ValueError("Azimuthal integration needs a 2D (z, u) detector")
+        if n_q < 1 or n_chi < 1:
+            raise ValueError("Azimuthal integration needs at least one q and one chi bin")
+        q, chi = pixel_q_chi(detector_shape, geometry)
+        used = np.isfinite(q)
+        if mask is not None:
+            used &= np.asarray(mask) != 0
+        if q_range is not None:
+            used &= (q >= q_range[0]) & (q <= q_range[1])
+        if not used.any():
+            raise ValueError("No detector pixels left to integrate")
+        q_lo, q_hi = q_range if q_range is not None else (float(q[used].min()), float(q[used].max()))
+        self.q_edges = np.linspace(q_lo, q_hi, n_q + 1)
+        self.chi_edges = np.linspace(-180.0, 180.0, n_chi + 1)
+        self.q = (self.q_edges[:-1] + self.q_edges[1:]) / 2
+        self.chi = (self.chi_edges[:-1] + self.chi_edges[1:]) / 2
+        self.n_q, self.n_chi = n_q, n_chi
+        self.geometry = geometry
+
+        nonzero = np.nonzero(used)
+        self.window = tuple(slice(int(i.min()), int(i.max()) + 1) for i in nonzero)
+        used = used[self.window]
+        pixels = np.flatnonzero(used)
+        q_bin = np.clip(np.searchsorted(self.q_edges, q[self.window].ravel()[pixels], 'right') - 1, 0, n_q - 1)
+        chi_bin = np.clip(np.searchsorted(self.chi_edges, chi[self.window].ravel()[pixels], 'right') - 1, 0, n_chi - 1)
+        bins = chi_bin * n_q + q_bin
+        counts = np.bincount(bins, minlength=n_q * n_chi)
+        self.empty = counts == 0
+        digest = hashlib.sha1(repr((tuple(detector_shape), n_q, n_chi, (q_lo, q_hi), sorted(
+            (k, np.asarray(v).tolist()) for k, v in geometry.items()))).encode())
+        digest.update(np.packbits(used).tobytes())
+        self.key = digest.hexdigest()
+        if scipy is not None:
+            self._matrix = scipy.sparse.csr_matrix(
+                (1.0 / counts[bins], (bins, pixels)), shape=(n_q * n_chi, used.size), dtype=np.float32)
+            self._order = None
+        else:
+            order = np.argsort(bins, kind='stable')
+            self._order = pixels[order]
+            self._starts = np.searchsorted(bins[order], np.flatnonzero(~self.empty))
+            self._scale = (1.0 / counts[~self.empty]).astype(np.float32)
+
+    @property
+    def bin_shape(self):
+        """Trailing shape of integrated frames: (q,) or (chi, q)."""
+        return (self.n_q,) if self.n_chi == 1 else (self.n_chi, self.n_q)
+
+    def apply(self, block):
+        """Integrate block (any leading shape x detector window) into (..., q) or (..., chi, q)."""
+        lead = block.shape[:block.ndim - 2]
+        flat = np.asarray(block, dtype=np.float32).reshape(-1, int(np.prod(block.shape[-2:])))
+        if self._order is None:
+            out = np.asarray((self._matrix @ flat.T).T)
+        else:
+            out = np.empty((flat.shape[0], self.n_q * self.n_chi), dtype=np.float32)
+            if self._order.size:
+                out[:, ~self.empty] = np.add.reduceat(flat[:, self._order], self._starts, axis=1) * self._scale
+        out[:, self.empty] = np.nan
+        return out.reshape(lead + self.bin_shape)
+
+    def metadata(self):
+        """JSON description (geometry and bin centres) stored next to an integrated volume."""
+        return {
+            'geometry': {k: np.asarray(v).tolist() for k, v in self.geometry.items()},
+            'q': self.q.tolist(),
+            'chi': self.chi.tolist() if self.n_chi > 1 else None,
+            'window': [[s.start, s.stop] for s in self.window],
+        }
+
+
+def build_integrated_volume(source, integrator, filename, status_callback=None, slab_bytes=VOLUME_CACHE_SLAB_BYTES):
+    """
+    Write integrator applied to every frame of a 4D (x, y, z, u) volume, in one pass.
+
+    The output memmap is (x, y, q) for I(q) or (x, y, chi, q) for I(chi, q);
+    only the integrator's detector window of each x-slab is read.
+    """
+    shape = tuple(source.shape)
+    out_shape = shape[:-2] + integrator.bin_shape
+    window_shape = tuple(s.stop - s.start for s in integrator.window)
+    row_bytes = int(np.prod(shape[1:-2], dtype=np.int64)) * int(np.prod(window_shape)) * 4
+    slab_rows = max(1, int(slab_bytes // max(row_bytes, 1)))
+    partial_filename = f"{filename}.partial-{os.getpid()}-{id(source)}"
+    try:
+        out = np.memmap(partial_filename, dtype=np.float32, mode='w+', shape=out_shape)
+        next_report = 0.25
+        for lo in range(0, shape[0], slab_rows):
+            hi = min(lo + slab_rows, shape[0])
+            out[lo:hi] = integrator.apply(source[(slice(lo, hi),) + (slice(None),) * (len(shape) - 3) + integrator.window])
+            if status_callback and hi / shape[0] >= next_report and hi < shape[0]:
+                status_callback(f"⏳ Azimuthal integration: {hi / shape[0]:.0%}")
+                next_report += 0.25
+        out.flush()
+        del out
+        with open(f"{filename}.json.partial-{os.getpid()}", 'w') as fp:
+            json.dump(integrator.metadata(), fp)
+        os.replace(f"{filename}.json.partial-{os.getpid()}", f"{filename}.json")
+        os.replace(partial_filename, filename)
+    except Exception:
+        try:
+            os.remove(partial_filename)
+        except OSError:
+            pass
+        raise
+
+
+def integrated_profile(volume, n_bin_axes, slab_bytes=VOLUME_CACHE_SLAB_BYTES):
+    """
+    Mean I(q) of an integrated volume over all its scan points, read in x-slabs.
+
+    n_bin_axes is 1 for (..., q) volumes and 2 for (..., chi, q) ones, whose
+    chi bins are averaged too. Empty (NaN) bins are ignored; a q bin empty
+    everywhere is NaN.
+    """
+    shape = tuple(volume.shape)
+    bin_shape = shape[len(shape) - n_bin_axes:]
+    row_bytes = int(np.prod(shape[1:], dtype=np.int64)) * 4
+    slab_rows = max(1, int(slab_bytes // max(row_bytes, 1)))
+    total = np.zeros(bin_shape, dtype=np.float64)
+    count = np.zeros(bin_shape, dtype=np.int64)
+    for lo in range(0, shape[0], slab_rows):
+        frames = np.asarray(volume[lo:lo + slab_rows], dtype=np.float32).reshape((-1,) + bin_shape)
+        finite = np.isfinite(frames)
+        total += np.where(finite, frames, 0).sum(axis=0, dtype=np.float64)
+        count += finite.sum(axis=0)
+    profile = ratio_map(total, count)
+    if n_bin_axes == 2:
+        finite = np.isfinite(profile)
+        profile = ratio_map(np.where(finite, profile, 0).sum(axis=0), finite.sum(axis=0))
+    return profile
+
+
+def _decomposition_slabs(volume, slab_rows):
+    """Yield (lo, hi, rows) with rows the probe spectra of x rows lo:hi as a (points, features) float32 matrix."""
+    shape = tuple(volume.shape)
+    n_scan = len(shape) - detector_axes(len(shape))
+    n_features = int(np.prod(shape[n_scan:]))
+    for lo in range(0, shape[0], slab_rows):
+        hi = min(lo + slab_rows, shape[0])
+        yield lo, hi, np.nan_to_num(np.asarray(volume[lo:hi], dtype=np.float32).reshape(-1, n_features))
+
+
+def _decomposition_result(method, volume, components, loadings, weights, passes, **extra):
+    """Reshape (k, features) components and (points, k) loadings back onto the detector and scan axes."""
+    shape = tuple(volume.shape)
+    n_scan = len(shape) - detector_axes(len(shape))
+    # Fix the sign/scale ambiguity: the largest component value is positive
+    flip = np.where(np.take_along_axis(components, np.abs(components).argmax(1)[:, None], 1)[:, 0] < 0, -1.0, 1.0)
+    return dict(
+        method=method,
+        components=(components * flip[:, None]).astype(np.float32).reshape((-1,) + shape[n_scan:]),
+        loadings=(loadings * flip).T.astype(np.float32).reshape((-1,) + shape[:n_scan]),
+        weights=np.asarray(weights, dtype=np.float64),
+        passes=passes,
+        **extra
+    )
+
+
+def streaming_pca(volume, n_components=DECOMPOSITION_COMPONENTS, passes=PCA_PASSES, slab_rows=1,
+                  cancelled=None, on_update=None, seed=0):
+    """
+    PCA of the probe spectra of a 3D/4D volume by randomized SVD, streaming over x-slabs.
+
+    Every pass reads each slab once and computes both B = Ac Q (the centred
+    data projected on the current basis) and Z = Ac^T B (one power
+    iteration); only the (points + features) x (k + oversampling) factors are
+    held in memory. From the second pass on, on_update(result) receives the
+    estimate from the SVD of B, which improves with every pass. Returns the
+    final result dict (components, loadings, weights = singular values,
+    explained variance ratio, mean), or None when cancelled.
+    """
+    shape = tuple(volume.shape)
+    n_scan = len(shape) - detector_axes(len(shape))
+    n_points, n_features = int(np.prod(shape[:n_scan])), int(np.prod(shape[n_scan:]))
+    rank = min(n_components + DECOMPOSITION_OVERSAMPLE, n_points, n_features)
+    n_components = min(n_components, rank)
+    q = np.linalg.qr(np.random.default_rng(seed).standard_normal((n_features, rank)))[0].astype(np.float32)
+    mean = total = None
+    result = None
+    for p in range(max(2, passes)):
+        b = np.empty((n_points, rank), dtype=np.float64)
+        z = np.zeros((n_features, rank), dtype=np.float64)
+        col_sum = np.zeros(n_features, dtype=np.float64) if mean is None else None
+        sum_sq = 0.0
+        row = 0
+        for lo, hi, rows in _decomposition_slabs(volume, slab_rows):
+            if cancelled is not None and cancelled.is_set():
+                return None
+            b_rows = rows @ q
+            b[row:row + len(rows)] = b_rows
+            z += rows.T @ b_rows
+            if col_sum is not None:
+                col_sum += rows.sum(0, dtype=np.float64)
+                sum_sq += float(np.einsum('ij,ij->', rows, rows, dtype=np.float64))
+            row += len(rows)
+        if mean is None:
+            mean = col_sum / n_points
+            total = sum_sq - n_points * float(mean @ mean)
+        # Centre without a separate pass: Ac Q = A Q - 1 (mean^T Q), Ac^T Ac Q = A^T A Q - n mean (mean^T Q)
+        mean_q = mean @ q
+        b -= mean_q
+        z -= n_points * np.outer(mean, mean_q)
+        if p > 0:
+            u, sigma, wt = np.linalg.svd(b, full_matrices=False)
+            result = _decomposition_result(
+                'pca', volume, (q @ wt.T[:, :n_components]).T, u[:, :n_components] * sigma[:n_components],
+                sigma[:n_components], p + 1,
+                explained=sigma[:n_components] ** 2 / total if total > 0 else np.zeros(n_components),
+                mean=mean.astype(np.float32).reshape(shape[n_scan:]),
+            )
+            if on_update is not None and p + 1 < max(2, passes):
+                on_update(result)
+        q = np.linalg.qr(z)[0].astype(np.float32)
+    return result
+
+
+def streaming_nmf(volume, n_components=DECOMPOSITION_COMPONENTS, passes=NMF_PASSES, slab_rows=1,
+                  cancelled=None, on_update=None, seed=0):
+    """
+    Non-negative factorization of the probe spectra of a 3D/4D volume, streaming over x-slabs.
+
+    Multiplicative updates (Lee & Seung): each pass updates the loadings of
+    every slab against the current components and accumulates W^T A and W^T W,
+    then updates the components. Negative values are clipped to 0. Only the
+    loadings (points x k) and components (k x features) are held in memory;
+    on_update(result) receives the estimate after every pass. Returns the
+    final result dict, or None when cancelled.
+    """
+    shape = tuple(volume.shape)
+    n_scan = len(shape) - detector_axes(len(shape))
+    n_points, n_features = int(np.prod(shape[:n_scan])), int(np.prod(shape[n_scan:]))
+    rng = np.random.default_rng(seed)
+    w = rng.uniform(0.1, 1.0, (n_points, n_components)).astype(np.float32)
+    h = rng.uniform(0.1, 1.0, (n_components, n_features)).astype(np.float32)
+    eps = np.float32(1e-12)
+    result = None
+    for p in range(max(1, passes)):
+        hht = h @ h.T
+        wta = np.zeros((n_components, n_features), dtype=np.float64)
+        wtw = np.zeros((n_components, n_components), dtype=np.float64)
+        row = 0
+        for lo, hi, rows in _decomposition_slabs(volume, slab_rows):
+            if cancelled is not None and cancelled.is_set():
+                return None
+            np.maximum(rows, 0, out=rows)
+            w_rows = w[row:row + len(rows)]
+            w_rows *= (rows @ h.T) / (w_rows @ hht + eps)
+            wta += w_rows.T @ rows
+            wtw += w_rows.T @ w_rows
+            row += len(rows)
+        h *= (wta / (wtw @ h + eps)).astype(np.float32)
+        # Components scaled to a maximum of 1, loadings carrying the intensity
+        scale = np.maximum(h.max(1), eps)
+        h /= scale[:, None]
+        w *= scale
+        result = _decomposition_result('nmf', volume, h, w, np.linalg.norm(w, axis=0), p + 1)
+        if on_update is not None and p + 1 < passes:
+            on_update(result)
+    return result
+
+
+class DecompositionJob:
+    """A decomposition or clustering running in a background thread: its latest result, completion and cancellation state."""
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def wait(self, timeout=None):
+        """Wait for the decomposition; returns its result, or None if cancelled or failed."""
+        self.finished.wait(timeout)
+        return None if self.cancelled.is_set() or self.error else self.result
+
+
+def probe_features(block, n_scan, factor=1, normalize=True):
+    """
+    (points, features) float32 probe signatures of a block of a volume.
+
+    The detector axes are mean-binned by factor (matching pyramid level
+    factor); with normalize every probe is scaled to unit L2 norm, so points
+    cluster by the shape of their probe rather than its intensity.
+    """
+    block = np.asarray(block, dtype=np.float32)
+    if factor > 1:
+        block = bin_mean(block, factor, axes=range(n_scan, block.ndim))
+    rows = np.nan_to_num(block.reshape(-1, int(np.prod(block.shape[n_scan:]))))
+    if normalize:
+        rows /= np.maximum(np.linalg.norm(rows, axis=1, keepdims=True), 1e-12)
+    return rows
+
+
+class MiniBatchKMeans:
+    """
+    Mini-batch k-means (Sculley, 2010) over feature rows fed a batch at a time.
+
+    Every centre is the running mean of all rows ever assigned to it (the
+    batched form of the per-row update c += (x - c) / count), so partial_fit()
+    can keep refining it from any number of batches.
+    """
+
+    def __init__(self, n_clusters, seed=0):
+        self.n_clusters = n_clusters
+        self.centers = None
+        self.counts = np.zeros(n_clusters, dtype=np.float64)
+        self._rng = np.random.default_rng(seed)
+
+    def init(self, features):
+        """Seed the centres from rows of features with k-means++."""
+        n = len(features)
+        if n < self.n_clusters:
+            raise ValueError(f"Cannot make {self.n_clusters} clusters of {n} scan points")
+        first = self._rng.integers(n)
+        centers = [features[first]]
+        d2 = ((features - features[first]) ** 2).sum(1)
+        for _ in range(1, self.n_clusters):
+            total = d2.sum()
+            i = self._rng.choice(n, p=d2 / total) if total > 0 else self._rng.integers(n)
+            centers.append(features[i])
+            d2 = np.minimum(d2, ((features - features[i]) ** 2).sum(1))
+        self.centers = np.array(centers, dtype=np.float32)
+
+    def predict(self, features):
+        """Nearest centre of every row, and the squared distance to it."""
+        d2 = (features ** 2).sum(1)[:, None] - 2 * features @ self.centers.T + (self.centers ** 2).sum(1)
+        labels = d2.argmin(1)
+        return labels, np.maximum(d2[np.arange(len(labels)), labels], 0)
+
+    def partial_fit(self, features):
+        """Move the centres towards one batch of rows; returns the batch's labels."""
+        labels, _ = self.predict(features)
+        one_hot = (labels[:, None] == np.arange(self.n_clusters)).astype(np.float32)
+        counts = one_hot.sum(0)
+        hit = counts > 0
+        self.counts += counts
+        sums = one_hot.T @ features
+        self.centers[hit] += (sums[hit] - counts[hit, None] * self.centers[hit]) / self.counts[hit, None]
+        return labels
+
+
+def cluster_scan_points(volume, n_clusters=CLUSTER_COUNT, coarse=None, factor=1, refine_passes=CLUSTER_REFINE_PASSES,
+                        normalize=True, slab_rows=1, cancelled=None, on_update=None, seed=0):
+    """
+    Group the scan points of a 3D/4D volume by their probes with mini-batch k-means.
+
+    coarse is the volume's pyramid level binned by factor: the centres are
+    first fitted on random batches of its (few) points, giving a cluster map
+    in seconds (sent to on_update(result) upsampled to the full scan). The
+    full volume is then streamed in x-slabs: refine_passes passes of
+    mini-batch updates with the probes binned by the same factor, and one
+    pass labelling every point and averaging the full-resolution probes of
+    each cluster. Returns dict(labels (scan shape), means (k, *detector),
+    counts, inertia), or None when cancelled.
+    """
+    shape = tuple(volume.shape)
+    n_scan = len(shape) - detector_axes(len(shape))
+    rng = np.random.default_rng(seed)
+    kmeans = MiniBatchKMeans(n_clusters, seed=seed)
+
+    def _stopped():
+        return cancelled is not None and cancelled.is_set()
+
+    def _slabs():
+        for lo in range(0, shape[0], slab_rows):
+            if _stopped():
+                return
+            yield np.asarray(volume[lo:min(lo + slab_rows, shape[0])], dtype=np.float32)
+
+    if coarse is not None and factor > 1:
+        coarse_features = probe_features(coarse, n_scan, normalize=normalize)
+        n = len(coarse_features)
+        kmeans.init(coarse_features[rng.choice(n, min(n, CLUSTER_BATCH_POINTS), replace=False)])
+        for _ in range(CLUSTER_COARSE_ITERATIONS):
+            if _stopped():
+                return None
+            kmeans.partial_fit(coarse_features[rng.choice(n, min(n, CLUSTER_BATCH_POINTS), replace=False)])
+        if on_update is not None:
+            labels = kmeans.predict(coarse_features)[0].reshape(coarse.shape[:n_scan])
+            for axis in range(n_scan):
+                labels = np.repeat(labels, factor, axis=axis)
+            labels = labels[tuple(slice(0, n) for n in shape[:n_scan])].astype(np.int32)
+            on_update(dict(method='kmeans', labels=labels, counts=np.bincount(labels.ravel(), minlength=n_clusters),
+                           means=kmeans.centers.reshape((n_clusters,) + tuple(coarse.shape[n_scan:])), passes=0))
+    else:
+        factor = 1
+        seed_rows = []
+        for slab in _slabs():
+            seed_rows.append(probe_features(slab, n_scan, normalize=normalize))
+            if sum(len(r) for r in seed_rows) >= max(n_clusters, CLUSTER_BATCH_POINTS):
+                break
+        if _stopped():
+            return None
+        kmeans.init(np.concatenate(seed_rows))
+
+    for _ in range(refine_passes):
+        for slab in _slabs():
+            kmeans.partial_fit(probe_features(slab, n_scan, factor, normalize))
+        if _stopped():
+            return None
+
+    labels = np.empty(int(np.prod(shape[:n_scan])), dtype=np.int32)
+    sums = np.zeros((n_clusters, int(np.prod(shape[n_scan:]))), dtype=np.float64)
+    inertia = 0.0
+    row = 0
+    for slab in _slabs():
+        slab_labels, d2 = kmeans.predict(probe_features(slab, n_scan, factor, normalize))
+        one_hot = (slab_labels[:, None] == np.arange(n_clusters)).astype(np.float32)
+        sums += one_hot.T @ np.nan_to_num(slab.reshape(len(slab_labels), -1))
+        labels[row:row + len(slab_labels)] = slab_labels
+        inertia += float(d2.sum())
+        row += len(slab_labels)
+    if _stopped():
+        return None
+    counts = np.bincount(labels, minlength=n_clusters)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (sums / counts[:, None]).astype(np.float32)
+    return dict(method='kmeans', labels=labels.reshape(shape[:n_scan]), means=means.reshape((n_clusters,) + shape[n_scan:]),
+                counts=counts, inertia=inertia, passes=refine_passes + 1)
+
+
+def roi_strip_deltas(old_ranges, new_ranges):
+    """
+    Signed boxes turning a sum over old_ranges into the sum over new_ranges.
+
+    Each detector axis is moved from its old to its new (lo, hi) interval in
+    turn, adding the strips that entered the box (+1) and subtracting those
+    that left it (-1). Returns a list of (sign, ranges).
+    """
+    current = [(int(lo), int(hi)) for lo, hi in old_ranges]
+    deltas = []
+    for axis, (c, d) in enumerate(new_ranges):
+        a, b = current[axis]
+        c, d = int(c), int(d)
+        for sign, lo, hi in ((1, c, min(a, d)), (-1, a, min(c, b)), (1, max(b, c), d), (-1, max(d, a), b)):
+            if hi > lo:
+                strip = list(current)
+                strip[axis] = (lo, hi)
+                deltas.append((sign, tuple(strip)))
+        current[axis] = (c, d)
+    return deltas
+
+
+class InteractiveRefiner:
+    """
+    Coarse-while-dragging, refine-when-idle scheduling for Bokeh callbacks.
+
+    request(compute, render) immediately renders compute(coarse_level) and
+    schedules compute(1) after idle_ms without a newer request; a newer
+    request cancels the pending refinement. compute receives the pyramid
+    factor to read from (1 = full resolution). defer(callback) only
+    schedules callback, for views without a coarse level.
+    """
+
+    def __init__(self, doc, idle_ms=300):
+        self.doc = doc
+        self.idle_ms = idle_ms
+        self._pending = None
+
+    def request(self, compute, render, coarse_level=None):
+        if not coarse_level or coarse_level == 1:
+            self.cancel()
+            render(compute(1))
+            return
+        render(compute(coarse_level))
+        self.defer(lambda: render(compute(1)))
+
+    def defer(self, callback):
+        self.cancel()
+
+        def _refine():
+            self._pending = None
+            callback()
+
+        self._pending = self.doc.add_timeout_callback(_refine, self.idle_ms)
+
+    def cancel(self):
+        if self._pending is not None:
+            try:
+                self.doc.remove_timeout_callback(self._pending)
+            except ValueError:
+                pass
+            self._pending = None
+
+
+class ReductionJob:
+    """One submitted reduction: its map, completion and cancellation state."""
+
+    def __init__(self, n_rows, n_slabs, reduce_rows, on_done, on_progress, on_error=None):
+        self.n_rows = n_rows
+        self.n_slabs = n_slabs
+        self.remaining = n_slabs
+        self.reduce_rows = reduce_rows
+        self.on_done = on_done
+        self.on_progress = on_progress
+        self.on_error = on_error
+        self.out = None
+        self.error = None
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+        self.last_progress = time.time()
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def wait(self, timeout=None):
+        """Wait for the reduction (not the on_done callback); returns the map, or None if cancelled or failed."""
+        self.finished.wait(timeout)
+        return None if self.cancelled.is_set() or self.error else self.out
+
+
+class ROIReductionEngine:
+    """
+    Reduces a volume in x-slabs on a thread pool without blocking the Bokeh session.
+
+    submit() splits the scan rows into slabs reduced by reduce_rows(lo, hi),
+    which returns the map rows lo:hi; rows not reduced yet are NaN. Partial
+    maps go to on_progress(map, fraction) at most every
+    REDUCE_PROGRESS_SECONDS and the final one to on_done(map), both through
+    doc.add_next_tick_callback (called from the pool thread without a doc).
+    When reduce_rows raises, the job stops and on_error(exception) is
+    dispatched the same way instead of on_done (once, for the first failing
+    slab). Submitting a new job cancels the one in flight: its remaining
+    slabs are skipped and nothing more is pushed for it. pool is the executor running
+    the slabs, usually shared by all sessions of the server process.
+    """
+
+    def __init__(self, pool, doc=None):
+        self.doc = doc
+        self.pool = pool
+        self._job = None
+
+    def submit(self, n_rows, slab_rows, reduce_rows, on_done, on_progress=None, on_error=None):
+        self.cancel()
+        slab_rows = max(1, int(slab_rows))
+        starts = range(0, n_rows, slab_rows)
+        job = ReductionJob(n_rows, len(starts), reduce_rows, on_done, on_progress, on_error)
+        self._job = job
+        if not starts:
+            job.out = np.empty((0,))
+            job.finished.set()
+            self._dispatch(lambda: self._finish(job))
+        for lo in starts:
+            self.pool.submit(self._run, job, lo, min(lo + slab_rows, n_rows))
+        return job
+
+    def cancel(self):
+        if self._job is not None:
+            self._job.cancel()
+            self._job = None
+
+    def _dispatch(self, callback):
+        if self.doc is None:
+            callback()
+        else:
+            self.doc.add_next_tick_callback(callback)
+
+    def _run(self, job, lo, hi):
+        if job.cancelled.is_set():
+            return
+        try:
+            block = np.asarray(job.reduce_rows(lo, hi), dtype=np.float64)
+        except Exception as e:
+            with job.lock:
+                # A job cancelled meanwhile (or already failed) reports nothing more
+                first = not job.cancelled.is_set()
+                if first:
+                    job.error = e
+                    job.cancel()
+            job.finished.set()
+            if first:
+                print(f"❌ ROI reduction failed: {e}")
+                if job.on_error is not None:
+                    self._dispatch(lambda error=e: job.on_error(error))
+            return
+        with job.lock:
+            if job.cancelled.is_set():
+                return
+            if job.out is None:
+                job.out = np.full((job.n_rows,) + block.shape[1:], np.nan)
+            job.out[lo:hi] = block
+            job.remaining -= 1
+            done = job.remaining == 0
+            progress = (not done and job.on_progress is not None
+                        and time.time() - job.last_progress >= REDUCE_PROGRESS_SECONDS)
+            if progress:
+                job.last_progress = time.time()
+                partial, fraction = job.out.copy(), 1 - job.remaining / job.n_slabs
+        if done:
+            job.finished.set()
+            self._dispatch(lambda: self._finish(job))
+        elif progress:
+            self._dispatch(lambda: None if job.cancelled.is_set() else job.on_progress(partial, fraction))
+
+    @staticmethod
+    def _finish(job):
+        if not job.cancelled.is_set():
+            job.on_done(job.out)
+
+
+def ratio_map(numerator, denominator):
+    """numerator / denominator as float32, NaN where the ratio is undefined (zero or non-finite inputs)."""
+    numerator = np.asarray(numerator)
+    denominator = np.asarray(denominator)
+    if numerator.shape != denominator.shape:
+        raise ValueError(f"Ratio of datasets with different shapes {numerator.shape} / {denominator.shape}")
+    out = np.full(numerator.shape, np.nan, dtype=np.float32)
+    valid = (denominator != 0) & np.isfinite(numerator) & np.isfinite(denominator)
+    np.divide(numerator, denominator, out=out, where=valid, casting='unsafe')
+    return out
+
+
+def nan_percentiles(data, q=RATIO_PERCENTILES):
+    """Percentiles of the finite values of data (all NaN when there are none)."""
+    finite = data[np.isfinite(data)]
+    if finite.size == 0:
+        return np.full(len(q), np.nan)
+    return np.percentile(finite, q)
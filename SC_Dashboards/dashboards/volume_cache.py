@@ -0,0 +1,1420 @@
+#!/usr/bin/env python3
+"""
+Volume caches and shared stores of the 4D dashboard
+
+The HDF5/NumPy side of the 4D dashboard: derived caches built next to the
+.nxs uploads (float32 memmaps, compact encodings, tiled caches, pyramid
+levels, summed-area tables), their fingerprints, the sidecar dataset index,
+the per-directory .nxs catalog, the SWMR tail of live scans, and the
+process-wide stores the Bokeh sessions share (SharedVolumeRegistry,
+ByteBudgetLRUCache). Nothing here imports Bokeh, so the worker processes
+started by the builders can import this module on their own.
+"""
+
+import collections
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+
+import h5py
+import numpy as np
+
+# Size of one x-slab copied per step when building the float32 volume cache
+VOLUME_CACHE_SLAB_BYTES = int(os.getenv('SC_4D_CACHE_SLAB_MB', '256')) * 1024 * 1024
+# Worker processes converting slabs in parallel (0 = one per core, at most 8; 1 = in-thread)
+VOLUME_CACHE_WORKERS = int(os.getenv('SC_4D_CACHE_WORKERS', '0')) or min(8, os.cpu_count() or 1)
+# Compact encodings of the volume cache and their storage dtypes; uint16 codes reserve one value for NaN
+QUANTIZED_ENCODINGS = {'float16': np.float16, 'uint16': np.uint16, 'log-uint16': np.uint16}
+UINT16_NAN_CODE = 65535
+# Largest finite float16; the float16 encoding refuses volumes with larger magnitudes (they would become inf)
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+# Default block edge along scan (x, y) and detector (z, u) axes of the tiled cache
+TILE_SCAN_EDGE = 8
+TILE_DETECTOR_EDGE = 64
+# Bumped when a transform's output changes, so artifacts written by older code are rebuilt
+CACHE_TRANSFORM_VERSIONS = {
+    'float32': 1, 'tiles': 1, 'pyramid': 1, 'float16': 1, 'uint16': 1, 'log-uint16': 1, 'sat': 1,
+    'azimuthal': 1,
+}
+# How often using an artifact refreshes its last-access time (fingerprint mtime) for the cache LRU
+ARTIFACT_TOUCH_SECONDS = 3600
+# Longest a load waits for a batched prefetch of the same dataset before reading it itself
+PREFETCH_WAIT_SECONDS = 30
+# Sidecar dataset index (<name>.choices.json) replacing the get_choices() walk
+DATASET_INDEX_VERSION = 1
+DATASET_INDEX_MAX_ATTR_ITEMS = 64
+# Per-directory catalog of .nxs files (scanned with VOLUME_CACHE_WORKERS processes)
+NEXUS_CATALOG_VERSION = 1
+NEXUS_CATALOG_MAX_VOLUMES = 4
+# Worker processes that report nothing for this long are considered hung and terminated
+WORKER_STALL_SECONDS = float(os.getenv('SC_4D_WORKER_STALL_SECONDS', '600'))
+# Live acquisition: the .nxs files may still be open for writing by an HDF5 SWMR writer
+LIVE_MODE = os.getenv('SC_4D_LIVE', '0') == '1'
+
+
+def worker_context():
+    """
+    multiprocessing context for the worker processes of the builders below.
+
+    The builders run in threads of the Bokeh server, and a child forked from
+    a threaded process can inherit locks (HDF5, logging, allocator) held by
+    another thread that will never release them. Workers are started with
+    forkserver (spawn where unavailable) instead and import their target
+    from this module, so its directory is kept on sys.path for them. The
+    fork server preloads this module, so workers start without importing
+    NumPy and h5py again.
+    """
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    if module_dir not in sys.path:
+        sys.path.append(module_dir)
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    ctx = multiprocessing.get_context('forkserver')
+    ctx.set_forkserver_preload([__name__])
+    return ctx
+
+
+def open_nexus(nexus_filename, live=LIVE_MODE):
+    """
+    Open a NeXus file read-only; in live mode as an HDF5 SWMR reader.
+
+    A file held open by an SWMR writer cannot be opened by a plain reader, so
+    every read of the source file goes through here. Files that were not
+    written in SWMR format (finished scans) fall back to a plain open.
+    """
+    if live:
+        try:
+            return h5py.File(nexus_filename, 'r', libver='latest', swmr=True)
+        except OSError:
+            pass
+    return h5py.File(nexus_filename, 'r')
+
+
+def _nexus_catalog_entry(nexus_filename):
+    """Summarize one NeXus file for the catalog; its dataset index sidecar is written on the way."""
+    entry = {'path': nexus_filename}
+    try:
+        stat = os.stat(nexus_filename)
+        entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        index = load_dataset_index(nexus_filename, os.path.splitext(nexus_filename)[0] + '.choices.json',
+                                   status_callback=lambda message: None)
+    except Exception as e:
+        entry['error'] = str(e)
+        return entry
+    volumes = sorted((d for d in index['datasets'] if len(d['shape']) >= 3),
+                     key=lambda d: int(np.prod(d['shape'])), reverse=True)
+    entry['datasets'] = len(index['datasets'])
+    entry['volumes'] = [{'path': d['path'], 'shape': list(d['shape'])} for d in volumes[:NEXUS_CATALOG_MAX_VOLUMES]]
+    return entry
+
+
+def _nexus_catalog_worker(tasks, done):
+    """Worker process: summarize the files taken from tasks until a None sentinel."""
+    for nexus_filename in iter(tasks.get, None):
+        done.put(_nexus_catalog_entry(nexus_filename))
+
+
+def build_nexus_catalog(directory, previous=None, workers=VOLUME_CACHE_WORKERS):
+    """
+    Catalog every .nxs file under directory (shape and summary metadata only).
+
+    Entries of previous whose file kept its size and mtime are reused; new or
+    changed files are opened by a pool of worker processes (see
+    worker_context()). Files a crashed or hung worker did not report are
+    scanned serially afterwards.
+    """
+    reuse = {entry['path']: entry for entry in (previous or {}).get('files', []) if 'error' not in entry}
+    paths = sorted(
+        os.path.join(dirpath, filename)
+        for dirpath, _dirnames, filenames in os.walk(directory)
+        for filename in filenames if filename.endswith('.nxs')
+    )
+    entries, todo = {}, []
+    for path in paths:
+        old = reuse.get(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if old is not None and old.get('size') == stat.st_size and old.get('mtime_ns') == stat.st_mtime_ns:
+            entries[path] = old
+        else:
+            todo.append(path)
+
+    workers = min(workers, len(todo))
+    if workers > 1:
+        ctx = worker_context()
+        tasks, done = ctx.Queue(), ctx.Queue()
+        for path in todo:
+            tasks.put(path)
+        for _ in range(workers):
+            tasks.put(None)
+        procs = [ctx.Process(target=_nexus_catalog_worker, args=(tasks, done), name="nexus-catalog-worker", daemon=True)
+                 for _ in range(workers)]
+        for proc in procs:
+            proc.start()
+        remaining = len(todo)
+        last_progress = time.time()
+        while remaining:
+            try:
+                entry = done.get(timeout=0.5)
+            except queue.Empty:
+                if not any(proc.is_alive() for proc in procs) or time.time() - last_progress > WORKER_STALL_SECONDS:
+                    break
+                continue
+            entries[entry['path']] = entry
+            remaining -= 1
+            last_progress = time.time()
+        for proc in procs:
+            if proc.is_alive() and remaining:
+                proc.terminate()
+            proc.join()
+    # Serial scan, also picking up whatever a crashed worker left behind
+    for path in todo:
+        if path not in entries:
+            entries[path] = _nexus_catalog_entry(path)
+
+    return {
+        'version': NEXUS_CATALOG_VERSION,
+        'directory': directory,
+        'built_at': time.time(),
+        'files': [entries[path] for path in paths if path in entries],
+    }
+
+
+def describe_catalog_entry(entry, directory=None):
+    """One-line label of a catalog entry for the file picker."""
+    label = os.path.relpath(entry['path'], directory) if directory else os.path.basename(entry['path'])
+    if 'error' in entry:
+        return f"{label} (unreadable)"
+    if entry['volumes']:
+        volume = entry['volumes'][0]
+        return f"{label} {tuple(volume['shape'])} {volume['path']}"
+    return f"{label} ({entry['datasets']} datasets)"
+
+
+def _normalize_index(key, ndim):
+    """Expand a NumPy-style index into a tuple with one entry per axis."""
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is Ellipsis for k in key):
+        i = next(i for i, k in enumerate(key) if k is Ellipsis)
+        key = key[:i] + (slice(None),) * (ndim - len(key) + 1) + key[i + 1:]
+    return key + (slice(None),) * (ndim - len(key))
+
+
+def _leading_rows(key, n):
+    """Return the [lo, hi) range of first-axis rows touched by an index."""
+    if not isinstance(key, tuple):
+        key = (key,)
+    if not key or key[0] is Ellipsis:
+        return 0, n
+    k = key[0]
+    if isinstance(k, slice):
+        rows = range(*k.indices(n))
+        if len(rows) == 0:
+            return 0, 0
+        return min(rows[0], rows[-1]), max(rows[0], rows[-1]) + 1
+    if isinstance(k, (int, np.integer)):
+        i = int(k) + n if k < 0 else int(k)
+        return i, i + 1
+    arr = np.asarray(k)
+    if arr.dtype == bool:
+        arr = np.nonzero(arr)[0]
+    if arr.size == 0:
+        return 0, 0
+    arr = np.where(arr < 0, arr + n, arr)
+    return int(arr.min()), int(arr.max()) + 1
+
+
+def bounded_read(dset, key, reader=None):
+    """
+    Read dset[key] for any NumPy-style index.
+
+    h5py (and TiledVolume) only support increasing slices, so we read the
+    bounding hyperslab and apply the original index to it in memory.
+    reader(bounds) overrides how the hyperslab is read (default: dset[bounds]).
+    """
+    bounds = []
+    local = []
+    for k, n in zip(_normalize_index(key, dset.ndim), dset.shape):
+        if isinstance(k, slice):
+            rows = range(*k.indices(n))
+            if len(rows) == 0:
+                bounds.append(slice(0, 0))
+                local.append(slice(None))
+            elif rows.step > 0:
+                bounds.append(slice(rows[0], rows[-1] + 1))
+                local.append(slice(None, None, rows.step))
+            else:
+                bounds.append(slice(rows[-1], rows[0] + 1))
+                local.append(slice(rows[0] - rows[-1], None, rows.step))
+        elif isinstance(k, (int, np.integer)):
+            i = int(k) + n if k < 0 else int(k)
+            bounds.append(slice(i, i + 1))
+            local.append(0)
+        else:
+            arr = np.asarray(k)
+            if arr.dtype == bool:
+                arr = np.nonzero(arr)[0]
+            arr = np.where(arr < 0, arr + n, arr)
+            lo = int(arr.min()) if arr.size else 0
+            hi = int(arr.max()) + 1 if arr.size else 0
+            bounds.append(slice(lo, hi))
+            local.append(arr - lo)
+    block = reader(tuple(bounds)) if reader is not None else dset[tuple(bounds)]
+    return block[tuple(local)]
+
+
+def open_contiguous_float32(nexus_filename, dataset_path, live=LIVE_MODE):
+    """
+    Memmap a dataset directly inside the HDF5 file, or return None.
+
+    Only datasets stored contiguous (not chunked, hence unfiltered), fully
+    allocated and as little-endian float32 qualify; they are byte-for-byte
+    what the float32 cache would contain.
+    """
+    with open_nexus(nexus_filename, live=live) as f:
+        dset = f[dataset_path]
+        if dset.chunks is not None or dset.external or dset.dtype != np.dtype('<f4'):
+            return None
+        offset = dset.id.get_offset()
+        if offset is None or dset.id.get_storage_size() != dset.size * 4:
+            return None
+        shape = tuple(dset.shape)
+    return np.memmap(nexus_filename, dtype='<f4', mode='r', offset=offset, shape=shape)
+
+
+def _volume_cache_worker(nexus_filename, dataset_path, out_filename, shape, slab_rows, tasks, done, live):
+    """
+    Process-pool worker: convert the slabs listed on tasks into out_filename.
+
+    Each slab is read (and decompressed/cast by HDF5) straight into a memmap
+    of its own region, which is flushed and dropped before the next one, so a
+    worker never holds more than one slab.
+    """
+    row_bytes = int(np.prod(shape[1:], dtype=np.int64)) * 4
+    try:
+        with open_nexus(nexus_filename, live=live) as f:
+            dset = f[dataset_path]
+            while True:
+                i = tasks.get()
+                if i is None:
+                    break
+                lo = i * slab_rows
+                hi = min(lo + slab_rows, shape[0])
+                region = np.memmap(out_filename, dtype=np.float32, mode='r+',
+                                   offset=lo * row_bytes, shape=(hi - lo,) + tuple(shape[1:]))
+                dset.read_direct(region, source_sel=np.s_[lo:hi])
+                region.flush()
+                del region
+                done.put(('done', i))
+    except Exception as e:
+        done.put(('error', f"{type(e).__name__}: {e}"))
+
+
+class ProgressiveVolumeCache:
+    """
+    Builds the float32 memmap cache of one HDF5 volume in a background thread.
+
+    The volume is copied slab by slab along x into a private partial file that
+    is renamed into place once complete. Until then, read() serves rows whose
+    slabs are finished from the partial memmap and everything else straight
+    from the HDF5 file, so plots are usable while the cache is being built.
+
+    With workers > 1 the slabs are converted by a pool of worker processes
+    (see worker_context()), since decompressing gzip/LZ4 chunks is CPU-bound.
+    A slab is at most slab_bytes (but at least one scan row), so a build
+    touches at most workers x slab_bytes of the cache at a time. Slabs hold
+    whole chunks when a row of chunks fits in slab_bytes; larger chunks are
+    decoded once by every slab they straddle. The build fails when no slab
+    finishes for WORKER_STALL_SECONDS.
+    """
+
+    def __init__(self, nexus_filename, dataset_path, mmap_filename,
+                 status_callback=None, slab_bytes=VOLUME_CACHE_SLAB_BYTES, on_complete=None,
+                 workers=VOLUME_CACHE_WORKERS, fingerprint=None, live=LIVE_MODE):
+        self.nexus_filename = nexus_filename
+        self.dataset_path = dataset_path
+        self.mmap_filename = mmap_filename
+        self.on_complete = on_complete
+        self.fingerprint = fingerprint
+        # Private name so concurrent builders never write into the same file
+        self.partial_filename = f"{mmap_filename}.partial-{os.getpid()}-{id(self)}"
+        self.status_callback = status_callback or print
+        self.live = live
+        with open_nexus(nexus_filename, live=live) as f:
+            self.shape = tuple(f[dataset_path].shape)
+            chunk_rows = f[dataset_path].chunks[0] if f[dataset_path].chunks else 1
+        row_bytes = int(np.prod(self.shape[1:], dtype=np.int64)) * 4
+        self.slab_rows = max(1, int(slab_bytes // max(row_bytes, 1)))
+        # Whole chunks per slab when they fit, so no compressed chunk is decoded by two workers
+        if chunk_rows <= self.slab_rows:
+            self.slab_rows = self.slab_rows // chunk_rows * chunk_rows
+        self.n_slabs = -(-self.shape[0] // self.slab_rows)
+        self.workers = max(1, min(int(workers), self.n_slabs))
+        self.error = None
+        self._slab_done = np.zeros(self.n_slabs, dtype=bool)
+        self._cancel = threading.Event()
+        self._h5_lock = threading.Lock()
+        self._h5 = None
+        self._thread = None
+        self._partial_memmap = None
+        self._final_memmap = None
+
+    @property
+    def complete(self):
+        return self._final_memmap is not None
+
+    @property
+    def progress(self):
+        """Fraction of slabs written so far (0.0 - 1.0)."""
+        if self.complete:
+            return 1.0
+        return float(self._slab_done.mean()) if self.n_slabs else 0.0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._build,
+                name=f"volume-cache:{self.dataset_path}",
+                daemon=True,
+            )
+            self._thread.start()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def rows_ready(self, lo, hi):
+        """True when every slab covering rows [lo, hi) has been written."""
+        if hi <= lo:
+            return False
+        return bool(self._slab_done[lo // self.slab_rows:(hi - 1) // self.slab_rows + 1].all())
+
+    def volume(self):
+        """Return the finished memmap, or a ProgressiveVolume while building."""
+        if self.complete:
+            return self._final_memmap
+        return ProgressiveVolume(self)
+
+    def read(self, key):
+        if self._final_memmap is not None:
+            return self._final_memmap[key]
+        lo, hi = _leading_rows(key, self.shape[0])
+        if self._partial_memmap is not None and self.rows_ready(lo, hi):
+            return np.array(self._partial_memmap[key])
+        with self._h5_lock:
+            if self._h5 is None:
+                self._h5 = open_nexus(self.nexus_filename, live=self.live)
+            data = bounded_read(self._h5[self.dataset_path], key)
+        return np.asarray(data, dtype=np.float32)
+
+    def _close_hdf5(self):
+        with self._h5_lock:
+            if self._h5 is not None:
+                self._h5.close()
+                self._h5 = None
+
+    def _slab_finished(self, i, t0):
+        self._slab_done[i] = True
+        done = int(self._slab_done.sum())
+        if done < self.n_slabs and done * 10 // self.n_slabs > (done - 1) * 10 // self.n_slabs:
+            self.status_callback(f"⏳ Volume cache {self.dataset_path}: {done / self.n_slabs:.0%} ({time.time() - t0:.1f}s)")
+
+    def _copy_slabs(self, out, t0):
+        with open_nexus(self.nexus_filename, live=self.live) as f:
+            dset = f[self.dataset_path]
+            for i in range(self.n_slabs):
+                if self._cancel.is_set():
+                    raise RuntimeError("cancelled")
+                lo = i * self.slab_rows
+                hi = min(lo + self.slab_rows, self.shape[0])
+                # HDF5 casts to float32 while reading straight into the memmap
+                dset.read_direct(out, source_sel=np.s_[lo:hi], dest_sel=np.s_[lo:hi])
+                self._slab_finished(i, t0)
+
+    def _copy_slabs_parallel(self, t0):
+        ctx = worker_context()
+        tasks, done = ctx.Queue(), ctx.Queue()
+        for i in range(self.n_slabs):
+            tasks.put(i)
+        for _ in range(self.workers):
+            tasks.put(None)
+        procs = [
+            ctx.Process(
+                target=_volume_cache_worker,
+                args=(self.nexus_filename, self.dataset_path, self.partial_filename,
+                      self.shape, self.slab_rows, tasks, done, self.live),
+                name=f"volume-cache-worker:{self.dataset_path}",
+                daemon=True,
+            )
+            for _ in range(self.workers)
+        ]
+        for proc in procs:
+            proc.start()
+        try:
+            remaining = self.n_slabs
+            last_progress = time.time()
+            while remaining:
+                if self._cancel.is_set():
+                    raise RuntimeError("cancelled")
+                try:
+                    kind, value = done.get(timeout=0.5)
+                except queue.Empty:
+                    if any(proc.exitcode not in (None, 0) for proc in procs):
+                        raise RuntimeError("a volume cache worker died")
+                    if not any(proc.is_alive() for proc in procs):
+                        raise RuntimeError("volume cache workers exited early")
+                    if time.time() - last_progress > WORKER_STALL_SECONDS:
+                        raise RuntimeError(f"no slab finished in {WORKER_STALL_SECONDS:.0f}s")
+                    continue
+                if kind == 'error':
+                    raise RuntimeError(value)
+                self._slab_finished(value, t0)
+                remaining -= 1
+                last_progress = time.time()
+        finally:
+            for proc in procs:
+                if proc.is_alive() and remaining:
+                    proc.terminate()
+                proc.join()
+
+    def _build(self):
+        t0 = time.time()
+        self.status_callback(f"⏳ Building volume cache for {self.dataset_path} {self.shape} in the background"
+                             + (f" ({self.workers} workers)" if self.workers > 1 else ""))
+        try:
+            out = np.memmap(self.partial_filename, dtype=np.float32, mode='w+', shape=self.shape)
+            self._partial_memmap = np.memmap(self.partial_filename, dtype=np.float32, mode='r', shape=self.shape)
+            if self.workers > 1:
+                del out
+                self._copy_slabs_parallel(t0)
+            else:
+                self._copy_slabs(out, t0)
+                out.flush()
+                del out
+            os.replace(self.partial_filename, self.mmap_filename)
+            if self.fingerprint is not None:
+                write_fingerprint(self.mmap_filename, self.fingerprint)
+            self._final_memmap = np.memmap(self.mmap_filename, dtype=np.float32, mode='r', shape=self.shape)
+            self._partial_memmap = None
+            self.status_callback(f"✅ Volume cache ready for {self.dataset_path} ({time.time() - t0:.1f}s)")
+            if self.on_complete is not None:
+                try:
+                    self.on_complete(self._final_memmap)
+                except Exception as e:
+                    print(f"⚠️ Volume cache on_complete for {self.dataset_path} failed: {e}")
+        except Exception as e:
+            self.error = e
+            self.status_callback(f"❌ Volume cache build for {self.dataset_path} stopped: {e}")
+            try:
+                os.remove(self.partial_filename)
+            except OSError:
+                pass
+        finally:
+            self._close_hdf5()
+
+
+class ProgressiveVolume:
+    """Read-only, NumPy-indexable view of a volume whose cache is still being built."""
+
+    def __init__(self, cache):
+        self._cache = cache
+        self.shape = cache.shape
+        self.ndim = len(cache.shape)
+        self.dtype = np.dtype(np.float32)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self._cache.read(key)
+
+    def __array__(self, dtype=None, copy=None):
+        data = np.asarray(self._cache.read(Ellipsis))
+        return data.astype(dtype) if dtype is not None else data
+
+
+def _quantize(block, encoding, scale, offset):
+    """Encode a float block (see QuantizedVolume for the encodings)."""
+    if encoding == 'float16':
+        return block.astype(np.float16)
+    values = np.asarray(block, dtype=np.float64) - offset
+    nan = np.isnan(values)
+    if encoding == 'log-uint16':
+        values = np.log1p(np.maximum(values, 0))
+    codes = np.clip(np.rint(values / scale), 0, UINT16_NAN_CODE - 1)
+    codes[nan] = UINT16_NAN_CODE
+    return codes.astype(np.uint16)
+
+
+def _dequantize(codes, encoding, scale, offset):
+    codes = np.asarray(codes)
+    if encoding == 'float16':
+        return codes.astype(np.float32)
+    # In place, so 0-d selections stay arrays
+    out = codes.astype(np.float32)
+    out *= np.float32(scale)
+    if encoding == 'log-uint16':
+        np.expm1(out, out=out)
+    out += np.float32(offset)
+    out[codes == UINT16_NAN_CODE] = np.nan
+    return out
+
+
+def write_quantized_volume(source, filename, encoding, status_callback=None, slab_bytes=VOLUME_CACHE_SLAB_BYTES):
+    """
+    Write source (a float volume) with a compact encoding and return it as a QuantizedVolume.
+
+    The scaled encodings first scan source for its range. Every slab is
+    decoded again after encoding to measure the max absolute quantization
+    error, which is stored in the <filename>.json sidecar next to the scale
+    and offset. Raises ValueError, leaving no file behind, when a finite
+    value cannot be represented (float16 beyond +-FLOAT16_MAX).
+    """
+    status_callback = status_callback or print
+    shape = tuple(source.shape)
+    row_items = int(np.prod(shape[1:], dtype=np.int64))
+    slab_rows = max(1, int(slab_bytes // max(row_items * 4, 1)))
+    slabs = [(lo, min(lo + slab_rows, shape[0])) for lo in range(0, shape[0], slab_rows)]
+    vmin, vmax = np.inf, -np.inf
+    scale, offset = 1.0, 0.0
+    if encoding != 'float16':
+        for lo, hi in slabs:
+            block = np.asarray(source[lo:hi])
+            if np.isfinite(block).any():
+                vmin = min(vmin, float(np.nanmin(block[np.isfinite(block)])))
+                vmax = max(vmax, float(np.nanmax(block[np.isfinite(block)])))
+        if not np.isfinite(vmin):
+            vmin, vmax = 0.0, 0.0
+        offset = vmin
+        span = np.log1p(vmax - vmin) if encoding == 'log-uint16' else vmax - vmin
+        scale = float(span / (UINT16_NAN_CODE - 1)) if span > 0 else 1.0
+    partial_filename = f"{filename}.partial-{os.getpid()}"
+    max_error = 0.0
+    out = np.memmap(partial_filename, dtype=QUANTIZED_ENCODINGS[encoding], mode='w+', shape=shape)
+    try:
+        for lo, hi in slabs:
+            block = np.asarray(source[lo:hi], dtype=np.float32)
+            finite = np.isfinite(block)
+            if encoding == 'float16' and finite.any():
+                # The range comes with the write here; the encoding has no scale to fit it
+                vmin = min(vmin, float(block[finite].min()))
+                vmax = max(vmax, float(block[finite].max()))
+                if max(-vmin, vmax) > FLOAT16_MAX:
+                    raise ValueError(f"values up to {max(-vmin, vmax):.6g} exceed the float16 range "
+                                     f"(+-{FLOAT16_MAX:g}), use the uint16 or log-uint16 encoding")
+            out[lo:hi] = _quantize(block, encoding, scale, offset)
+            decoded = _dequantize(out[lo:hi], encoding, scale, offset)[finite]
+            if not np.isfinite(decoded).all():
+                # A finite value decoded to inf/NaN is lost, however small the other errors are
+                max_error = np.inf
+            elif decoded.size:
+                max_error = max(max_error, float(np.abs(decoded - block[finite]).max()))
+        if not np.isfinite(max_error):
+            raise ValueError(f"the {encoding} encoding cannot represent every finite value of the volume")
+        out.flush()
+        del out
+        os.replace(partial_filename, filename)
+    except BaseException:
+        try:
+            os.remove(partial_filename)
+        except OSError:
+            pass
+        raise
+    if not np.isfinite(vmin):
+        vmin, vmax = 0.0, 0.0
+    meta = {
+        'encoding': encoding,
+        'shape': list(shape),
+        'scale': scale,
+        'offset': offset,
+        'min': vmin,
+        'max': vmax,
+        'max_error': max_error,
+    }
+    with open(f"{partial_filename}.json", 'w') as fp:
+        json.dump(meta, fp)
+    # The sidecar is the commit point: readers ignore data files without one
+    os.replace(f"{partial_filename}.json", f"{filename}.json")
+    return QuantizedVolume(filename)
+
+
+class QuantizedVolume:
+    """
+    Read-only float32 view of a volume cache stored with a compact encoding.
+
+    Encodings (described by the <filename>.json sidecar):
+      float16     - values stored as float16
+      uint16      - round((v - offset) / scale), linear over the data range
+      log-uint16  - round(log1p(v - offset) / scale), for detector counts
+    For the uint16 encodings, code 65535 stores NaN. Indexing decodes only
+    the elements selected.
+    """
+
+    def __init__(self, filename):
+        with open(f"{filename}.json", 'r') as fp:
+            meta = json.load(fp)
+        self.filename = filename
+        self.encoding = meta['encoding']
+        self.scale = meta['scale']
+        self.offset = meta['offset']
+        self.max_error = meta['max_error']
+        self.shape = tuple(meta['shape'])
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(np.float32)
+        self._codes = np.memmap(filename, dtype=QUANTIZED_ENCODINGS[self.encoding], mode='r', shape=self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    @property
+    def stored_nbytes(self):
+        return self._codes.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        data = _dequantize(self._codes[key], self.encoding, self.scale, self.offset)
+        return data[()] if data.ndim == 0 else data
+
+    def __array__(self, dtype=None, copy=None):
+        data = _dequantize(self._codes, self.encoding, self.scale, self.offset)
+        return data.astype(dtype) if dtype is not None else data
+
+
+def bin_mean(block, factor, axes=None):
+    """Mean-bin every axis of block (or only axes) by factor (a short last bin averages what is left)."""
+    out = block.astype(np.float64)
+    counts = np.ones((), dtype=np.float64)
+    for axis, n in enumerate(block.shape):
+        if axes is not None and axis not in axes:
+            counts = np.multiply.outer(counts, np.ones(n))
+            continue
+        starts = np.arange(0, n, factor)
+        out = np.add.reduceat(out, starts, axis=axis)
+        sizes = np.diff(np.append(starts, n)).astype(np.float64)
+        counts = np.multiply.outer(counts, sizes)
+    return (out / counts).astype(np.float32)
+
+
+def build_volume_pyramid(source, filenames, status_callback=None, slab_bytes=VOLUME_CACHE_SLAB_BYTES):
+    """
+    Write mean-binned copies of a volume in a single pass over it.
+
+    filenames maps a binning factor to its output memmap filename. Every axis
+    (scan and detector) is binned by the factor. Slabs along x are a multiple
+    of the largest factor so each level is written from whole bins.
+    """
+    shape = tuple(source.shape)
+    max_factor = max(filenames)
+    row_bytes = int(np.prod(shape[1:], dtype=np.int64)) * 4
+    slab_rows = max(max_factor, int(slab_bytes // max(row_bytes, 1)) // max_factor * max_factor)
+    partials = {f: f"{name}.partial-{os.getpid()}-{id(source)}" for f, name in filenames.items()}
+    try:
+        levels = {
+            f: np.memmap(partials[f], dtype=np.float32, mode='w+', shape=tuple(-(-n // f) for n in shape))
+            for f in filenames
+        }
+        next_report = 0.25
+        for lo in range(0, shape[0], slab_rows):
+            hi = min(lo + slab_rows, shape[0])
+            slab = np.asarray(source[lo:hi], dtype=np.float32)
+            for f, level in levels.items():
+                binned = bin_mean(slab, f)
+                level[lo // f:lo // f + binned.shape[0]] = binned
+            if status_callback and hi / shape[0] >= next_report and hi < shape[0]:
+                status_callback(f"⏳ Volume pyramid: {hi / shape[0]:.0%}")
+                next_report += 0.25
+        for f, level in levels.items():
+            level.flush()
+        del levels
+        for f, name in filenames.items():
+            os.replace(partials[f], name)
+    except Exception:
+        for partial in partials.values():
+            try:
+                os.remove(partial)
+            except OSError:
+                pass
+        raise
+
+
+def interactive_level(full_nbytes, level_nbytes, budget_bytes):
+    """
+    Finest pyramid factor cheap enough to read on every drag event.
+
+    level_nbytes maps the factors built so far to their size in bytes. 1 (full
+    resolution) when the volume fits budget_bytes or no level is built yet;
+    the coarsest built level when none fits.
+    """
+    if full_nbytes <= budget_bytes or not level_nbytes:
+        return 1
+    for factor in sorted(level_nbytes):
+        if level_nbytes[factor] <= budget_bytes:
+            return factor
+    return max(level_nbytes)
+
+
+def detector_axes(ndim):
+    """Number of trailing detector axes of a volume: (z, u) for 4D, z for 3D."""
+    return 2 if ndim >= 4 else 1
+
+
+def build_summed_area_table(source, filename, factor=1, status_callback=None, slab_bytes=VOLUME_CACHE_SLAB_BYTES):
+    """
+    Write the summed-area table of a volume over its detector axes, in one pass.
+
+    For a 4D (x, y, z, u) volume table[x, y, i, j] is the sum of
+    volume[x, y, :i*factor, :j*factor]; for a 3D volume it is the cumulative
+    sum along z. The leading zero row/column makes any ROI sum a fixed number
+    of lookups per scan point (see summed_area_sum()).
+    """
+    shape = tuple(source.shape)
+    n_det = detector_axes(len(shape))
+    n_scan = len(shape) - n_det
+    table_shape = shape[:n_scan] + tuple(-(-n // factor) + 1 for n in shape[n_scan:])
+    row_bytes = int(np.prod(table_shape[1:], dtype=np.int64)) * 8
+    slab_rows = max(1, int(slab_bytes // max(row_bytes, 1)))
+    partial_filename = f"{filename}.partial-{os.getpid()}-{id(source)}"
+    try:
+        table = np.memmap(partial_filename, dtype=np.float64, mode='w+', shape=table_shape)
+        next_report = 0.25
+        for lo in range(0, shape[0], slab_rows):
+            hi = min(lo + slab_rows, shape[0])
+            slab = np.asarray(source[lo:hi], dtype=np.float64)
+            for axis in range(n_scan, len(shape)):
+                if factor > 1:
+                    slab = np.add.reduceat(slab, np.arange(0, shape[axis], factor), axis=axis)
+                np.cumsum(slab, axis=axis, out=slab)
+            table[(slice(lo, hi),) + (slice(None),) * (n_scan - 1) + (slice(1, None),) * n_det] = slab
+            if status_callback and hi / shape[0] >= next_report and hi < shape[0]:
+                status_callback(f"⏳ ROI summed-area table: {hi / shape[0]:.0%}")
+                next_report += 0.25
+        table.flush()
+        del table
+        os.replace(partial_filename, filename)
+    except Exception:
+        try:
+            os.remove(partial_filename)
+        except OSError:
+            pass
+        raise
+
+
+def summed_area_sum(table, ranges, factor=1):
+    """
+    ROI sum map over the scan axes from a summed-area table.
+
+    ranges holds one full-resolution (lo, hi) pair per detector axis; with
+    factor > 1 they are snapped outwards to whole bins.
+    """
+    bounds = []
+    for (lo, hi), n in zip(ranges, table.shape[table.ndim - len(ranges):]):
+        a = min(max(int(lo) // factor, 0), n - 1)
+        bounds.append((a, min(max(-(-int(hi) // factor), a), n - 1)))
+    total = np.zeros(table.shape[:table.ndim - len(ranges)], dtype=np.float64)
+    for corner in itertools.product((0, 1), repeat=len(ranges)):
+        index = (Ellipsis,) + tuple(b[c] for b, c in zip(bounds, corner))
+        if (len(ranges) - sum(corner)) % 2:
+            total -= table[index]
+        else:
+            total += table[index]
+    return total
+
+
+class TiledVolume:
+    """
+    Read-only float32 volume stored on disk as (x, y, z, u) blocks.
+
+    File layout: 8-byte magic, little-endian uint64 header length, a JSON
+    header (shape, block_shape, grid), an int64 table with the byte offset of
+    every block, then the blocks in grid C-order, each stored C-contiguous.
+    A probe read touches one contiguous run per detector block, and an ROI
+    reduction only touches the blocks that overlap the ROI.
+    """
+
+    MAGIC = b'SC4DTIL1'
+    ALIGN = 4096
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            if f.read(8) != self.MAGIC:
+                raise ValueError(f"Not a tiled volume cache: {filename}")
+            header_len = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(header_len).decode('utf-8'))
+        self.shape = tuple(header['shape'])
+        self.block_shape = tuple(header['block_shape'])
+        self.grid = tuple(header['grid'])
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(np.float32)
+        self._mm = np.memmap(filename, dtype=np.uint8, mode='r')
+        self._offsets = np.frombuffer(self._mm, dtype='<i8', count=int(np.prod(self.grid)), offset=16 + header_len)
+
+    @staticmethod
+    def default_block_shape(shape):
+        """Small blocks along the scan axes, large blocks along the detector axes (see detector_axes())."""
+        n_scan = len(shape) - detector_axes(len(shape))
+        edges = [TILE_SCAN_EDGE] * n_scan + [TILE_DETECTOR_EDGE] * (len(shape) - n_scan)
+        return tuple(min(e, n) for e, n in zip(edges, shape))
+
+    @classmethod
+    def write(cls, filename, source, block_shape=None, status_callback=None):
+        """Write source (h5py dataset or array-like, 3D/4D) as a tiled cache file."""
+        shape = tuple(source.shape)
+        block_shape = tuple(min(b, n) for b, n in zip(block_shape or cls.default_block_shape(shape), shape))
+        grid = tuple(-(-n // b) for n, b in zip(shape, block_shape))
+        header = json.dumps({'shape': shape, 'block_shape': block_shape, 'grid': grid, 'dtype': '<f4'}).encode('utf-8')
+        n_blocks = int(np.prod(grid))
+        table_start = 16 + len(header)
+        data_start = -(-(table_start + 8 * n_blocks) // cls.ALIGN) * cls.ALIGN
+        offsets = np.empty(n_blocks, dtype='<i8')
+        pos = data_start
+        for i, bidx in enumerate(np.ndindex(*grid)):
+            offsets[i] = pos
+            pos += int(np.prod([min(b, n - g * b) for g, b, n in zip(bidx, block_shape, shape)])) * 4
+
+        partial = f"{filename}.partial-{os.getpid()}-{id(source)}"
+        try:
+            mm = np.memmap(partial, dtype=np.uint8, mode='w+', shape=(pos,))
+            mm[:8] = np.frombuffer(cls.MAGIC, dtype=np.uint8)
+            mm[8:16] = np.frombuffer(np.array([len(header)], dtype='<u8').tobytes(), dtype=np.uint8)
+            mm[16:table_start] = np.frombuffer(header, dtype=np.uint8)
+            mm[table_start:table_start + 8 * n_blocks] = offsets.view(np.uint8)
+
+            # Read one group of scan blocks (all detector pixels) at a time and split it
+            n_outer = len(shape) - 2
+            outer_grid = grid[:n_outer]
+            n_outer_groups = int(np.prod(outer_grid))
+            next_report = 0.1
+            for gi, outer in enumerate(np.ndindex(*outer_grid)):
+                sl = tuple(slice(g * b, min((g + 1) * b, n)) for g, b, n in zip(outer, block_shape, shape))
+                chunk = np.asarray(source[sl], dtype=np.float32)
+                for inner in np.ndindex(*grid[n_outer:]):
+                    lin = int(np.ravel_multi_index(outer + inner, grid))
+                    isl = tuple(
+                        slice(g * b, min((g + 1) * b, n))
+                        for g, b, n in zip(inner, block_shape[n_outer:], shape[n_outer:])
+                    )
+                    block = np.ascontiguousarray(chunk[(slice(None),) * n_outer + isl])
+                    mm[offsets[lin]:offsets[lin] + block.nbytes] = block.view(np.uint8).ravel()
+                done = (gi + 1) / n_outer_groups
+                if status_callback and done >= next_report and gi + 1 < n_outer_groups:
+                    status_callback(f"⏳ Tiled volume cache {os.path.basename(filename)}: {done:.0%}")
+                    next_report += 0.1
+            mm.flush()
+            del mm
+            os.replace(partial, filename)
+        except Exception:
+            try:
+                os.remove(partial)
+            except OSError:
+                pass
+            raise
+        return cls(filename)
+
+    def _block(self, bidx):
+        extent = tuple(min(b, n - g * b) for g, b, n in zip(bidx, self.block_shape, self.shape))
+        offset = int(self._offsets[int(np.ravel_multi_index(bidx, self.grid))])
+        return np.ndarray(extent, dtype=np.float32, buffer=self._mm, offset=offset)
+
+    def _overlaps(self, bounds):
+        """Yield (block, src, dst) for every block overlapping a region of step-1 slices."""
+        spans = [range(*s.indices(n)) for s, n in zip(bounds, self.shape)]
+        for bidx in itertools.product(*[
+            range(r.start // b, (r.stop - 1) // b + 1) if len(r) else range(0)
+            for r, b in zip(spans, self.block_shape)
+        ]):
+            src = []
+            dst = []
+            for g, b, r in zip(bidx, self.block_shape, spans):
+                lo = max(r.start, g * b)
+                hi = min(r.stop, (g + 1) * b)
+                src.append(slice(lo - g * b, hi - g * b))
+                dst.append(slice(lo - r.start, hi - r.start))
+            yield self._block(bidx), tuple(src), tuple(dst)
+
+    def read_region(self, bounds):
+        """Read a region given as one step-1 slice per axis."""
+        bounds = _normalize_index(bounds, self.ndim)
+        out = np.empty([len(range(*s.indices(n))) for s, n in zip(bounds, self.shape)], dtype=np.float32)
+        for block, src, dst in self._overlaps(bounds):
+            out[dst] = block[src]
+        return out
+
+    def reduce_sum(self, bounds, axes):
+        """Sum a region over axes, reading only the blocks that overlap it."""
+        bounds = _normalize_index(bounds, self.ndim)
+        axes = tuple(sorted(a % self.ndim for a in axes))
+        keep = [i for i in range(self.ndim) if i not in axes]
+        extents = [len(range(*s.indices(n))) for s, n in zip(bounds, self.shape)]
+        out = np.zeros([extents[i] for i in keep], dtype=np.float64)
+        for block, src, dst in self._overlaps(bounds):
+            out[tuple(dst[i] for i in keep)] += block[src].sum(axis=axes, dtype=np.float64)
+        return out
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return bounded_read(self, key, reader=self.read_region)
+
+
+def json_attr(value):
+    """Convert an HDF5 attribute value to something json.dump() accepts."""
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, np.ndarray):
+        return [json_attr(v) for v in value.ravel()[:DATASET_INDEX_MAX_ATTR_ITEMS]]
+    if isinstance(value, np.generic):
+        return json_attr(value.item())
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+def build_dataset_index(nexus_filename, live=LIVE_MODE):
+    """Walk the HDF5 hierarchy once and describe every dataset in it."""
+    stat = os.stat(nexus_filename)
+    datasets = []
+
+    def _visit(name, obj):
+        if not isinstance(obj, h5py.Dataset):
+            return
+        try:
+            attrs = {key: json_attr(obj.attrs[key]) for key in obj.attrs}
+        except Exception:
+            attrs = {}
+        datasets.append({
+            'path': name,
+            'shape': list(obj.shape),
+            'dtype': obj.dtype.str,
+            'chunks': list(obj.chunks) if obj.chunks else None,
+            'compression': obj.compression,
+            'attrs': attrs,
+        })
+
+    with open_nexus(nexus_filename, live=live) as f:
+        f.visititems(_visit)
+    return {
+        'version': DATASET_INDEX_VERSION,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'datasets': datasets,
+    }
+
+
+def dataset_index_is_current(index, nexus_filename):
+    """True when index was built from the current version (size and mtime) of nexus_filename."""
+    stat = os.stat(nexus_filename)
+    return (index.get('version') == DATASET_INDEX_VERSION
+            and index.get('size') == stat.st_size
+            and index.get('mtime_ns') == stat.st_mtime_ns)
+
+
+def load_dataset_index(nexus_filename, index_filename, status_callback=None, live=LIVE_MODE):
+    """
+    Return the dataset index of a NeXus file, reading the sidecar when it is current.
+
+    Otherwise the file is walked and the sidecar is (re)written; an unwritable
+    directory only costs the walk on every open. Shapes and chunks come back
+    as tuples, like the base class reports them.
+    """
+    status_callback = status_callback or print
+    index = None
+    try:
+        with open(index_filename, 'r') as fp:
+            index = json.load(fp)
+        if not dataset_index_is_current(index, nexus_filename):
+            index = None
+    except (OSError, ValueError):
+        index = None
+    if index is None:
+        t0 = time.time()
+        index = build_dataset_index(nexus_filename, live=live)
+        partial_filename = f"{index_filename}.partial-{os.getpid()}"
+        try:
+            with open(partial_filename, 'w') as fp:
+                json.dump(index, fp)
+            os.replace(partial_filename, index_filename)
+        except OSError as e:
+            print(f"⚠️ Could not write dataset index {index_filename}: {e}")
+        status_callback(f"✅ Indexed {len(index['datasets'])} datasets ({time.time() - t0:.1f}s)")
+    for entry in index['datasets']:
+        entry['shape'] = tuple(entry['shape'])
+        entry['chunks'] = tuple(entry['chunks']) if entry['chunks'] else None
+    return index
+
+
+class LiveVolumeTail:
+    """
+    Follows a NeXus file that is still being written (HDF5 SWMR) and appends new scan rows.
+
+    The volume and the auxiliary datasets (maps, coordinates) are expected to
+    grow along their first axis. poll() refreshes them, appends new volume
+    rows to a growing float32 cache file (viewed through LiveVolume) and
+    extends the auxiliary arrays by their new rows only.
+    """
+
+    def __init__(self, nexus_filename, dataset_path, cache_filename, aux_paths=()):
+        self.nexus_filename = nexus_filename
+        self.dataset_path = dataset_path
+        self.cache_filename = cache_filename
+        self._lock = threading.Lock()
+        self._h5 = h5py.File(nexus_filename, 'r', libver='latest', swmr=True)
+        self._dset = self._h5[dataset_path]
+        self.row_shape = tuple(self._dset.shape[1:])
+        self.rows = 0
+        self._aux_dsets = {path: self._h5[path] for path in aux_paths if path in self._h5}
+        self.aux = {path: np.empty((0,) + dset.shape[1:], dtype=dset.dtype) for path, dset in self._aux_dsets.items()}
+        self._memmap = None
+        open(cache_filename, 'wb').close()
+        self.volume = LiveVolume(self)
+
+    def poll(self):
+        """Read rows added since the last poll; returns the (old, new) row counts."""
+        with self._lock:
+            old = self.rows
+            self._dset.refresh()
+            n = self._dset.shape[0]
+            for path, dset in self._aux_dsets.items():
+                dset.refresh()
+                have = len(self.aux[path])
+                if dset.shape[0] > have:
+                    self.aux[path] = np.concatenate([self.aux[path], dset[have:]])
+            if n > old:
+                block = np.empty((n - old,) + self.row_shape, dtype=np.float32)
+                self._dset.read_direct(block, source_sel=np.s_[old:n])
+                with open(self.cache_filename, 'r+b') as fp:
+                    fp.seek(old * block[0].nbytes)
+                    fp.write(block.tobytes())
+                self._memmap = np.memmap(self.cache_filename, dtype=np.float32, mode='r', shape=(n,) + self.row_shape)
+                self.rows = n
+            return old, self.rows
+
+    def close(self):
+        with self._lock:
+            self._h5.close()
+
+
+class LiveVolume:
+    """Read-only, NumPy-indexable view of the rows a LiveVolumeTail has received so far."""
+
+    def __init__(self, tail):
+        self._tail = tail
+        self.ndim = 1 + len(tail.row_shape)
+        self.dtype = np.dtype(np.float32)
+
+    @property
+    def shape(self):
+        return (self._tail.rows,) + self._tail.row_shape
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self._tail.rows
+
+    def __getitem__(self, key):
+        data = self._tail._memmap
+        if data is None:
+            return np.empty((0,) + self._tail.row_shape, dtype=np.float32)[key]
+        return data[key]
+
+    def __array__(self, dtype=None, copy=None):
+        data = np.asarray(self[...])
+        return data.astype(dtype) if dtype is not None else data
+
+
+def artifact_fingerprint(nexus_filename, dataset_path, shape, dtype, transform):
+    """Describe what a derived artifact was built from: source size/mtime, dataset, shape, dtype and transform version."""
+    stat = os.stat(nexus_filename)
+    return {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'dataset': dataset_path,
+        'shape': [int(n) for n in shape],
+        'dtype': np.dtype(dtype).str,
+        'transform': transform,
+        'version': CACHE_TRANSFORM_VERSIONS[transform],
+    }
+
+
+def write_fingerprint(artifact_filename, fingerprint):
+    """Tag an artifact with its <artifact>.meta.json fingerprint (write it after the artifact itself)."""
+    partial_filename = f"{artifact_filename}.meta.json.partial-{os.getpid()}"
+    with open(partial_filename, 'w') as fp:
+        json.dump(fingerprint, fp)
+    os.replace(partial_filename, f"{artifact_filename}.meta.json")
+
+
+def touch_artifact(artifact_filename):
+    """Record a use of an artifact for the derived cache LRU (at most every ARTIFACT_TOUCH_SECONDS)."""
+    meta_filename = f"{artifact_filename}.meta.json"
+    try:
+        if time.time() - os.stat(meta_filename).st_mtime > ARTIFACT_TOUCH_SECONDS:
+            os.utime(meta_filename)
+    except OSError:
+        pass
+
+
+def fingerprint_matches(artifact_filename, fingerprint):
+    """True when the artifact's fingerprint sidecar equals fingerprint; reads only the sidecar."""
+    try:
+        with open(f"{artifact_filename}.meta.json", 'r') as fp:
+            return json.load(fp) == fingerprint
+    except (OSError, ValueError):
+        return False
+
+
+class SharedVolumeRegistry:
+    """
+    Process-wide, reference-counted registry of read-only volumes.
+
+    Entries are keyed by (nexus path, dataset path, dtype) and remember which
+    sessions use them; an entry is dropped when the last of those sessions is
+    released. Values are created once by the factory passed to acquire() and
+    handed to every session as-is, so they must never be written to.
+
+    Bokeh re-executes the dashboard script for every session, so a value
+    built from a class defined in the script is an instance of the creating
+    session's class: check values by duck typing, not isinstance().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        # key -> (Event, building thread) while a factory runs outside the lock
+        self._pending = {}
+
+    @staticmethod
+    def make_key(nexus_filename, dataset_path, dtype):
+        return (os.path.realpath(nexus_filename), dataset_path, str(dtype))
+
+    def _is_current(self, entry, valid, fingerprint):
+        return entry['fingerprint'] == fingerprint and (valid is None or valid(entry['value']))
+
+    def acquire(self, key, session_id, factory, valid=None, fingerprint=None):
+        """
+        Return the shared value for key, creating it with factory() if needed.
+
+        An entry created under a different fingerprint (e.g. the source file's
+        size and mtime) or for which valid(value) is False (e.g. a failed
+        build) is stale and replaced. A factory returning None is not registered.
+
+        factory() runs outside the registry lock, so a slow one only blocks
+        the sessions acquiring the same key; they wait for its result.
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and self._is_current(entry, valid, fingerprint):
+                    entry['sessions'].add(session_id)
+                    return entry['value']
+                pending = self._pending.get(key)
+                if pending is None:
+                    pending = self._pending[key] = (threading.Event(), threading.current_thread())
+                    break
+                if pending[1] is threading.current_thread():
+                    raise RuntimeError(f"Recursive acquire of {key} from its own factory")
+            pending[0].wait()
+            # The factory may have failed or returned a value we consider stale: look again
+        value = None
+        try:
+            value = factory()
+            if isinstance(value, np.ndarray) and value.flags.writeable:
+                value = value.view()
+                value.flags.writeable = False
+        finally:
+            with self._lock:
+                del self._pending[key]
+                if value is not None:
+                    self._entries[key] = {'value': value, 'fingerprint': fingerprint, 'sessions': {session_id}}
+            pending[0].set()
+        return value
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry['value'] if entry is not None else None
+
+    def release_session(self, session_id):
+        """Forget session_id everywhere; returns the keys dropped because no session uses them anymore."""
+        dropped = []
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                entry['sessions'].discard(session_id)
+                if not entry['sessions']:
+                    del self._entries[key]
+                    dropped.append(key)
+        return dropped
+
+    def stats(self):
+        with self._lock:
+            return {key: len(entry['sessions']) for key, entry in self._entries.items()}
+
+    def filenames(self):
+        """Real paths of the files behind registered values (memmaps, caches, builds in progress)."""
+        with self._lock:
+            values = [entry['value'] for entry in self._entries.values()]
+        names = set()
+        for value in values:
+            for attr in ('filename', 'mmap_filename', 'partial_filename', 'cache_filename'):
+                name = getattr(value, attr, None)
+                if isinstance(name, str):
+                    names.add(os.path.realpath(name))
+        return names
+
+    def sessions_using(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return set(entry['sessions']) if entry is not None else set()
+
+
+def index_key(index):
+    """Hashable form of a NumPy-style index, for cache keys."""
+    if index is None:
+        return None
+    if not isinstance(index, tuple):
+        index = (index,)
+    key = []
+    for k in index:
+        if isinstance(k, slice):
+            key.append(('slice', k.start, k.stop, k.step))
+        elif k is Ellipsis:
+            key.append('...')
+        elif isinstance(k, (int, np.integer)):
+            key.append(int(k))
+        else:
+            arr = np.asarray(k)
+            key.append((arr.dtype.str, arr.shape, arr.tobytes()))
+    return tuple(key)
+
+
+class ByteBudgetLRUCache:
+    """
+    Thread-safe LRU cache of read-only arrays, bounded by their total nbytes.
+
+    Values other than NumPy arrays are returned uncached, and so is any array
+    larger than the whole budget. Each entry remembers the fingerprint it was
+    loaded under; a lookup with a different one is a miss. Keys reserved by a
+    batched loader (see reserve()) are waited for instead of read twice.
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._pending = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_load(self, key, loader, fingerprint=None):
+        with self._lock:
+            pending = self._pending.get(key)
+        if pending is not None:
+            pending.wait(PREFETCH_WAIT_SECONDS)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] == fingerprint:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        # Load outside the lock; two sessions missing at once both read, the last one is kept
+        return self.put(key, loader(), fingerprint)
+
+    def put(self, key, value, fingerprint=None):
+        """Cache value under key (if it is an array that fits) and return it read-only."""
+        if not isinstance(value, np.ndarray) or value.nbytes > self.budget_bytes:
+            return value
+        if value.flags.writeable:
+            value = value.view()
+            value.flags.writeable = False
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, value.nbytes, fingerprint)
+            self.nbytes += value.nbytes
+            while self.nbytes > self.budget_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return value
+
+    def peek(self, key, fingerprint=None):
+        """Return the cached value for key without loading it (None on a miss, not counted)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None and entry[2] == fingerprint else None
+
+    def reserve(self, keys):
+        """
+        Mark keys as being loaded by the caller, who must release() each of them.
+
+        Returns the keys actually reserved (not cached or already reserved).
+        """
+        reserved = []
+        with self._lock:
+            for key in keys:
+                if key not in self._entries and key not in self._pending:
+                    self._pending[key] = threading.Event()
+                    reserved.append(key)
+        return reserved
+
+    def release(self, key):
+        with self._lock:
+            pending = self._pending.pop(key, None)
+        if pending is not None:
+            pending.set()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+    def invalidate(self, match=None):
+        """Drop every entry (or those whose key satisfies match(key)); returns how many were dropped."""
+        with self._lock:
+            keys = [key for key in self._entries if match is None or match(key)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'nbytes': self.nbytes,
+                'budget_bytes': self.budget_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
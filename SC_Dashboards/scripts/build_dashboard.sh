@@ -115,6 +115,17 @@ if [ -f "$DASHBOARDS_DIR/4d_dashboard_builder.py" ]; then
     echo "📋 Copied 4d_dashboard_builder.py to build context (from dashboards directory)"
 fi
 
+# Copy extra modules imported by the entry point (dashboard_modules in the config)
+for module in $(jq -r '.dashboard_modules // [] | .[]' "$CONFIG_FILE"); do
+    if [ -f "$DASHBOARDS_DIR/$module" ]; then
+        cp "$DASHBOARDS_DIR/$module" "$BUILD_CONTEXT/$module"
+        echo "📋 Copied $module to build context"
+    else
+        echo "Error: dashboard module not found: $DASHBOARDS_DIR/$module"
+        exit 1
+    fi
+done
+
 # Copy requirements if exists
 # Try multiple naming patterns for requirements file
 REQUIREMENTS_COPIED=false
@@ -113,6 +113,12 @@ if [ -n "$SHARED_UTILITIES" ]; then
     done
 fi
 
+# Extra modules imported by the entry point (dashboard_modules), copied next to it
+DASHBOARD_MODULES_SECTION=""
+for module in $(jq -r '.dashboard_modules // [] | .[]' "$CONFIG_FILE"); do
+    DASHBOARD_MODULES_SECTION="${DASHBOARD_MODULES_SECTION}COPY $module ./\n"
+done
+
 # Check if VTK/PyVista is needed (check additional_requirements for vtk or pyvista)
 NEEDS_VTK_X11=false
 if [ "$ADDITIONAL_REQUIREMENTS_COUNT" -gt 0 ]; then
@@ -263,6 +269,7 @@ sed -e "s|{{BASE_IMAGE}}|$BASE_IMAGE|g" \
     -e "s|{{ADDITIONAL_REQUIREMENTS}}|$ADDITIONAL_REQUIREMENTS|g" \
     -e "s|{{HEALTH_CHECK_PATH}}|$HEALTH_CHECK_PATH|g" \
     -e "s|{{SHARED_UTILITIES_SECTION}}|$SHARED_UTILITIES_SECTION|g" \
+    -e "s|{{DASHBOARD_MODULES_SECTION}}|$DASHBOARD_MODULES_SECTION|g" \
     -e "s|{{ENVIRONMENT_VARIABLES_SECTION}}|$ENVIRONMENT_VARIABLES_SECTION|g" \
     -e "s|{{CMD_SECTION}}|$CMD_SECTION|g" \
     "$TEMP_FILE" > "$OUTPUT_FILE"
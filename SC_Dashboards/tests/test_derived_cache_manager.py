@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Tests for the derived cache LRU manager
+=======================================
+
+Scans and prunes small artifact trees written to a temporary directory.
+
+Usage:
+    pytest test_derived_cache_manager.py -v
+"""
+
+import os
+import sys
+import time
+
+import pytest
+
+# The dashboard modules are plain scripts next to each other, not a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dashboards'))
+
+import derived_cache_manager
+from derived_cache_manager import (
+    META_SUFFIX,
+    prune,
+    scan,
+)
+
+HOUR = 3600
+
+
+@pytest.fixture
+def cache_root(tmp_path):
+    """Four 1000-byte fingerprinted artifacts last used 10, 20, 30 and 40 hours ago."""
+    now = time.time()
+    for i, hours in enumerate((10, 20, 30, 40)):
+        artifact = tmp_path / f'scan{i}.float32.npy'
+        artifact.write_bytes(b'\0' * 990)
+        meta = tmp_path / f'scan{i}.float32.npy{META_SUFFIX}'
+        meta.write_bytes(b'{}' * 5)
+        os.utime(meta, (now - hours * HOUR, now - hours * HOUR))
+    return tmp_path
+
+
+def _names(artifacts):
+    return [os.path.basename(artifact.path) for artifact in artifacts]
+
+
+class TestScan:
+    """scan() groups artifacts with their fingerprints and dates them by the fingerprint."""
+
+    def test_groups_and_dates_artifacts(self, cache_root):
+        artifacts = sorted(scan([str(cache_root)]), key=lambda a: a.last_access)
+        assert _names(artifacts) == [f'scan{i}.float32.npy' for i in (3, 2, 1, 0)]
+        assert all(artifact.size == 1000 and len(artifact.files) == 2 for artifact in artifacts)
+        assert time.time() - artifacts[0].last_access == pytest.approx(40 * HOUR, abs=60)
+
+    def test_untracked_and_partial_files(self, tmp_path):
+        (tmp_path / 'scan.choices.json').write_text('{}')
+        (tmp_path / 'scan.float32.dat.partial-123').write_bytes(b'\0' * 10)
+        (tmp_path / 'scan.nxs').write_bytes(b'\0' * 10)
+        assert sorted(_names(scan([str(tmp_path)]))) == ['scan.choices.json', 'scan.float32.dat.partial-123']
+
+
+class TestPrune:
+    """prune() evicts least recently used artifacts down to the budget."""
+
+    def test_evicts_in_lru_order_down_to_budget(self, cache_root):
+        evicted = prune(scan([str(cache_root)]), 2000, min_idle_seconds=HOUR)
+        assert _names(evicted) == ['scan3.float32.npy', 'scan2.float32.npy']
+        assert sorted(os.listdir(cache_root)) == ['scan0.float32.npy', f'scan0.float32.npy{META_SUFFIX}',
+                                                  'scan1.float32.npy', f'scan1.float32.npy{META_SUFFIX}']
+
+    def test_keeps_recently_used_artifacts(self, cache_root):
+        evicted = prune(scan([str(cache_root)]), 0, min_idle_seconds=25 * HOUR)
+        assert _names(evicted) == ['scan3.float32.npy', 'scan2.float32.npy']
+        assert (cache_root / 'scan1.float32.npy').exists() and (cache_root / 'scan0.float32.npy').exists()
+
+    def test_never_removes_kept_artifacts(self, cache_root):
+        kept = str(cache_root / 'scan3.float32.npy')
+        evicted = prune(scan([str(cache_root)]), 2000, min_idle_seconds=HOUR, keep=[kept])
+        assert _names(evicted) == ['scan2.float32.npy', 'scan1.float32.npy']
+        assert os.path.exists(kept) and os.path.exists(kept + META_SUFFIX)
+
+    def test_removes_fingerprint_before_artifact(self, cache_root, monkeypatch):
+        removed = []
+        remove = os.remove
+        monkeypatch.setattr(derived_cache_manager.os, 'remove', lambda path: (removed.append(path), remove(path)))
+        prune(scan([str(cache_root)]), 3000, min_idle_seconds=HOUR)
+        assert [os.path.basename(path) for path in removed] == [f'scan3.float32.npy{META_SUFFIX}', 'scan3.float32.npy']
+
+    def test_dry_run_deletes_nothing(self, cache_root):
+        before = sorted(os.listdir(cache_root))
+        evicted = prune(scan([str(cache_root)]), 0, min_idle_seconds=HOUR, dry_run=True)
+        assert len(evicted) == 4
+        assert sorted(os.listdir(cache_root)) == before
@@ -0,0 +1,632 @@
+#!/usr/bin/env python3
+"""
+Tests for the analysis engines of the 4D dashboard
+==================================================
+
+Runs the NumPy engines of dashboards/volume_analysis.py (ROI statistics,
+incremental ROI updates, streaming decompositions) against small synthetic
+volumes; no Bokeh server or SCLib_Dashboards needed.
+
+Usage:
+    pytest test_volume_analysis.py -v
+"""
+
+import os
+import sys
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+import pytest
+
+# The dashboard modules are plain scripts next to each other, not a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dashboards'))
+
+import volume_analysis
+from volume_analysis import (
+    ROI_STATISTICS,
+    AzimuthalIntegrator,
+    InteractiveRefiner,
+    MaskWeights,
+    MiniBatchKMeans,
+    ROIReductionEngine,
+    annulus_mask,
+    cluster_scan_points,
+    format_roi_set,
+    integrated_profile,
+    load_mask_file,
+    nan_percentiles,
+    parse_mask_set,
+    parse_roi_set,
+    polygon_mask,
+    probe_features,
+    ratio_map,
+    roi_set_sums,
+    roi_statistics,
+    roi_strip_deltas,
+    streaming_nmf,
+    streaming_pca,
+)
+from volume_cache import bin_mean
+
+
+def _box_sum(data, ranges):
+    return data[(Ellipsis,) + tuple(slice(lo, hi) for lo, hi in ranges)].sum(axis=(-2, -1))
+
+
+@pytest.fixture(params=['csr', 'numpy'])
+def sparse_backend(request, monkeypatch):
+    """Run with SciPy's CSR matrices, then with the NumPy fallback used when SciPy is missing."""
+    if request.param == 'csr':
+        pytest.importorskip('scipy.sparse')
+    else:
+        monkeypatch.setattr(volume_analysis, 'scipy', None)
+    return request.param
+
+
+class TestRoiStripDeltas:
+    """roi_strip_deltas() turns the old ROI sum into the new one."""
+
+    @pytest.mark.parametrize('old, new', [
+        (((2, 6), (3, 8)), ((3, 9), (1, 8))),    # overlapping move
+        (((0, 4), (0, 4)), ((6, 10), (6, 9))),   # disjoint boxes
+        (((2, 8), (2, 8)), ((3, 5), (4, 6))),    # shrink inside
+        (((3, 5), (4, 6)), ((0, 10), (0, 9))),   # grow around
+        (((2, 6), (3, 8)), ((2, 6), (3, 8))),    # unchanged
+    ])
+    def test_deltas_update_the_sum(self, old, new):
+        data = np.random.default_rng(1).random((3, 4, 10, 9))
+        total = _box_sum(data, old)
+        for sign, ranges in roi_strip_deltas(old, new):
+            total = total + sign * _box_sum(data, ranges)
+        np.testing.assert_allclose(total, _box_sum(data, new))
+
+    def test_unchanged_roi_has_no_deltas(self):
+        assert roi_strip_deltas(((2, 6), (3, 8)), ((2, 6), (3, 8))) == []
+
+    def test_strips_are_smaller_than_the_roi_for_small_moves(self):
+        deltas = roi_strip_deltas(((10, 50), (10, 50)), ((11, 51), (10, 50)))
+        assert len(deltas) == 2
+        assert all(ranges[0][1] - ranges[0][0] == 1 for _sign, ranges in deltas)
+
+
+class TestRoiSet:
+    """roi_set_sums() and the text form of ROI sets."""
+
+    @pytest.mark.parametrize('rois', [
+        [('a', ((2, 6), (3, 8))), ('b', ((4, 9), (1, 5)))],               # overlapping boxes
+        [('a', ((0, 3), (0, 2))), ('b', ((7, 10), (6, 9)))],              # disjoint boxes
+        [('a', ((2, 8), (2, 8))), ('b', ((3, 5), (4, 6))), ('c', ((2, 8), (2, 8)))],   # nested, repeated
+    ])
+    def test_sums_match_each_roi(self, rois):
+        data = np.random.default_rng(5).random((3, 4, 10, 9))
+        roi_set = [{'name': name, 'ranges': ranges} for name, ranges in rois]
+        lo = [min(roi['ranges'][axis][0] for roi in roi_set) for axis in range(2)]
+        hi = [max(roi['ranges'][axis][1] for roi in roi_set) for axis in range(2)]
+        block = data[..., lo[0]:hi[0], lo[1]:hi[1]]
+        sums = roi_set_sums(block, lo, roi_set)
+        assert sums.shape == (3, 4, len(rois))
+        for i, roi in enumerate(roi_set):
+            np.testing.assert_allclose(sums[..., i], _box_sum(data, roi['ranges']))
+
+    def test_3d_sums(self):
+        data = np.random.default_rng(6).random((5, 12))
+        roi_set = [{'name': 'a', 'ranges': [[2, 7]]}, {'name': 'b', 'ranges': [[5, 11]]}]
+        sums = roi_set_sums(data[:, 2:11], (2,), roi_set)
+        np.testing.assert_allclose(sums, np.stack([data[:, 2:7].sum(axis=1), data[:, 5:11].sum(axis=1)], axis=-1))
+
+    def test_text_round_trip(self):
+        roi_set = parse_roi_set("peak: 2 6 3 8\n ring 2: 4, 9, 1, 5; 0 3 0 2")
+        assert roi_set == [
+            {'name': 'peak', 'ranges': [[2, 6], [3, 8]]},
+            {'name': 'ring 2', 'ranges': [[4, 9], [1, 5]]},
+            {'name': 'ROI 3', 'ranges': [[0, 3], [0, 2]]},
+        ]
+        assert format_roi_set(roi_set) == "peak: 2 6 3 8; ring 2: 4 9 1 5; ROI 3: 0 3 0 2"
+        assert parse_roi_set(format_roi_set(roi_set)) == roi_set
+
+    @pytest.mark.parametrize('text', ["a: 2 6 3", "a: 6 2 3 8", "a: x 6 3 8"])
+    def test_invalid_text(self, text):
+        with pytest.raises(ValueError):
+            parse_roi_set(text)
+
+
+class TestMaskFiles:
+    """File masks are only read from the allowed directories."""
+
+    @pytest.fixture
+    def dirs(self, tmp_path):
+        scan_dir = tmp_path / 'scan'
+        other_dir = tmp_path / 'other'
+        scan_dir.mkdir()
+        other_dir.mkdir()
+        mask = np.zeros((4, 5), dtype=bool)
+        mask[1:3, 2:4] = True
+        for directory in (scan_dir, other_dir):
+            np.save(str(directory / 'mask.npy'), mask)
+            with h5py.File(str(directory / 'masks.h5'), 'w') as f:
+                f['detector/mask'] = mask
+        return scan_dir, other_dir, mask
+
+    def test_reads_masks_of_the_scan_directory(self, dirs):
+        scan_dir, _other_dir, mask = dirs
+        np.testing.assert_array_equal(load_mask_file('mask.npy', (4, 5), [str(scan_dir)]), mask)
+        np.testing.assert_array_equal(load_mask_file(str(scan_dir / 'masks.h5') + '::detector/mask', (4, 5),
+                                                     [str(scan_dir)]), mask)
+        masks = parse_mask_set('a: file mask.npy', (4, 5), mask_dirs=[str(scan_dir)])
+        np.testing.assert_array_equal(masks['a'], mask)
+
+    @pytest.mark.parametrize('spec', ['../other/mask.npy', '{other}/mask.npy', '/etc/passwd', 'link.npy',
+                                      '{other}/masks.h5::detector/mask'])
+    def test_rejects_files_outside(self, dirs, spec):
+        scan_dir, other_dir, _mask = dirs
+        os.symlink(str(other_dir / 'mask.npy'), str(scan_dir / 'link.npy'))
+        with pytest.raises(ValueError, match='outside the dataset directory'):
+            load_mask_file(spec.format(other=other_dir), (4, 5), [str(scan_dir)])
+        with pytest.raises(ValueError, match='outside the dataset directory'):
+            parse_mask_set(f"a: file {spec.format(other=other_dir)}", (4, 5), mask_dirs=[str(scan_dir)])
+
+    def test_sibling_directory_with_the_same_prefix_is_outside(self, dirs, tmp_path):
+        scan_dir, _other_dir, mask = dirs
+        sibling = tmp_path / 'scan2'
+        sibling.mkdir()
+        np.save(str(sibling / 'mask.npy'), mask)
+        with pytest.raises(ValueError, match='outside'):
+            load_mask_file(str(sibling / 'mask.npy'), (4, 5), [str(scan_dir)])
+
+    def test_every_allowed_directory_is_accepted(self, dirs):
+        scan_dir, other_dir, mask = dirs
+        np.testing.assert_array_equal(load_mask_file(str(other_dir / 'mask.npy'), (4, 5),
+                                                     [str(scan_dir), None, str(other_dir)]), mask)
+
+    def test_no_directories_reject_every_file(self, dirs):
+        scan_dir, _other_dir, _mask = dirs
+        with pytest.raises(ValueError, match='disabled'):
+            load_mask_file(str(scan_dir / 'mask.npy'), (4, 5))
+
+
+class TestMaskWeights:
+    """MaskWeights.apply() against direct masked sums."""
+
+    def test_4d_masks(self, sparse_backend):
+        rng = np.random.default_rng(7)
+        volume = rng.random((5, 4, 12, 10)).astype(np.float32)
+        weights = rng.random((12, 10))
+        weights[:, :3] = 0
+        masks = {
+            'ring': annulus_mask((12, 10), (6, 5), 2, 4),
+            'triangle': polygon_mask((12, 10), [(1, 1), (1, 8), (9, 4)]),
+            'weighted': weights,
+        }
+        mask_weights = MaskWeights(masks, (12, 10))
+        maps = mask_weights.apply(volume[(Ellipsis,) + mask_weights.window])
+        assert maps.shape == (5, 4, 3)
+        for i, mask in enumerate(masks.values()):
+            np.testing.assert_allclose(maps[..., i], (volume * mask).sum(axis=(-2, -1)), rtol=1e-5)
+
+    def test_3d_masks(self, sparse_backend):
+        volume = np.random.default_rng(8).random((6, 20)).astype(np.float32)
+        masks = {'every third': np.arange(20) % 3 == 0, 'ramp': np.where(np.arange(20) >= 5, np.arange(20.0), 0)}
+        mask_weights = MaskWeights(masks, (20,))
+        assert mask_weights.window == (slice(0, 20),)
+        maps = mask_weights.apply(volume[:, mask_weights.window[0]])
+        for i, mask in enumerate(masks.values()):
+            np.testing.assert_allclose(maps[:, i], (volume * mask).sum(axis=-1), rtol=1e-5)
+
+    def test_window_is_the_bounding_box(self, sparse_backend):
+        mask = np.zeros((12, 10), dtype=bool)
+        mask[3:5, 2:7] = True
+        assert MaskWeights({'box': mask}, (12, 10)).window == (slice(3, 5), slice(2, 7))
+
+
+class TestAzimuthalIntegrator:
+    """AzimuthalIntegrator.apply() against binning every pixel by hand."""
+
+    GEOMETRY = {'center': (6.3, 4.8), 'distance': 0.05, 'pixel_size': (1e-3, 1.2e-3), 'wavelength': 1.0}
+
+    def _brute_force(self, frames, integrator, mask):
+        n_z, n_u = frames.shape[-2:]
+        pz, pu = self.GEOMETRY['pixel_size']
+        sums = np.zeros(frames.shape[:-2] + (integrator.n_chi, integrator.n_q))
+        counts = np.zeros((integrator.n_chi, integrator.n_q))
+        for z in range(n_z):
+            for u in range(n_u):
+                if not mask[z, u]:
+                    continue
+                dz = (z - self.GEOMETRY['center'][0]) * pz
+                du = (u - self.GEOMETRY['center'][1]) * pu
+                q = 4 * np.pi / self.GEOMETRY['wavelength'] * np.sin(np.arctan2(np.hypot(dz, du), 0.05) / 2)
+                chi = np.degrees(np.arctan2(-dz, du))
+                q_bin = min(np.searchsorted(integrator.q_edges, q, 'right') - 1, integrator.n_q - 1)
+                chi_bin = min(np.searchsorted(integrator.chi_edges, chi, 'right') - 1, integrator.n_chi - 1)
+                sums[..., chi_bin, q_bin] += frames[..., z, u]
+                counts[chi_bin, q_bin] += 1
+        with np.errstate(invalid='ignore'):
+            expected = sums / counts
+        return expected[..., 0, :] if integrator.n_chi == 1 else expected
+
+    @pytest.mark.parametrize('n_chi', [1, 4])
+    def test_matches_per_pixel_binning(self, sparse_backend, n_chi):
+        frames = np.random.default_rng(9).random((3, 2, 14, 11)).astype(np.float32)
+        mask = np.ones((14, 11), dtype=bool)
+        mask[:2] = False
+        mask[6, 4:6] = False
+        integrator = AzimuthalIntegrator((14, 11), self.GEOMETRY, n_q=12, n_chi=n_chi, mask=mask)
+        assert integrator.window == (slice(2, 14), slice(0, 11))
+        out = integrator.apply(frames[(Ellipsis,) + integrator.window])
+        assert out.shape == (3, 2) + integrator.bin_shape
+        expected = self._brute_force(frames, integrator, mask)
+        np.testing.assert_array_equal(np.isnan(out), np.isnan(expected))
+        np.testing.assert_allclose(out, expected, rtol=1e-5)
+
+    @pytest.mark.filterwarnings('ignore:Mean of empty slice')
+    def test_profile_is_the_mean_over_scan_and_chi(self):
+        integrated = np.random.default_rng(10).random((5, 3, 4, 6)).astype(np.float32)
+        integrated[..., 1, 2] = np.nan
+        integrated[..., 5] = np.nan
+        profile = integrated_profile(integrated, 2, slab_bytes=3 * 4 * 6 * 4 * 2)
+        expected = np.nanmean(integrated.reshape(-1, 4, 6), axis=0)
+        expected = np.nanmean(expected[:, :5], axis=0)
+        np.testing.assert_allclose(profile[:5], expected, rtol=1e-5)
+        assert np.isnan(profile[5])
+        np.testing.assert_allclose(integrated_profile(integrated[..., 0, :], 1, slab_bytes=1),
+                                   np.nanmean(integrated[..., 0, :].reshape(-1, 6), axis=0), rtol=1e-5)
+
+
+class FakeDoc:
+    """The timeout callbacks of a Bokeh document, run by hand."""
+
+    def __init__(self):
+        self.timeouts = {}
+        self._handles = 0
+
+    def add_timeout_callback(self, callback, timeout_ms):
+        self._handles += 1
+        self.timeouts[self._handles] = callback
+        return self._handles
+
+    def remove_timeout_callback(self, handle):
+        if handle not in self.timeouts:
+            raise ValueError(f"Unknown callback {handle}")
+        del self.timeouts[handle]
+
+    def run_timeouts(self):
+        for handle, callback in list(self.timeouts.items()):
+            del self.timeouts[handle]
+            callback()
+
+
+class TestInteractiveRefiner:
+    """Coarse render at once, full resolution once idle, newer requests cancel older ones."""
+
+    @staticmethod
+    def _request(refiner, name, rendered, coarse_level=4):
+        refiner.request(lambda level: (name, level), rendered.append, coarse_level=coarse_level)
+
+    def test_coarse_then_fine(self):
+        doc, rendered = FakeDoc(), []
+        self._request(InteractiveRefiner(doc), 'a', rendered)
+        assert rendered == [('a', 4)]
+        assert len(doc.timeouts) == 1
+        doc.run_timeouts()
+        assert rendered == [('a', 4), ('a', 1)]
+
+    def test_newer_request_cancels_the_refinement(self):
+        doc, rendered = FakeDoc(), []
+        refiner = InteractiveRefiner(doc)
+        self._request(refiner, 'a', rendered)
+        self._request(refiner, 'b', rendered)
+        assert len(doc.timeouts) == 1
+        doc.run_timeouts()
+        assert rendered == [('a', 4), ('b', 4), ('b', 1)]
+
+    @pytest.mark.parametrize('coarse_level', [None, 1])
+    def test_full_resolution_request_renders_at_once(self, coarse_level):
+        doc, rendered = FakeDoc(), []
+        refiner = InteractiveRefiner(doc)
+        self._request(refiner, 'a', rendered)
+        self._request(refiner, 'b', rendered, coarse_level=coarse_level)
+        assert rendered == [('a', 4), ('b', 1)]
+        assert doc.timeouts == {}
+
+    def test_defer_and_cancel(self):
+        doc, calls = FakeDoc(), []
+        refiner = InteractiveRefiner(doc)
+        refiner.defer(lambda: calls.append('first'))
+        refiner.defer(lambda: calls.append('second'))
+        doc.run_timeouts()
+        assert calls == ['second']
+        refiner.defer(lambda: calls.append('third'))
+        refiner.cancel()
+        refiner.cancel()
+        doc.run_timeouts()
+        assert calls == ['second']
+
+
+class TestROIReductionEngine:
+    """ROIReductionEngine: slab reductions on a pool, completion and failure callbacks."""
+
+    @pytest.fixture
+    def pool(self):
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            yield pool
+
+    @staticmethod
+    def _submit(engine, reduce_rows, n_rows=10, slab_rows=2):
+        finished = threading.Event()
+        results, errors = [], []
+
+        def _on_done(result):
+            results.append(result)
+            finished.set()
+
+        def _on_error(error):
+            errors.append(error)
+            finished.set()
+
+        job = engine.submit(n_rows, slab_rows, reduce_rows, _on_done, on_error=_on_error)
+        assert finished.wait(10)
+        job.finished.wait(10)
+        return job, results, errors
+
+    def test_reduces_every_slab(self, pool):
+        data = np.arange(10 * 3, dtype=np.float64).reshape(10, 3)
+        job, results, errors = self._submit(ROIReductionEngine(pool), lambda lo, hi: data[lo:hi] * 2)
+        assert errors == []
+        np.testing.assert_array_equal(results[0], data * 2)
+        np.testing.assert_array_equal(job.wait(), data * 2)
+
+    def test_failure_reaches_on_error_once(self, pool):
+        def _reduce_rows(lo, hi):
+            if lo >= 4:
+                raise OSError(f"cannot read rows {lo}:{hi}")
+            return np.zeros((hi - lo, 3))
+
+        job, results, errors = self._submit(ROIReductionEngine(pool), _reduce_rows)
+        pool.shutdown(wait=True)
+        assert results == []
+        assert len(errors) == 1 and isinstance(errors[0], OSError)
+        assert job.error is errors[0]
+        assert job.wait() is None
+
+    def test_callbacks_go_through_the_doc(self, pool):
+        class Doc:
+            def __init__(self):
+                self.callbacks = []
+
+            def add_next_tick_callback(self, callback):
+                self.callbacks.append(callback)
+
+        doc = Doc()
+        errors = []
+        job = ROIReductionEngine(pool, doc).submit(4, 4, lambda lo, hi: 1 / 0, lambda result: None,
+                                                   on_error=errors.append)
+        assert job.finished.wait(10)
+        pool.shutdown(wait=True)
+        assert errors == [] and len(doc.callbacks) == 1
+        doc.callbacks[0]()
+        assert isinstance(errors[0], ZeroDivisionError)
+
+
+class TestRoiStatistics:
+    """roi_statistics() against the equivalent NumPy reductions."""
+
+    def test_4d_statistics(self):
+        rng = np.random.default_rng(2)
+        ranges = ((5, 11), (2, 6))
+        block = rng.random((3, 4, 6, 4))
+        stats = roi_statistics(block, ranges)
+        assert stats.shape == (3, 4, len(ROI_STATISTICS))
+        np.testing.assert_allclose(stats[..., ROI_STATISTICS.index('sum')], block.sum(axis=(2, 3)))
+        np.testing.assert_allclose(stats[..., ROI_STATISTICS.index('mean')], block.mean(axis=(2, 3)))
+        np.testing.assert_allclose(stats[..., ROI_STATISTICS.index('max')], block.max(axis=(2, 3)))
+        np.testing.assert_allclose(stats[..., ROI_STATISTICS.index('std')], block.std(axis=(2, 3)))
+        z = np.arange(5, 11)[:, None]
+        u = np.arange(2, 6)[None, :]
+        total = block.sum(axis=(2, 3))
+        np.testing.assert_allclose(stats[..., ROI_STATISTICS.index('centroid_z')], (block * z).sum(axis=(2, 3)) / total)
+        np.testing.assert_allclose(stats[..., ROI_STATISTICS.index('centroid_u')], (block * u).sum(axis=(2, 3)) / total)
+
+    def test_3d_statistics_have_no_centroid_u(self):
+        block = np.arange(2 * 5, dtype=np.float64).reshape(2, 5)
+        stats = roi_statistics(block, ((10, 15),))
+        np.testing.assert_allclose(stats[:, ROI_STATISTICS.index('centroid_z')],
+                                   (block * np.arange(10, 15)).sum(axis=1) / block.sum(axis=1))
+        assert np.isnan(stats[:, ROI_STATISTICS.index('centroid_u')]).all()
+
+    def test_empty_roi_centroid_is_nan(self):
+        stats = roi_statistics(np.zeros((2, 3, 2, 2)), ((0, 2), (0, 2)))
+        assert (stats[..., ROI_STATISTICS.index('sum')] == 0).all()
+        assert np.isnan(stats[..., ROI_STATISTICS.index('centroid_z')]).all()
+
+
+class TestStreamingPCA:
+    """streaming_pca() against an exact SVD of the centred probe spectra."""
+
+    @pytest.fixture
+    def low_rank_file(self, tmp_path):
+        rng = np.random.default_rng(3)
+        n_x, n_y, n_z, n_u = 8, 6, 9, 7
+        components = rng.random((3, n_z * n_u))
+        loadings = rng.standard_normal((n_x * n_y, 3)) * np.array([10.0, 4.0, 1.0])
+        data = (loadings @ components + 5.0).reshape(n_x, n_y, n_z, n_u).astype(np.float32)
+        data += rng.normal(0, 1e-3, data.shape).astype(np.float32)
+        filename = str(tmp_path / 'low_rank.nxs')
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('entry/data/volume', data=data)
+        return filename, data
+
+    def test_matches_exact_svd(self, low_rank_file):
+        filename, data = low_rank_file
+        updates = []
+        with h5py.File(filename, 'r') as f:
+            result = streaming_pca(f['entry/data/volume'], n_components=3, passes=3, slab_rows=3,
+                                   on_update=updates.append)
+        assert len(updates) == 1
+        rows = data.reshape(48, -1).astype(np.float64)
+        centred = rows - rows.mean(axis=0)
+        _u, sigma, vt = np.linalg.svd(centred, full_matrices=False)
+        np.testing.assert_allclose(result['weights'], sigma[:3], rtol=1e-3)
+        np.testing.assert_allclose(result['explained'], sigma[:3] ** 2 / (sigma ** 2).sum(), rtol=1e-3)
+        np.testing.assert_allclose(result['mean'], rows.mean(axis=0).reshape(9, 7), rtol=1e-4)
+        assert result['components'].shape == (3, 9, 7)
+        assert result['loadings'].shape == (3, 8, 6)
+        for i in range(3):
+            component = result['components'][i].ravel()
+            assert abs(component @ vt[i]) == pytest.approx(1.0, abs=1e-3)
+        # Loadings are the projections of the centred spectra on the components
+        projected = centred @ result['components'].reshape(3, -1).T.astype(np.float64)
+        np.testing.assert_allclose(result['loadings'].reshape(3, -1).T, projected, rtol=1e-3, atol=1e-2)
+
+    def test_cancelled(self, low_rank_file):
+        class Cancelled:
+            def is_set(self):
+                return True
+
+        filename, _data = low_rank_file
+        with h5py.File(filename, 'r') as f:
+            assert streaming_pca(f['entry/data/volume'], n_components=2, cancelled=Cancelled()) is None
+
+
+class TestRatioMap:
+    """ratio_map() and nan_percentiles() turn undefined ratios into NaN without warnings."""
+
+    def test_undefined_ratios_are_nan(self):
+        numerator = np.array([[6.0, 1.0, 0.0], [np.nan, 4.0, np.inf]])
+        denominator = np.array([[3.0, 0.0, 0.0], [2.0, np.nan, 2.0]])
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            ratio = ratio_map(numerator, denominator)
+        assert ratio.dtype == np.float32
+        np.testing.assert_array_equal(ratio, [[2.0, np.nan, np.nan], [np.nan, np.nan, np.nan]])
+
+    def test_integer_inputs(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            ratio = ratio_map(np.array([3, 5, 7]), np.array([2, 0, 7]))
+        np.testing.assert_array_equal(ratio, np.array([1.5, np.nan, 1.0], dtype=np.float32))
+
+    def test_shape_mismatch(self):
+        with pytest.raises(ValueError):
+            ratio_map(np.ones((2, 3)), np.ones((3, 2)))
+
+    def test_percentiles_ignore_nan(self):
+        data = np.array([np.nan, 1.0, 2.0, np.nan, 3.0, 4.0, np.inf, 5.0], dtype=np.float32)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            percentiles = nan_percentiles(data, q=(0, 50, 100))
+        np.testing.assert_allclose(percentiles, [1.0, 3.0, 5.0])
+
+    def test_percentiles_of_all_nan(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            percentiles = nan_percentiles(np.full((3, 3), np.nan, dtype=np.float32), q=(5, 95))
+        assert percentiles.shape == (2,) and np.isnan(percentiles).all()
+
+
+class TestStreamingNMF:
+    """streaming_nmf() keeps its factors non-negative and improves the fit with every pass."""
+
+    @pytest.fixture
+    def parts_volume(self):
+        rng = np.random.default_rng(4)
+        components = rng.random((3, 8 * 6))
+        loadings = rng.random((7 * 5, 3)) * np.array([10.0, 5.0, 2.0])
+        data = (loadings @ components).reshape(7, 5, 8, 6).astype(np.float32)
+        # A little negative noise, which the factorization clips to 0
+        return data - rng.random(data.shape).astype(np.float32) * 0.05
+
+    def test_non_negative_and_error_decreases(self, parts_volume):
+        updates = []
+        result = streaming_nmf(parts_volume, n_components=3, passes=30, slab_rows=2, on_update=updates.append)
+        results = updates + [result]
+        assert [r['passes'] for r in results] == list(range(1, 31))
+        target = np.maximum(parts_volume, 0).reshape(35, -1).astype(np.float64)
+        errors = []
+        for r in results:
+            assert (r['components'] >= 0).all() and (r['loadings'] >= 0).all()
+            assert r['components'].shape == (3, 8, 6) and r['loadings'].shape == (3, 7, 5)
+            reconstruction = r['loadings'].reshape(3, -1).T.astype(np.float64) @ r['components'].reshape(3, -1)
+            errors.append(np.linalg.norm(target - reconstruction))
+        assert all(b <= a * (1 + 1e-5) for a, b in zip(errors, errors[1:]))
+        assert errors[-1] < 0.6 * errors[0]
+        assert errors[-1] < 0.1 * np.linalg.norm(target)
+
+    def test_cancelled(self, parts_volume):
+        class Cancelled:
+            def is_set(self):
+                return True
+
+        assert streaming_nmf(parts_volume, n_components=2, cancelled=Cancelled()) is None
+
+
+def _same_partition(labels, truth):
+    """True when labels and truth group the points identically, whatever the cluster numbering."""
+    pairs = set(zip(np.ravel(labels).tolist(), np.ravel(truth).tolist()))
+    return len(pairs) == len({a for a, _ in pairs}) == len({b for _, b in pairs})
+
+
+class TestClustering:
+    """MiniBatchKMeans and cluster_scan_points() on well separated probe shapes."""
+
+    @pytest.fixture
+    def clustered_volume(self):
+        """An (8, 6, 6, 4) volume whose scan points carry one of three probe shapes at random intensities."""
+        rng = np.random.default_rng(7)
+        shapes = np.zeros((3, 6, 4), dtype=np.float32)
+        shapes[0, :2, :2] = 1.0
+        shapes[1, 2:4, 1:3] = 1.0
+        shapes[2, 4:, 2:] = 1.0
+        truth = np.zeros((8, 6), dtype=np.int64)
+        truth[:4, 4:] = 1
+        truth[4:] = 2
+        intensity = rng.uniform(1.0, 10.0, truth.shape).astype(np.float32)
+        data = shapes[truth] * intensity[..., None, None]
+        data += rng.uniform(0.0, 0.01, data.shape).astype(np.float32)
+        return data, truth
+
+    def test_kmeans_centres_are_cluster_means(self, clustered_volume):
+        data, truth = clustered_volume
+        features = probe_features(data, 2)
+        kmeans = MiniBatchKMeans(3, seed=1)
+        kmeans.init(features)
+        labels = kmeans.partial_fit(features)
+        assert _same_partition(labels, truth)
+        for k in range(3):
+            np.testing.assert_allclose(kmeans.centers[k], features[labels == k].mean(0), rtol=1e-5, atol=1e-6)
+        assert kmeans.counts.sum() == len(features)
+
+    def test_kmeans_needs_enough_points(self):
+        with pytest.raises(ValueError):
+            MiniBatchKMeans(4).init(np.ones((3, 2), dtype=np.float32))
+
+    @pytest.mark.parametrize('factor', [1, 2])
+    def test_cluster_scan_points(self, clustered_volume, factor):
+        data, truth = clustered_volume
+        coarse = bin_mean(data, factor) if factor > 1 else None
+        updates = []
+        result = cluster_scan_points(data, n_clusters=3, coarse=coarse, factor=factor, slab_rows=3,
+                                     on_update=updates.append)
+        assert result['labels'].shape == (8, 6)
+        assert _same_partition(result['labels'], truth)
+        for k in range(3):
+            members = result['labels'] == k
+            assert result['counts'][k] == members.sum()
+            np.testing.assert_allclose(result['means'][k], data[members].mean(0), rtol=1e-5)
+        if factor > 1:
+            (preview,) = updates
+            assert preview['labels'].shape == (8, 6) and _same_partition(preview['labels'], truth)
+        else:
+            assert updates == []
+
+    @pytest.mark.parametrize('factor', [1, 2])
+    def test_cancelled(self, clustered_volume, factor):
+        class Cancelled:
+            def is_set(self):
+                return True
+
+        data, _truth = clustered_volume
+        coarse = bin_mean(data, factor) if factor > 1 else None
+        assert cluster_scan_points(data, n_clusters=3, coarse=coarse, factor=factor, cancelled=Cancelled()) is None
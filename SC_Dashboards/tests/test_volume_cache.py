@@ -0,0 +1,608 @@
+#!/usr/bin/env python3
+"""
+Tests for the volume caches and shared stores of the 4D dashboard
+=================================================================
+
+Runs the HDF5/NumPy engines of dashboards/volume_cache.py against small
+synthetic .nxs-like files; no Bokeh server or SCLib_Dashboards needed.
+
+Usage:
+    pytest test_volume_cache.py -v
+"""
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import h5py
+import numpy as np
+import pytest
+
+# The dashboard modules are plain scripts next to each other, not a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dashboards'))
+
+from volume_cache import (
+    CACHE_TRANSFORM_VERSIONS,
+    ByteBudgetLRUCache,
+    ProgressiveVolumeCache,
+    QuantizedVolume,
+    SharedVolumeRegistry,
+    TiledVolume,
+    artifact_fingerprint,
+    bin_mean,
+    build_nexus_catalog,
+    build_summed_area_table,
+    build_volume_pyramid,
+    fingerprint_matches,
+    interactive_level,
+    load_dataset_index,
+    open_contiguous_float32,
+    open_nexus,
+    summed_area_sum,
+    write_fingerprint,
+    write_quantized_volume,
+)
+
+
+@pytest.fixture
+def volume_file(tmp_path):
+    """A 4D (x, y, z, u) float32 volume in an HDF5 file, and its values."""
+    rng = np.random.default_rng(0)
+    data = rng.gamma(2.0, 50.0, size=(6, 5, 12, 10)).astype(np.float32)
+    filename = str(tmp_path / 'scan.nxs')
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset('entry/data/volume', data=data, chunks=(1, 5, 12, 10))
+    return filename, data
+
+
+class TestNexusCatalog:
+    """build_nexus_catalog() with worker processes and incremental rebuilds."""
+
+    def _write_scans(self, directory, count):
+        for i in range(count):
+            with h5py.File(str(directory / f'scan{i}.nxs'), 'w') as f:
+                f.create_dataset('entry/data/volume', data=np.zeros((2, 3, 4 + i, 5), dtype=np.float32))
+                f.create_dataset('entry/data/x', data=np.arange(2.0))
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_catalogs_every_file(self, tmp_path, workers):
+        self._write_scans(tmp_path, 3)
+        (tmp_path / 'broken.nxs').write_bytes(b'not hdf5')
+        catalog = build_nexus_catalog(str(tmp_path), workers=workers)
+        entries = {os.path.basename(entry['path']): entry for entry in catalog['files']}
+        assert sorted(entries) == ['broken.nxs', 'scan0.nxs', 'scan1.nxs', 'scan2.nxs']
+        assert 'error' in entries['broken.nxs']
+        assert entries['scan2.nxs']['volumes'] == [{'path': 'entry/data/volume', 'shape': [2, 3, 6, 5]}]
+        assert entries['scan0.nxs']['datasets'] == 2
+
+    def test_unchanged_files_are_reused(self, tmp_path):
+        self._write_scans(tmp_path, 2)
+        previous = build_nexus_catalog(str(tmp_path), workers=1)
+        previous['files'][0]['marker'] = True
+        catalog = build_nexus_catalog(str(tmp_path), previous=previous, workers=1)
+        assert catalog['files'][0].get('marker') is True
+
+
+# Holds a scan open as an HDF5 SWMR writer until <file>.stop appears
+SWMR_WRITER = '''
+import os, sys, time
+import h5py, numpy as np
+f = h5py.File(sys.argv[1], 'w', libver='latest')
+f.create_dataset('entry/data/map', data=np.arange(4.0), maxshape=(None,), chunks=(4,))
+f.swmr_mode = True
+open(sys.argv[1] + '.ready', 'w').close()
+while not os.path.exists(sys.argv[1] + '.stop'):
+    time.sleep(0.05)
+f.close()
+'''
+
+
+class TestOpenNexus:
+    """open_nexus() against a scan that is still being written."""
+
+    @pytest.fixture
+    def swmr_file(self, tmp_path):
+        filename = str(tmp_path / 'live.nxs')
+        writer = subprocess.Popen([sys.executable, '-c', SWMR_WRITER, filename])
+        deadline = time.time() + 30
+        while not os.path.exists(filename + '.ready'):
+            assert writer.poll() is None and time.time() < deadline, "SWMR writer did not start"
+            time.sleep(0.05)
+        yield filename
+        open(filename + '.stop', 'w').close()
+        writer.wait(timeout=30)
+
+    def test_plain_reader_is_refused(self, swmr_file):
+        with pytest.raises(OSError):
+            open_nexus(swmr_file, live=False)
+
+    def test_live_reader(self, swmr_file):
+        with open_nexus(swmr_file, live=True) as f:
+            np.testing.assert_array_equal(f['entry/data/map'][()], np.arange(4.0))
+
+    def test_live_reader_of_a_finished_file(self, volume_file):
+        filename, data = volume_file
+        with open_nexus(filename, live=True) as f:
+            np.testing.assert_array_equal(f['entry/data/volume'][()], data)
+
+
+class TestDatasetIndex:
+    """load_dataset_index() and its .choices.json sidecar."""
+
+    def _load(self, filename):
+        return load_dataset_index(filename, filename + '.choices.json', status_callback=lambda message: None)
+
+    def _mark_sidecar(self, filename):
+        with open(filename + '.choices.json') as fp:
+            index = json.load(fp)
+        index['marker'] = True
+        with open(filename + '.choices.json', 'w') as fp:
+            json.dump(index, fp)
+
+    def test_sidecar_describes_the_file(self, volume_file):
+        filename, _ = volume_file
+        index = self._load(filename)
+        assert os.path.exists(filename + '.choices.json')
+        (entry,) = index['datasets']
+        assert entry['path'] == 'entry/data/volume'
+        assert entry['shape'] == (6, 5, 12, 10)
+        assert entry['chunks'] == (1, 5, 12, 10)
+        assert entry['dtype'] == '<f4'
+
+    def test_sidecar_is_reused_while_size_and_mtime_match(self, volume_file):
+        filename, _ = volume_file
+        self._load(filename)
+        self._mark_sidecar(filename)
+        assert self._load(filename).get('marker') is True
+
+    def test_changed_mtime_rewalks(self, volume_file):
+        filename, _ = volume_file
+        self._load(filename)
+        self._mark_sidecar(filename)
+        stat = os.stat(filename)
+        os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        index = self._load(filename)
+        assert 'marker' not in index
+        assert index['mtime_ns'] == stat.st_mtime_ns + 1000
+
+    def test_changed_file_rewalks(self, volume_file):
+        filename, _ = volume_file
+        self._load(filename)
+        self._mark_sidecar(filename)
+        with h5py.File(filename, 'a') as f:
+            f.create_dataset('entry/data/x', data=np.arange(6.0))
+        index = self._load(filename)
+        assert 'marker' not in index
+        assert sorted(entry['path'] for entry in index['datasets']) == ['entry/data/volume', 'entry/data/x']
+        assert index['size'] == os.stat(filename).st_size
+
+
+class TestOpenContiguousFloat32:
+    """open_contiguous_float32() memmaps only datasets stored as plain <f4 bytes."""
+
+    @pytest.fixture
+    def layouts_file(self, tmp_path):
+        data = np.random.default_rng(1).normal(size=(4, 3, 6, 5)).astype('<f4')
+        filename = str(tmp_path / 'layouts.nxs')
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('contiguous', data=data)
+            f.create_dataset('chunked', data=data, chunks=(1, 3, 6, 5))
+            f.create_dataset('compressed', data=data, compression='gzip')
+            f.create_dataset('big_endian', data=data.astype('>f4'))
+            f.create_dataset('float64', data=data.astype('<f8'))
+            f.create_dataset('unallocated', shape=data.shape, dtype='<f4')
+        return filename, data
+
+    def test_contiguous_matches_h5py(self, layouts_file):
+        filename, data = layouts_file
+        volume = open_contiguous_float32(filename, 'contiguous')
+        assert volume is not None and volume.dtype == np.dtype('<f4') and volume.shape == data.shape
+        with h5py.File(filename, 'r') as f:
+            np.testing.assert_array_equal(volume, f['contiguous'][...])
+
+    @pytest.mark.parametrize('path', ['chunked', 'compressed', 'big_endian', 'float64', 'unallocated'])
+    def test_other_layouts_are_refused(self, layouts_file, path):
+        filename, _ = layouts_file
+        assert open_contiguous_float32(filename, path) is None
+
+
+class TestArtifactFingerprint:
+    """artifact_fingerprint() / fingerprint_matches() decide when a derived artifact is stale."""
+
+    @pytest.fixture
+    def artifact(self, volume_file, tmp_path):
+        filename, data = volume_file
+        artifact_filename = str(tmp_path / 'scan.float32.npy')
+        np.save(artifact_filename, data)
+        write_fingerprint(artifact_filename,
+                          artifact_fingerprint(filename, 'entry/data/volume', data.shape, data.dtype, 'float32'))
+        return filename, data, artifact_filename
+
+    def _current(self, filename, data):
+        return artifact_fingerprint(filename, 'entry/data/volume', data.shape, data.dtype, 'float32')
+
+    def test_unchanged_source_matches(self, artifact):
+        filename, data, artifact_filename = artifact
+        assert fingerprint_matches(artifact_filename, self._current(filename, data))
+
+    def test_changed_mtime_invalidates(self, artifact):
+        filename, data, artifact_filename = artifact
+        stat = os.stat(filename)
+        os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        assert not fingerprint_matches(artifact_filename, self._current(filename, data))
+
+    def test_changed_size_invalidates(self, artifact):
+        filename, data, artifact_filename = artifact
+        stat = os.stat(filename)
+        with open(filename, 'ab') as fp:
+            fp.write(b'\0' * 16)
+        os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        assert os.stat(filename).st_size != stat.st_size
+        assert not fingerprint_matches(artifact_filename, self._current(filename, data))
+
+    def test_transform_version_bump_invalidates(self, artifact, monkeypatch):
+        filename, data, artifact_filename = artifact
+        monkeypatch.setitem(CACHE_TRANSFORM_VERSIONS, 'float32', CACHE_TRANSFORM_VERSIONS['float32'] + 1)
+        assert not fingerprint_matches(artifact_filename, self._current(filename, data))
+
+    def test_missing_sidecar_is_stale(self, artifact):
+        filename, data, artifact_filename = artifact
+        os.remove(artifact_filename + '.meta.json')
+        assert not fingerprint_matches(artifact_filename, self._current(filename, data))
+
+    def test_corrupt_sidecar_is_stale(self, artifact):
+        filename, data, artifact_filename = artifact
+        with open(artifact_filename + '.meta.json', 'w') as fp:
+            fp.write('{not json')
+        assert not fingerprint_matches(artifact_filename, self._current(filename, data))
+
+
+class TestProgressiveVolumeCache:
+    """Float32 cache builds in a thread and in worker processes."""
+
+    @pytest.fixture
+    def chunked_file(self, tmp_path):
+        data = np.random.default_rng(4).integers(0, 1000, size=(10, 3, 8, 6)).astype(np.uint16)
+        filename = str(tmp_path / 'chunked.nxs')
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('entry/data/volume', data=data, chunks=(2, 3, 8, 6), compression='gzip')
+        return filename, data
+
+    @pytest.mark.parametrize('workers', [1, 3])
+    def test_builds_float32_copy(self, chunked_file, tmp_path, workers):
+        filename, data = chunked_file
+        mmap_filename = str(tmp_path / 'chunked.float32.dat')
+        row_bytes = 3 * 8 * 6 * 4
+        cache = ProgressiveVolumeCache(filename, 'entry/data/volume', mmap_filename,
+                                       status_callback=lambda m: None, slab_bytes=2 * row_bytes, workers=workers)
+        cache.start()
+        cache._thread.join(60)
+        assert cache.error is None
+        assert cache.complete
+        np.testing.assert_array_equal(cache.volume(), data.astype(np.float32))
+        assert not [name for name in os.listdir(tmp_path) if '.partial-' in name]
+
+    @pytest.mark.parametrize('slab_rows, expected', [(5, 4), (2, 2), (1, 1)])
+    def test_slabs_stay_within_slab_bytes(self, chunked_file, tmp_path, slab_rows, expected):
+        filename, _data = chunked_file
+        row_bytes = 3 * 8 * 6 * 4
+        cache = ProgressiveVolumeCache(filename, 'entry/data/volume', str(tmp_path / 'c.dat'),
+                                       slab_bytes=slab_rows * row_bytes, workers=1)
+        # Rounded down to whole 2-row chunks when those fit, never above slab_bytes
+        assert cache.slab_rows == expected
+        assert cache.n_slabs == -(-10 // expected)
+
+
+class TestTiledVolume:
+    """TiledVolume write / read round trips with blocks that do not divide the shape."""
+
+    @pytest.fixture(params=[((11, 7, 13), (4, 3, 5)), ((9, 5, 10, 7), (4, 2, 3, 4))], ids=['3d', '4d'])
+    def tiled(self, request, tmp_path):
+        shape, block_shape = request.param
+        data = np.random.default_rng(5).random(shape).astype(np.float32)
+        with h5py.File(str(tmp_path / 'scan.nxs'), 'w') as f:
+            f['volume'] = data
+            tiled = TiledVolume.write(str(tmp_path / 'scan.tiles'), f['volume'], block_shape=block_shape)
+        return tiled, data
+
+    def test_round_trip(self, tiled):
+        tiled, data = tiled
+        assert tiled.shape == data.shape
+        np.testing.assert_array_equal(tiled[...], data)
+        np.testing.assert_array_equal(tiled[3], data[3])
+        np.testing.assert_array_equal(tiled[7:1:-2, ..., [4, 0, 2]], data[7:1:-2, ..., [4, 0, 2]])
+
+    def test_read_region_across_block_edges(self, tiled):
+        tiled, data = tiled
+        bounds = (slice(1, 8), slice(2, 5)) + tuple(slice(1, n - 1) for n in data.shape[2:])
+        np.testing.assert_array_equal(tiled.read_region(bounds), data[bounds])
+
+    def test_reduce_sum_over_detector_axes(self, tiled):
+        tiled, data = tiled
+        n_detector = 2 if data.ndim == 4 else 1
+        axes = tuple(range(data.ndim - n_detector, data.ndim))
+        bounds = (slice(None), slice(1, 4)) + tuple(slice(2, n - 1) for n in data.shape[2:])
+        np.testing.assert_allclose(tiled.reduce_sum(bounds, axes),
+                                   data[bounds].sum(axis=axes, dtype=np.float64), rtol=1e-6)
+
+    def test_default_block_shape(self):
+        assert TiledVolume.default_block_shape((100, 100, 300, 300)) == (8, 8, 64, 64)
+        # 3D volumes are (x, y, z): two scan axes, one detector axis
+        assert TiledVolume.default_block_shape((100, 100, 300)) == (8, 8, 64)
+        assert TiledVolume.default_block_shape((5, 100, 30)) == (5, 8, 30)
+
+
+def _reshape_mean(data, factor, axes):
+    """Mean over factor-wide bins of axes by reshaping, with NaN padding for the short last bins."""
+    padded = data.astype(np.float64)
+    for axis in axes:
+        widths = [(0, 0)] * padded.ndim
+        widths[axis] = (0, -padded.shape[axis] % factor)
+        padded = np.pad(padded, widths, constant_values=np.nan)
+    shape = []
+    for axis, n in enumerate(padded.shape):
+        shape += [n // factor, factor] if axis in axes else [n, 1]
+    return np.nanmean(padded.reshape(shape), axis=tuple(range(1, 2 * padded.ndim, 2)))
+
+
+class TestVolumePyramid:
+    """bin_mean() / build_volume_pyramid() against reshape means, and the choice of the interactive level."""
+
+    DATA = np.random.default_rng(6).random((11, 5, 9, 6)).astype(np.float32)
+
+    @pytest.mark.parametrize('factor', [2, 3, 4])
+    def test_bin_mean_odd_shape(self, factor):
+        np.testing.assert_allclose(bin_mean(self.DATA, factor), _reshape_mean(self.DATA, factor, range(4)), rtol=1e-6)
+        np.testing.assert_allclose(bin_mean(self.DATA, factor, axes=(2, 3)),
+                                   _reshape_mean(self.DATA, factor, (2, 3)), rtol=1e-6)
+
+    def test_pyramid_levels(self, tmp_path):
+        filenames = {f: str(tmp_path / f'scan.pyr{f}.float32.dat') for f in (2, 4, 8)}
+        # Two x-slabs of 8 rows: the second one holds the short last bins
+        build_volume_pyramid(self.DATA, filenames, slab_bytes=5 * 9 * 6 * 4)
+        for factor, filename in filenames.items():
+            shape = tuple(-(-n // factor) for n in self.DATA.shape)
+            level = np.memmap(filename, dtype=np.float32, mode='r', shape=shape)
+            np.testing.assert_allclose(level, _reshape_mean(self.DATA, factor, range(4)), rtol=1e-6)
+        assert not [name for name in os.listdir(tmp_path) if '.partial-' in name]
+
+    @pytest.mark.parametrize('full, levels, expected', [
+        (100, {2: 40, 4: 10, 8: 2}, 1),          # the full volume fits the budget
+        (1000, {}, 1),                            # no level built yet
+        (1000, {2: 250, 4: 60, 8: 8}, 4),         # finest level that fits
+        (1000, {8: 8}, 8),
+        (1000, {2: 250, 4: 150}, 4),              # none fits: the coarsest built
+    ])
+    def test_interactive_level(self, full, levels, expected):
+        assert interactive_level(full, levels, budget_bytes=100) == expected
+
+
+class TestSummedAreaTable:
+    """build_summed_area_table() / summed_area_sum() against direct ROI sums."""
+
+    ROIS = [((0, 12), (0, 10)), ((3, 7), (2, 9)), ((5, 6), (0, 1)), ((4, 4), (1, 8))]
+
+    def test_roi_sums_match_direct_sums(self, volume_file, tmp_path):
+        filename, data = volume_file
+        table_filename = str(tmp_path / 'scan.sat.dat')
+        with h5py.File(filename, 'r') as f:
+            # Small slabs so the table is built over several of them
+            build_summed_area_table(f['entry/data/volume'], table_filename, slab_bytes=2048)
+        table = np.memmap(table_filename, dtype=np.float64, mode='r', shape=(6, 5, 13, 11))
+        for (z0, z1), (u0, u1) in self.ROIS:
+            expected = data[:, :, z0:z1, u0:u1].astype(np.float64).sum(axis=(2, 3))
+            np.testing.assert_allclose(summed_area_sum(table, ((z0, z1), (u0, u1))), expected, rtol=1e-9)
+
+    def test_binned_table_snaps_outwards(self, volume_file, tmp_path):
+        filename, data = volume_file
+        table_filename = str(tmp_path / 'scan.sat2.dat')
+        with h5py.File(filename, 'r') as f:
+            build_summed_area_table(f['entry/data/volume'], table_filename, factor=2)
+        table = np.memmap(table_filename, dtype=np.float64, mode='r', shape=(6, 5, 7, 6))
+        aligned = data[:, :, 2:8, 4:10].astype(np.float64).sum(axis=(2, 3))
+        np.testing.assert_allclose(summed_area_sum(table, ((2, 8), (4, 10)), factor=2), aligned, rtol=1e-9)
+        # (3, 7) x (5, 9) covers the bins of [2, 8) x [4, 10)
+        np.testing.assert_allclose(summed_area_sum(table, ((3, 7), (5, 9)), factor=2), aligned, rtol=1e-9)
+
+    def test_3d_volume(self, tmp_path):
+        data = np.arange(4 * 3 * 9, dtype=np.float32).reshape(4, 3, 9)
+        table_filename = str(tmp_path / 'line.sat.dat')
+        build_summed_area_table(data, table_filename)
+        table = np.memmap(table_filename, dtype=np.float64, mode='r', shape=(4, 3, 10))
+        np.testing.assert_allclose(summed_area_sum(table, ((2, 7),)), data[..., 2:7].sum(axis=-1))
+
+
+class TestQuantizedVolume:
+    """write_quantized_volume() round trips and its max_error bound."""
+
+    @pytest.mark.parametrize('encoding', ['float16', 'uint16', 'log-uint16'])
+    def test_round_trip_within_max_error(self, volume_file, tmp_path, encoding):
+        filename, data = volume_file
+        data = data.copy()
+        data[1, 2, 3, 4] = np.nan
+        out_filename = str(tmp_path / f'scan.{encoding}.dat')
+        volume = write_quantized_volume(data, out_filename, encoding, status_callback=lambda m: None,
+                                        slab_bytes=4096)
+        assert isinstance(volume, QuantizedVolume)
+        assert volume.shape == data.shape
+        assert volume.stored_nbytes == data.nbytes // 2
+        decoded = volume[...]
+        assert np.isnan(decoded[1, 2, 3, 4])
+        finite = np.isfinite(data)
+        assert np.isfinite(decoded[finite]).all()
+        error = np.abs(decoded[finite] - data[finite]).max()
+        assert error <= volume.max_error * (1 + 1e-6)
+        assert volume.max_error <= 0.01 * np.nanmax(data)
+        # Indexing decodes just the selection; the sidecar reopens the same volume
+        np.testing.assert_array_equal(volume[2, :, 5], decoded[2, :, 5])
+        np.testing.assert_array_equal(QuantizedVolume(out_filename)[...], decoded)
+        assert not [name for name in os.listdir(tmp_path) if '.partial-' in name]
+
+    def test_float16_refuses_values_beyond_its_range(self, volume_file, tmp_path):
+        _filename, data = volume_file
+        data = data.copy()
+        data[4, 1, 7, 2] = 1e6
+        out_filename = str(tmp_path / 'scan.float16.dat')
+        with pytest.raises(ValueError, match='float16 range'):
+            write_quantized_volume(data, out_filename, 'float16', status_callback=lambda m: None, slab_bytes=4096)
+        assert sorted(os.listdir(tmp_path)) == ['scan.nxs']
+
+    @pytest.mark.parametrize('value', [65504.0, -65504.0])
+    def test_float16_keeps_its_largest_values(self, volume_file, tmp_path, value):
+        _filename, data = volume_file
+        data = data.copy()
+        data[0, 0, 0, 0] = value
+        volume = write_quantized_volume(data, str(tmp_path / 'scan.float16.dat'), 'float16',
+                                        status_callback=lambda m: None)
+        assert volume[0, 0, 0, 0] == value
+        assert np.isfinite(volume.max_error)
+        with open(str(tmp_path / 'scan.float16.dat.json')) as fp:
+            meta = json.load(fp)
+        assert (meta['min'], meta['max']) == (float(np.nanmin(data)), float(np.nanmax(data)))
+
+
+class TestByteBudgetLRUCache:
+    """Byte-budget eviction, fingerprints and uncached values."""
+
+    def test_evicts_least_recently_used(self):
+        cache = ByteBudgetLRUCache(budget_bytes=3 * 800)
+        arrays = {key: np.full(100, i, dtype=np.float64) for i, key in enumerate('abcd')}
+        for key in 'abc':
+            cache.put(key, arrays[key])
+        # Touch 'a' so 'b' becomes the least recently used entry
+        assert cache.get_or_load('a', lambda: pytest.fail("cached value reloaded")) is not None
+        cache.put('d', arrays['d'])
+        assert cache.peek('b') is None
+        for key in 'acd':
+            np.testing.assert_array_equal(cache.peek(key), arrays[key])
+        stats = cache.stats()
+        assert stats['entries'] == 3
+        assert stats['nbytes'] == 3 * 800
+        assert stats['evictions'] == 1
+
+    def test_values_are_read_only(self):
+        cache = ByteBudgetLRUCache(budget_bytes=1024)
+        value = cache.get_or_load('a', lambda: np.zeros(4))
+        with pytest.raises(ValueError):
+            value[0] = 1
+
+    def test_fingerprint_mismatch_is_a_miss(self):
+        cache = ByteBudgetLRUCache(budget_bytes=1024)
+        cache.get_or_load('a', lambda: np.zeros(4), fingerprint=1)
+        reloaded = cache.get_or_load('a', lambda: np.ones(4), fingerprint=2)
+        np.testing.assert_array_equal(reloaded, np.ones(4))
+        assert cache.peek('a', fingerprint=1) is None
+        assert cache.stats()['misses'] == 2
+
+    def test_oversized_and_non_array_values_are_not_cached(self):
+        cache = ByteBudgetLRUCache(budget_bytes=64)
+        assert cache.put('big', np.zeros(100)).shape == (100,)
+        assert cache.put('text', "not an array") == "not an array"
+        assert cache.stats()['entries'] == 0
+
+    def test_invalidate(self):
+        cache = ByteBudgetLRUCache(budget_bytes=1024)
+        cache.put(('a.nxs', 'x'), np.zeros(2))
+        cache.put(('b.nxs', 'x'), np.zeros(2))
+        assert cache.invalidate(lambda key: key[0] == 'a.nxs') == 1
+        assert cache.peek(('a.nxs', 'x')) is None
+        assert cache.peek(('b.nxs', 'x')) is not None
+
+
+class TestSharedVolumeRegistry:
+    """Reference counting of shared volumes across sessions."""
+
+    def test_acquire_shares_one_value(self):
+        registry = SharedVolumeRegistry()
+        calls = []
+
+        def factory():
+            calls.append(1)
+            return np.arange(4.0)
+
+        first = registry.acquire('vol', 'session-1', factory)
+        second = registry.acquire('vol', 'session-2', factory)
+        assert first is second
+        assert len(calls) == 1
+        assert not first.flags.writeable
+        assert registry.sessions_using('vol') == {'session-1', 'session-2'}
+
+    def test_release_drops_entry_with_last_session(self):
+        registry = SharedVolumeRegistry()
+        registry.acquire('vol', 'session-1', lambda: np.zeros(2))
+        registry.acquire('vol', 'session-2', lambda: np.zeros(2))
+        registry.acquire('other', 'session-2', lambda: np.zeros(2))
+        assert registry.release_session('session-1') == []
+        assert registry.stats() == {'vol': 1, 'other': 1}
+        assert sorted(registry.release_session('session-2')) == ['other', 'vol']
+        assert registry.get('vol') is None
+
+    def test_stale_entries_are_replaced(self):
+        registry = SharedVolumeRegistry()
+        old = registry.acquire('vol', 's', lambda: np.zeros(2), fingerprint=(1, 1))
+        new = registry.acquire('vol', 's', lambda: np.ones(2), fingerprint=(2, 1))
+        assert new is not old
+        invalid = registry.acquire('vol', 's', lambda: np.full(2, 2.0), valid=lambda value: False, fingerprint=(2, 1))
+        np.testing.assert_array_equal(invalid, [2.0, 2.0])
+
+    def test_factory_returning_none_is_not_registered(self):
+        registry = SharedVolumeRegistry()
+        assert registry.acquire('vol', 's', lambda: None) is None
+        assert registry.stats() == {}
+
+    def test_slow_factory_only_blocks_its_key(self):
+        registry = SharedVolumeRegistry()
+        started, finish = threading.Event(), threading.Event()
+        calls = []
+        results = {}
+
+        def slow():
+            calls.append(1)
+            started.set()
+            finish.wait(10)
+            return np.zeros(2)
+
+        def acquire(name, key, session_id, factory):
+            results[name] = registry.acquire(key, session_id, factory)
+
+        builder = threading.Thread(target=acquire, args=('slow', 'vol', 's1', slow))
+        builder.start()
+        assert started.wait(10)
+        others = [threading.Thread(target=acquire, args=(key, key, 's2', lambda: np.ones(2))) for key in ('a', 'b')]
+        for thread in others:
+            thread.start()
+        for thread in others:
+            thread.join(10)
+        assert 'a' in results and 'b' in results and 'slow' not in results
+
+        # Same key: waits for the running factory instead of calling it again
+        waiter = threading.Thread(target=acquire, args=('same', 'vol', 's2', slow))
+        waiter.start()
+        waiter.join(0.1)
+        assert waiter.is_alive()
+        finish.set()
+        builder.join(10)
+        waiter.join(10)
+        assert results['same'] is results['slow']
+        assert len(calls) == 1
+        assert registry.sessions_using('vol') == {'s1', 's2'}
+
+    def test_failed_factory_is_retried(self):
+        registry = SharedVolumeRegistry()
+
+        def broken():
+            raise OSError("unreadable")
+
+        with pytest.raises(OSError):
+            registry.acquire('vol', 's', broken)
+        np.testing.assert_array_equal(registry.acquire('vol', 's', lambda: np.ones(2)), [1.0, 1.0])
+
+    def test_filenames(self, tmp_path):
+        registry = SharedVolumeRegistry()
+        filename = str(tmp_path / 'scan.float32.dat')
+        np.memmap(filename, dtype=np.float32, mode='w+', shape=(2,)).flush()
+        registry.acquire('vol', 's', lambda: np.memmap(filename, dtype=np.float32, mode='r', shape=(2,)))
+        assert registry.filenames() == {os.path.realpath(filename)}